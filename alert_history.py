@@ -0,0 +1,107 @@
+from collections import deque
+
+
+class AlertHistory(deque):
+    """
+    Historial de productos de una alerta (deque con maxlen) con un índice de IDs en sincronía,
+    para saber en O(1) si un producto ya fue visto. Al desbordar el maxlen, el producto que sale
+    del deque también sale del índice, así la memoria queda acotada igual que el historial.
+    """
+
+    def __init__(self, iterable=(), maxlen=None):
+        # deque.__init__ carga el iterable en C (respetando maxlen); el índice se arma después en un solo paso
+        super().__init__(iterable, maxlen)
+        # _ids: { product_id: cantidad de veces que aparece en el deque }
+        ids = [product.get('id') for product in self if product is not None]
+        self._ids = dict.fromkeys(ids, 1)
+        if len(self._ids) != len(ids) or None in self._ids:
+            # Hay IDs repetidos o faltantes: contar uno por uno
+            self._ids = {}
+            for product in self:
+                self._index(product)
+
+    def contains_id(self, product_id):
+        return product_id in self._ids
+
+    def _index(self, product):
+        product_id = product.get('id') if product is not None else None
+        if product_id is not None:
+            self._ids[product_id] = self._ids.get(product_id, 0) + 1
+
+    def _unindex(self, product):
+        product_id = product.get('id') if product is not None else None
+        count = self._ids.get(product_id)
+        if count is None:
+            return
+        if count <= 1:
+            del self._ids[product_id]
+        else:
+            self._ids[product_id] = count - 1
+
+    def appendleft(self, product):
+        if self.maxlen is not None and len(self) == self.maxlen:
+            if self.maxlen == 0:
+                return
+            self._unindex(self[-1])
+        super().appendleft(product)
+        self._index(product)
+
+    def replace(self, product):
+        """Saca la versión anterior de la publicación (mismo ID) y pone esta adelante, como la última vista."""
+        product_id = product.get('id')
+        for index, old in enumerate(self if self.contains_id(product_id) else ()):
+            if old is not None and old.get('id') == product_id:
+                del self[index]
+                break
+        self.appendleft(product)
+
+    def append(self, product):
+        if self.maxlen is not None and len(self) == self.maxlen:
+            if self.maxlen == 0:
+                return
+            self._unindex(self[0])
+        super().append(product)
+        self._index(product)
+
+    def extend(self, products):
+        for product in products:
+            self.append(product)
+
+    def extendleft(self, products):
+        for product in products:
+            self.appendleft(product)
+
+    def pop(self):
+        product = super().pop()
+        self._unindex(product)
+        return product
+
+    def popleft(self):
+        product = super().popleft()
+        self._unindex(product)
+        return product
+
+    def remove(self, product):
+        super().remove(product)
+        self._unindex(product)
+
+    def insert(self, index, product):
+        super().insert(index, product)
+        self._index(product)
+
+    def __setitem__(self, index, product):
+        self._unindex(self[index])
+        super().__setitem__(index, product)
+        self._index(product)
+
+    def __delitem__(self, index):
+        self._unindex(self[index])
+        super().__delitem__(index)
+
+    def __iadd__(self, products):
+        self.extend(products)
+        return self
+
+    def clear(self):
+        super().clear()
+        self._ids.clear()
@@ -0,0 +1,154 @@
+import asyncio
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from scheduler import QueryScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncQueryScheduler(QueryScheduler):
+    """
+    Variante de QueryScheduler sobre asyncio: cada grupo de búsqueda es una corrutina en un único
+    event loop, y un semáforo limita cuántas peticiones a Marketplace hay en vuelo a la vez.
+    La entrega a los suscriptores (telebot es bloqueante) se hace en un pool de hilos acotado.
+    """
+
+    def __init__(self, fetch_products_async, interval_fn, max_concurrency=20, max_workers=8, on_shutdown=None,
+                 max_cover_radius=0):
+        # fetch_products_async(search_term, region, seen_ids, price_bounds) -> corrutina que devuelve list | None
+        super().__init__(None, interval_fn, max_workers=max_workers, max_cover_radius=max_cover_radius)
+        self._fetch_products_async = fetch_products_async
+        # on_shutdown() -> corrutina a correr en el loop antes de cerrarlo (ej. cerrar la sesión HTTP)
+        self._on_shutdown = on_shutdown
+        self._max_concurrency = max_concurrency
+        self._loop = None
+        self._loop_thread = None
+        self._semaphore = None
+        # _wake_events: { QueryGroup: asyncio.Event | None } - corrutinas vivas, para despertarlas en reschedule/unsubscribe
+        self._wake_events = {}
+
+    def start(self):
+        """Arranca el event loop en un hilo propio y el pool de entrega (idempotente)."""
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="notify")
+            self._loop_thread = threading.Thread(target=self._loop.run_forever, name="monitor-asyncio", daemon=True)
+            self._loop_thread.start()
+            # Grupos que se suscribieron antes de arrancar el loop
+            for group_key, group in self._groups.items():
+                self._spawn(group_key, group)
+        logger.info(f"Motor asyncio de monitoreo iniciado (concurrencia {self._max_concurrency}, {self._max_workers} workers de entrega).")
+
+    def stop(self, wait=True):
+        """Cancela las corrutinas de los grupos y detiene el event loop. Las suscripciones se conservan."""
+        with self._lock:
+            if self._loop is None:
+                return
+            loop, loop_thread, executor = self._loop, self._loop_thread, self._executor
+            self._loop = None
+            self._loop_thread = None
+            self._executor = None
+            self._wake_events = {}
+
+        async def _shutdown():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            try:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            finally:
+                # Se corre siempre: es lo que cierra la sesión aiohttp del loop
+                if self._on_shutdown is not None:
+                    await self._on_shutdown()
+
+        try:
+            asyncio.run_coroutine_threadsafe(_shutdown(), loop).result()
+        except Exception as e:
+            logger.exception(f"Error cerrando el motor asyncio de monitoreo: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        loop.close()
+        executor.shutdown(wait=wait)
+        logger.info("Motor asyncio de monitoreo detenido.")
+
+    def unsubscribe(self, user_id, search_term):
+        with self._lock:
+            group = self._groups.get(self._subscriptions.get((user_id, search_term)))
+        stopped = super().unsubscribe(user_id, search_term)
+        if group is not None:
+            self._wake(group)
+        return stopped
+
+    def _schedule(self, group_key, group, delay):
+        # Requiere self._lock. La corrutina del grupo espera hasta group.next_due.
+        group.next_due = time.monotonic() + delay
+        if group in self._wake_events:
+            self._wake(group)
+        elif self._loop is not None:
+            self._spawn(group_key, group)
+
+    def _spawn(self, group_key, group):
+        # Requiere self._lock
+        self._wake_events[group] = None
+        asyncio.run_coroutine_threadsafe(self._group_loop(group_key, group), self._loop)
+
+    def _wake(self, group):
+        loop = self._loop
+        wake_event = self._wake_events.get(group)
+        if loop is not None and wake_event is not None:
+            loop.call_soon_threadsafe(wake_event.set)
+
+    def _is_current(self, group_key, group):
+        with self._lock:
+            return self._groups.get(group_key) is group
+
+    async def _group_loop(self, group_key, group):
+        wake_event = asyncio.Event()
+        with self._lock:
+            self._wake_events[group] = wake_event
+        logger.info(f"Corrutina de grupo iniciada para '{group.query}'")
+        try:
+            while self._is_current(group_key, group):
+                # Esperar hasta el vencimiento (reschedule puede moverlo y despertarnos)
+                while True:
+                    with self._lock:
+                        remaining = None if group.next_due is None else group.next_due - time.monotonic()
+                    if remaining is None or remaining <= 0 or not self._is_current(group_key, group):
+                        break
+                    wake_event.clear()
+                    try:
+                        await asyncio.wait_for(wake_event.wait(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                if not self._is_current(group_key, group):
+                    break
+
+                with self._lock:
+                    group.running = True
+                    group.next_due = None
+                try:
+                    async with self._semaphore:
+                        products = await self._fetch_products_async(group.query, group.region, group.seen_ids, group.price_bounds)
+                    await asyncio.get_running_loop().run_in_executor(self._executor, self._fan_out, group, products)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.exception(f"Error inesperado en el ciclo del grupo '{group.query}': {e}")
+                finally:
+                    with self._lock:
+                        group.running = False
+                        refresh_interval = 0 if group.rerun else self._interval_fn(group)
+                        group.rerun = False
+                        group.next_due = time.monotonic() + refresh_interval
+                logger.info(f"Grupo '{group.query}' esperando {refresh_interval} segundos.")
+        finally:
+            with self._lock:
+                if self._wake_events.get(group) is wake_event:
+                    del self._wake_events[group]
+            logger.info(f"Corrutina de grupo detenida para '{group.query}'")
@@ -0,0 +1,205 @@
+"""
+Benchmark de la capa de handlers: muchos usuarios tocando botones a la vez, contra la Bot API de prueba
+(fake_telegram.py) y el servidor GraphQL de prueba (fake_graphql.py).
+
+Levanta el bot en modo polling (infinity_polling y el pool de telebot) o webhook (UpdateDispatcher),
+inyecta un update por usuario (por ronda) y mide:
+  - entrega: desde que el update está disponible hasta que getUpdates lo levanta (o el webhook lo acepta)
+  - respuesta: hasta la primera llamada del bot a Telegram para ese update (ej. answerCallbackQuery)
+  - fin: hasta la última llamada del bot para ese update
+y el throughput de updates atendidos por segundo.
+
+Escenarios: "start" (/start), "menu" (botón "Buscar Ahora" que lista las alertas) y "search_now"
+(elegir una alerta en "Buscar Ahora", que deja la búsqueda en Marketplace en el pool de búsquedas manuales).
+
+Uso:
+    python benchmarks/bench_handlers.py --users 500 --scenario search_now --graphql-latency 1
+    python benchmarks/bench_handlers.py --users 500 --scenario search_now --mode webhook --workers 32
+    python benchmarks/bench_handlers.py --users 2000 --scenario start --rate 200
+"""
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_graphql import FakeGraphQLServer
+from fake_telegram import FakeTelegramServer
+from bench_pipeline import percentile, fmt_ms, current_rss_kib
+from aiohttp import web
+
+SCENARIOS = ("start", "menu", "search_now")
+WEBHOOK_PATH = "/telegram"
+
+
+def make_update(telegram, scenario, user_id, search_term):
+    if scenario == "start":
+        return telegram.message_update(user_id, "/start")
+    if scenario == "menu":
+        return telegram.callback_update(user_id, "select_alert_search_now")
+    return telegram.callback_update(user_id, f"search_now_{search_term}")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_webhook_server(app, port):
+    """Sirve la app del webhook en un hilo propio; devuelve la función para detenerlo."""
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app, access_log=None)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+    thread = threading.Thread(target=loop.run_forever, name="webhook", daemon=True)
+    thread.start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+    return stop
+
+
+def wait_until_idle(telegram, update_ids, idle, timeout):
+    """Espera a que se entreguen todos los updates y el bot deje de llamar a Telegram por idle segundos."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(0.2)
+        with telegram._lock:
+            delivered = all(update_id in telegram.delivered_at for update_id in update_ids)
+            last_call = telegram.calls[-1]["time"] if telegram.calls else 0
+        if delivered and time.monotonic() - last_call >= idle:
+            return True
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--scenario", choices=SCENARIOS, default="search_now")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--workers", type=int, default=16, help="hilos del UpdateDispatcher en modo webhook")
+    parser.add_argument("--rounds", type=int, default=1, help="updates por usuario (una ronda termina antes de la siguiente)")
+    parser.add_argument("--rate", type=float, default=0, help="updates por segundo al inyectar (0 = todos juntos)")
+    parser.add_argument("--queries", type=int, default=20, help="búsquedas distintas entre las alertas de los usuarios")
+    parser.add_argument("--graphql-latency", type=float, default=0.5, help="demora de cada respuesta de GraphQL (s)")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="demora de cada llamada a la Bot API (s)")
+    parser.add_argument("--chat-per-second", type=int, default=3)
+    parser.add_argument("--global-per-second", type=int, default=30)
+    parser.add_argument("--idle", type=float, default=2.0, help="segundos sin llamadas para dar una ronda por terminada")
+    parser.add_argument("--timeout", type=float, default=300, help="tope de espera por ronda (s)")
+    parser.add_argument("--verbose", action="store_true", help="dejar los logs INFO del bot")
+    args = parser.parse_args()
+
+    graphql = FakeGraphQLServer(latency=args.graphql_latency, seed=1).start()
+    telegram = FakeTelegramServer(latency=args.telegram_latency, chat_per_second=args.chat_per_second,
+                                  global_per_second=args.global_per_second, seed=1).start()
+    workdir = tempfile.mkdtemp(prefix="bench_handlers_")
+    webhook_port = free_port()
+    webhook_url = f"http://127.0.0.1:{webhook_port}{WEBHOOK_PATH}"
+    os.environ.update({
+        "BOT_TOKEN": "123456:benchmark",
+        "TELEGRAM_API_URL": telegram.api_url,
+        "FACEBOOK_COOKIE": "c_user=0; xs=benchmark",
+        "FACEBOOK_SESSIONS_FILE": os.path.join(workdir, "sin_sesiones.json"),
+        "MARKETPLACE_GRAPHQL_URL": graphql.url,
+        "DB_FILE": os.path.join(workdir, "bench.db"),
+        "MARKETPLACE_REQUESTS_PER_MINUTE": "60000",
+        "MARKETPLACE_BURST": "1000",
+        "BOT_MODE": args.mode,
+        "WEBHOOK_URL": webhook_url,
+    })
+    os.chdir(workdir)
+
+    import bot
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    bot.user_searches, bot.product_history = bot.load_storage()
+    search_terms = {}
+    for user in range(args.users):
+        user_id = 1000 + user
+        search_terms[user_id] = f"producto {user % args.queries}"
+        bot.user_searches[user_id][search_terms[user_id]] = {"active": False, "chat_id": user_id}
+    bot.notifier.start()
+    if args.mode == "webhook":
+        from webhook import UpdateDispatcher, create_webhook_app
+        dispatcher = UpdateDispatcher(bot.bot.process_new_updates, max_workers=args.workers)
+        stop_webhook = start_webhook_server(create_webhook_app(dispatcher, WEBHOOK_PATH), webhook_port)
+        bot.bot.set_webhook(url=webhook_url)
+    else:
+        polling = threading.Thread(target=bot.bot.infinity_polling, kwargs={"timeout": 30, "long_polling_timeout": 5},
+                                   name="polling", daemon=True)
+        polling.start()
+
+    print(f"{args.users} usuarios, escenario '{args.scenario}', modo {args.mode}, {args.rounds} ronda(s), "
+          f"GraphQL {args.graphql_latency}s, Bot API {args.telegram_latency}s...")
+    update_ids = []
+    start = time.monotonic()
+    for _ in range(args.rounds):
+        round_ids = []
+        for user_id, search_term in search_terms.items():
+            round_ids.append(telegram.push_update(make_update(telegram, args.scenario, user_id, search_term)))
+            if args.rate:
+                time.sleep(1 / args.rate)
+        if not wait_until_idle(telegram, round_ids, args.idle, args.timeout):
+            print(f"  ¡La ronda no terminó en {args.timeout:.0f}s!")
+        update_ids.extend(round_ids)
+
+    if args.mode == "webhook":
+        bot.bot.remove_webhook()
+        stop_webhook()
+        dispatcher.shutdown()
+    else:
+        bot.bot.stop_polling()
+        polling.join(timeout=10)
+    bot.notifier.stop(timeout=1)
+    bot.storage.close()
+    graphql_stats = graphql.stats()
+    telegram_stats = telegram.stats()
+    graphql.stop()
+    telegram.stop()
+
+    calls_by_update = {}
+    for call in telegram.calls:
+        if call["update_id"] is not None and call["method"] != "getUpdates":
+            calls_by_update.setdefault(call["update_id"], []).append(call["time"])
+    delivery, response, done = [], [], []
+    for update_id in update_ids:
+        pushed = telegram.pushed_at[update_id]
+        if update_id in telegram.delivered_at:
+            delivery.append(telegram.delivered_at[update_id] - pushed)
+        times = calls_by_update.get(update_id)
+        if times:
+            response.append(min(times) - pushed)
+            done.append(max(times) - pushed)
+    last_done = max((max(times) for times in calls_by_update.values()), default=start)
+    elapsed = max(1e-9, last_done - start)
+
+    print(f"\nUpdates: {len(update_ids)} inyectados, {len(delivery)} entregados, {len(done)} con respuesta "
+          f"({len(done) / elapsed:.1f} updates/s)")
+    for name, values in (("entrega", delivery), ("respuesta", response), ("fin", done)):
+        print(f"  {name:<10} p50 {fmt_ms(percentile(values, 50)):>10}  p99 {fmt_ms(percentile(values, 99)):>10}  "
+              f"máx {fmt_ms(max(values) if values else None):>10}")
+    print(f"Llamadas a la Bot API: {telegram_stats['calls']}")
+    for method, statuses in sorted(telegram_stats["methods"].items()):
+        counts = ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items()))
+        print(f"  {method:<22} {counts}")
+    print(f"Peticiones a GraphQL: {graphql_stats['requests']}")
+    rss = current_rss_kib()
+    if rss:
+        print(f"RSS al final: {rss // 1024} MiB")
+    print(f"Datos temporales en {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Compara el parseo completo (json.loads + parse_graphql_response) contra el parseo incremental
+(ijson, parse_graphql_stream) sobre respuestas de GraphQL: tiempo por respuesta y pico de memoria.
+
+Uso:
+    python benchmarks/bench_parse.py                       # respuestas sintéticas
+    python benchmarks/bench_parse.py respuesta1.json ...   # respuestas grabadas
+    python benchmarks/bench_parse.py --edges 96 --padding 4000 --repeat 50
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import marketplace_api
+from marketplace_api import parse_graphql_response, parse_page_info
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger("bench_parse")
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+def synthetic_response(edges, padding):
+    """Respuesta con la forma de la de Marketplace; padding agrega datos que el bot no usa a cada edge."""
+    def edge(i):
+        return {
+            "node": {
+                "__typename": "MarketplaceFeedListingStoryObject",
+                "story_type": "POST",
+                "story_key": str(10 ** 15 + i),
+                "tracking": "x" * padding,
+                "listing": {
+                    "__typename": "GroupCommerceProductItem",
+                    "id": str(10 ** 15 + i),
+                    "primary_listing_photo": {"__typename": "ProductImage", "image": {"uri": f"https://scontent.example/{i}.jpg"}, "id": str(i)},
+                    "__isMarketplaceListingRenderable": "GroupCommerceProductItem",
+                    "listing_price": {"formatted_amount": f"${i * 1000:,}", "amount_with_offset_in_currency": str(i * 100000), "amount": str(i * 1000)},
+                    "strikethrough_price": None,
+                    "location": {"reverse_geocode": {"city": "Rosario", "state": "Santa Fe", "city_page": {"display_name": "Rosario", "id": "1"}}},
+                    "is_hidden": False, "is_live": True, "is_pending": False, "is_sold": i % 10 == 0, "is_viewer_seller": False,
+                    "min_listing_price": None, "max_listing_price": None,
+                    "marketplace_listing_category_id": "1792291877663080",
+                    "marketplace_listing_title": f"Producto de prueba número {i}",
+                    "custom_title": None,
+                    "custom_sub_titles_with_rendering_flags": [],
+                    "origin_group": None,
+                    "pre_recorded_videos": [],
+                    "__isMarketplaceListingWithChildListings": "GroupCommerceProductItem",
+                    "parent_listing": None,
+                    "marketplace_listing_seller": {"__typename": "User", "name": "Vendedor", "id": str(i)},
+                    "__isMarketplaceListingWithDeliveryOptions": "GroupCommerceProductItem",
+                    "delivery_types": ["IN_PERSON"],
+                },
+                "id": f"{i}:{10 ** 15 + i}",
+            },
+            "cursor": None,
+        }
+    return {
+        "data": {
+            "marketplace_search": {
+                "feed_units": {
+                    "edges": [edge(i) for i in range(edges)],
+                    "page_info": {"end_cursor": "eyJwZyI6MX0=", "has_next_page": True},
+                    "session_id": "abc",
+                    "logging_unit_id": "y" * padding,
+                },
+                "marketplace_seo_page": None,
+            }
+        },
+        "extensions": {"is_final": True, "prefetch_uris_v2": [{"uri": "z" * 200, "label": None}] * (edges // 2)},
+    }
+
+
+def parse_full(body):
+    data = json.loads(body)
+    return parse_graphql_response(data, logger), parse_page_info(data)
+
+def parse_full_orjson(body):
+    data = orjson.loads(body)
+    return parse_graphql_response(data, logger), parse_page_info(data)
+
+def parse_stream(body):
+    return marketplace_api.parse_graphql_stream(io.BytesIO(body), logger)
+
+
+def measure(parse, body, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = parse(body)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    parse(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, statistics.median(times), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="respuestas grabadas (JSON); sin archivos se usan sintéticas")
+    parser.add_argument("--edges", type=int, default=24, help="edges por respuesta sintética")
+    parser.add_argument("--padding", type=int, default=2000, help="bytes de relleno por edge en las sintéticas")
+    parser.add_argument("--repeat", type=int, default=30)
+    args = parser.parse_args()
+
+    if args.files:
+        bodies = []
+        for path in args.files:
+            with open(path, "rb") as f:
+                bodies.append((os.path.basename(path), f.read()))
+    else:
+        bodies = [(f"sintética {args.edges} edges", json.dumps(synthetic_response(args.edges, args.padding)).encode())]
+
+    parsers = [("json completo", parse_full)]
+    if orjson is not None:
+        parsers.append(("orjson completo", parse_full_orjson))
+    if marketplace_api.ijson is not None:
+        parsers.append(("ijson streaming", parse_stream))
+    else:
+        print("ijson no está instalado: se omite el parseo incremental.")
+
+    for name, body in bodies:
+        print(f"\n{name}: {len(body) / 1024:.0f} KiB")
+        print(f"  {'parser':<18}{'mediana':>12}{'pico memoria':>16}{'productos':>11}")
+        reference = None
+        for parser_name, parse in parsers:
+            (products, end_cursor), median, peak = measure(parse, body, args.repeat)
+            ids = [product.id for product in products]
+            if reference is None:
+                reference = (ids, end_cursor)
+            elif (ids, end_cursor) != reference:
+                print(f"  ¡{parser_name} devolvió un resultado distinto al de json completo!")
+            print(f"  {parser_name:<18}{median * 1000:>10.2f}ms{peak / 1024:>13.0f}KiB{len(products):>11}")
+
+
+if __name__ == "__main__":
+    main()
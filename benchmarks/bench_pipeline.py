@@ -0,0 +1,235 @@
+"""
+Benchmark del monitoreo completo (fetch -> parseo -> dedupe -> persistencia -> notificación) contra el
+servidor GraphQL de prueba (fake_graphql.py), sin tocar facebook.com ni Telegram.
+
+Levanta el bot con N usuarios x M alertas (scheduler, monitor_search y storage reales, en un directorio
+temporal), deja correr el monitoreo --duration segundos y reporta peticiones/s, costo del dedupe y de la
+persistencia, latencia p50/p99 desde que aparece una publicación hasta que sale su notificación, y RSS.
+Los envíos a Telegram se registran en memoria (pasan igual por el Notifier y sus límites).
+
+Uso:
+    python benchmarks/bench_pipeline.py --users 50 --alerts 3 --duration 60
+    python benchmarks/bench_pipeline.py --engine asyncio --latency 0.5 --throttle-rate 0.01 fixtures/*.json
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_graphql import FakeGraphQLServer
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+ITEM_ID_PATTERN = re.compile(r"/marketplace/item/(\d+)")
+
+
+class Timer:
+    """Acumula duraciones de llamadas desde varios hilos."""
+
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.durations = []
+        self._lock = threading.Lock()
+
+    def wrap(self, fn, count_items=None):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.calls += 1
+                    self.items += count_items(*args) if count_items else 1
+                    self.durations.append(elapsed)
+        return timed
+
+    @property
+    def total(self):
+        with self._lock:
+            return sum(self.durations)
+
+
+class RecordingTelegram:
+    """Hace de bot de Telegram para el Notifier: registra cada envío y la latencia de cada publicación."""
+
+    def __init__(self, created_at):
+        self.created_at = created_at
+        self.messages = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def _record(self, *texts):
+        now = time.monotonic()
+        with self._lock:
+            self.messages += 1
+            for text in texts:
+                for listing_id in ITEM_ID_PATTERN.findall(text or ""):
+                    created = self.created_at(listing_id)
+                    if created is not None:
+                        self.latencies.append(now - created)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._record(text)
+
+    def send_photo(self, chat_id, photo=None, caption=None, **kwargs):
+        self._record(caption)
+
+    def send_media_group(self, chat_id, media, **kwargs):
+        self._record(*(item.caption for item in media))
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def current_rss_kib():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_kib():
+    if resource is None:
+        return None
+    # ru_maxrss viene en KiB en Linux y en bytes en macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def fmt_ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.1f}ms"
+
+
+def configure_environment(args, server_url, workdir):
+    """Variables que lee bot.py al importarse: todo apunta al servidor de prueba y al directorio temporal."""
+    os.environ.update({
+        "BOT_TOKEN": "123456:benchmark",
+        "FACEBOOK_COOKIE": "c_user=0; xs=benchmark",
+        "FACEBOOK_SESSIONS_FILE": os.path.join(workdir, "sin_sesiones.json"),
+        "MARKETPLACE_GRAPHQL_URL": server_url,
+        "STORAGE_BACKEND": args.storage,
+        "DB_FILE": os.path.join(workdir, "bench.db"),
+        "MONITOR_ENGINE": args.engine,
+        "MONITOR_WORKERS": str(args.workers),
+        "MONITOR_CONCURRENCY": str(args.concurrency),
+        "MONITOR_INTERVAL_MODE": "adaptive",
+        "MONITOR_INTERVAL_MIN_SECONDS": str(args.interval),
+        "MONITOR_INTERVAL_MAX_SECONDS": str(args.interval),
+        "MONITOR_REQUESTS_PER_HOUR": "0",
+        "MARKETPLACE_REQUESTS_PER_MINUTE": str(args.requests_per_minute),
+        "MARKETPLACE_BURST": str(max(5, args.requests_per_minute // 60)),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fixtures", nargs="*", help="respuestas grabadas para el servidor de prueba")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--alerts", type=int, default=3, help="alertas por usuario")
+    parser.add_argument("--queries", type=int, default=0, help="búsquedas distintas (0 = una por alerta, sin compartir)")
+    parser.add_argument("--duration", type=float, default=30, help="segundos de monitoreo medidos")
+    parser.add_argument("--interval", type=int, default=5, help="segundos entre ciclos de cada búsqueda")
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--storage", choices=("sqlite", "json"), default="sqlite")
+    parser.add_argument("--requests-per-minute", type=int, default=6000, help="límite del bot hacia Marketplace")
+    parser.add_argument("--latency", type=float, default=0.1, help="demora del servidor de prueba (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--new-per-minute", type=float, default=6.0, help="publicaciones nuevas por minuto en cada búsqueda")
+    parser.add_argument("--verbose", action="store_true", help="dejar los logs INFO del bot")
+    args = parser.parse_args()
+
+    server = FakeGraphQLServer(latency=args.latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                               new_per_minute=args.new_per_minute, fixtures=args.fixtures, seed=1).start()
+    workdir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    configure_environment(args, server.url, workdir)
+    os.chdir(workdir)
+    rss_before = current_rss_kib()
+
+    import bot
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    telegram = RecordingTelegram(server.created_at)
+    bot.notifier.bot = telegram
+    dedupe = Timer()
+    persistence = Timer()
+    cycles = Timer()
+    bot.product_not_in_history = dedupe.wrap(bot.product_not_in_history)
+    bot.storage.add_products = persistence.wrap(bot.storage.add_products, lambda user_id, term, products: len(products))
+    monitor_search = cycles.wrap(bot.monitor_search)
+    bot.monitor_search = monitor_search
+
+    bot.user_searches, bot.product_history = bot.load_storage()
+    bot.notifier.start()
+    bot.digest_buffer.start()
+
+    distinct = args.queries or args.users * args.alerts
+    for user in range(args.users):
+        user_id = 1000 + user
+        for alert in range(args.alerts):
+            search_term = f"producto {(user * args.alerts + alert) % distinct}"
+            bot.user_searches[user_id][search_term] = {"active": True, "chat_id": user_id}
+            bot.start_monitoring(user_id, user_id, search_term)
+
+    print(f"{args.users} usuarios x {args.alerts} alertas ({distinct} búsquedas distintas), motor {args.engine}, "
+          f"storage {args.storage}, intervalo {args.interval}s, {args.duration:.0f}s de medición...")
+    start = time.monotonic()
+    rss_samples = []
+    while time.monotonic() - start < args.duration:
+        time.sleep(1)
+        rss_samples.append(current_rss_kib())
+    elapsed = time.monotonic() - start
+
+    bot.query_scheduler.stop()
+    pending_notifications = bot.notifier.pending()
+    flush_start = time.perf_counter()
+    bot.storage.flush()
+    flush_elapsed = time.perf_counter() - flush_start
+    bot.digest_buffer.stop()
+    bot.notifier.stop(timeout=1)
+    bot.storage.close()
+    server_stats = server.stats()
+    server.stop()
+
+    statuses = ", ".join(f"{status}: {count}" for status, count in sorted(server_stats["status"].items()))
+    print(f"\nPeticiones a GraphQL: {server_stats['requests']} ({server_stats['requests'] / elapsed:.1f}/s) [{statuses}]")
+    print(f"  edges servidos: {server_stats['edges']}, {server_stats['bytes'] / 1024 / 1024:.1f} MiB")
+    print(f"Ciclos de alerta (monitor_search): {cycles.calls}, p50 {fmt_ms(percentile(cycles.durations, 50))}, "
+          f"p99 {fmt_ms(percentile(cycles.durations, 99))}")
+    per_check = dedupe.total / dedupe.calls if dedupe.calls else 0
+    print(f"Dedupe: {dedupe.calls} chequeos, {dedupe.total * 1000:.1f}ms en total ({per_check * 1e6:.2f}µs por producto)")
+    print(f"Persistencia: {persistence.calls} llamadas / {persistence.items} productos, {persistence.total * 1000:.1f}ms en total, "
+          f"p99 {fmt_ms(percentile(persistence.durations, 99))}; flush final {flush_elapsed * 1000:.1f}ms")
+    print(f"Notificaciones: {telegram.messages} mensajes, {len(telegram.latencies)} productos, "
+          f"latencia p50 {fmt_ms(percentile(telegram.latencies, 50))}, p99 {fmt_ms(percentile(telegram.latencies, 99))}; "
+          f"{pending_notifications} pendientes al cortar")
+    samples = [sample for sample in rss_samples if sample is not None]
+    if samples:
+        print(f"RSS: {rss_before // 1024} MiB al arrancar, {samples[-1] // 1024} MiB al final, "
+              f"pico {(peak_rss_kib() or max(samples)) // 1024} MiB")
+    print(f"Datos temporales en {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Servidor GraphQL local que imita al de Marketplace, para probar y medir el bot sin pegarle a facebook.com.
+
+Cada búsqueda tiene su propio feed: arranca con unas páginas de publicaciones viejas y después aparecen
+publicaciones nuevas a razón de --new-per-minute. Las páginas respetan count/cursor como la API real.
+Los edges se arman a partir de respuestas grabadas (ver record_responses.py) o, sin archivos, de la
+respuesta sintética de bench_parse.py. Se puede agregar latencia, errores 500 y 429.
+
+Uso:
+    python benchmarks/fake_graphql.py --port 8765 --latency 0.3 --error-rate 0.01 --throttle-rate 0.005
+    MARKETPLACE_GRAPHQL_URL=http://127.0.0.1:8765/api/graphql/ python bot.py
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from marketplace_api import PAGE_SIZE
+from bench_parse import synthetic_response
+
+GRAPHQL_PATH = "/api/graphql/"
+# Los IDs de cada búsqueda viven en su propio bloque: base + índice de la publicación
+ID_BLOCK = 10 ** 9
+ID_PLACEHOLDER = "99999999999999999"
+TITLE_PLACEHOLDER = "__TITULO__"
+
+
+def load_edge_templates(paths, padding=2000):
+    """Edges con publicación de las respuestas grabadas (o sintéticos), serializados con marcadores para id y título."""
+    edges = []
+    for path in paths:
+        with open(path, "rb") as f:
+            data = json.load(f)
+        feed_units = (data.get("data") or {}).get("marketplace_search", {}).get("feed_units", {})
+        edges.extend(edge for edge in feed_units.get("edges", []) if (edge.get("node") or {}).get("listing"))
+    if not edges:
+        edges = synthetic_response(PAGE_SIZE, padding)["data"]["marketplace_search"]["feed_units"]["edges"]
+
+    templates = []
+    for edge in edges:
+        listing = edge["node"]["listing"]
+        listing["id"] = ID_PLACEHOLDER
+        listing["marketplace_listing_title"] = TITLE_PLACEHOLDER
+        # Una foto propia por publicación: con la misma foto y precio serían republicaciones (duplicates.py)
+        image = (listing.get("primary_listing_photo") or {}).get("image")
+        if image:
+            image["uri"] = f"https://scontent.example/v/{ID_PLACEHOLDER}_n.jpg"
+        templates.append(json.dumps(edge, ensure_ascii=False))
+    return templates
+
+
+class ListingFeed:
+    """Publicaciones de una búsqueda: el índice i aparece en start + i / rate (los índices negativos ya existían)."""
+
+    def __init__(self, query, base_id, new_per_minute, backlog, start):
+        self.query = query
+        self.base_id = base_id
+        self.interval = 60 / new_per_minute if new_per_minute > 0 else None
+        self.backlog = backlog
+        self.start = start
+
+    def newest_index(self, now):
+        if self.interval is None:
+            return -1
+        return int((now - self.start) / self.interval)
+
+    def listing_id(self, index):
+        return self.base_id + self.backlog + index
+
+    def created_at(self, listing_id):
+        index = listing_id - self.base_id - self.backlog
+        if index < 0 or self.interval is None:
+            return None
+        return self.start + index * self.interval
+
+
+class FakeGraphQLServer:
+    """
+    Servidor aiohttp en un hilo propio. created_at(listing_id) devuelve en qué momento (time.monotonic)
+    apareció una publicación, para medir la latencia hasta la notificación.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, latency_jitter=0.5, error_rate=0.0,
+                 throttle_rate=0.0, new_per_minute=2.0, backlog_pages=3, fixtures=(), padding=2000, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.new_per_minute = new_per_minute
+        self.backlog = backlog_pages * PAGE_SIZE
+        self.templates = load_edge_templates(fixtures, padding)
+        self._random = random.Random(seed)
+        # _feeds: { query: ListingFeed } y _feeds_by_base: { base_id: ListingFeed }
+        self._feeds = {}
+        self._feeds_by_base = {}
+        self._stats = {"requests": 0, "edges": 0, "bytes": 0, "status": {}}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}{GRAPHQL_PATH}"
+
+    def start(self):
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(started,), name="fake-graphql", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "status": dict(self._stats["status"]), "queries": len(self._feeds)}
+
+    def created_at(self, listing_id):
+        try:
+            listing_id = int(listing_id)
+        except (TypeError, ValueError):
+            return None
+        with self._lock:
+            feed = self._feeds_by_base.get(listing_id // ID_BLOCK * ID_BLOCK)
+        return feed.created_at(listing_id) if feed is not None else None
+
+    def _run(self, started):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        app = web.Application()
+        app.router.add_post(GRAPHQL_PATH, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, self.host, self.port)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        started.set()
+        self._loop.run_forever()
+
+    def _feed(self, query):
+        with self._lock:
+            feed = self._feeds.get(query)
+            if feed is None:
+                base_id = (zlib.crc32(query.encode()) % (10 ** 7) + 1) * ID_BLOCK
+                while base_id in self._feeds_by_base:
+                    base_id += ID_BLOCK
+                feed = ListingFeed(query, base_id, self.new_per_minute, self.backlog, time.monotonic())
+                self._feeds[query] = feed
+                self._feeds_by_base[base_id] = feed
+            return feed
+
+    def _count(self, status, edges=0, size=0):
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["edges"] += edges
+            self._stats["bytes"] += size
+            self._stats["status"][status] = self._stats["status"].get(status, 0) + 1
+
+    async def _handle(self, request):
+        form = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency * self._random.uniform(1 - self.latency_jitter, 1 + self.latency_jitter))
+
+        roll = self._random.random()
+        if roll < self.throttle_rate:
+            self._count(429)
+            return web.json_response({"error": 1675004, "errorSummary": "Rate limit exceeded"}, status=429)
+        if roll < self.throttle_rate + self.error_rate:
+            self._count(500)
+            return web.Response(status=500, text="Internal Server Error")
+
+        try:
+            variables = json.loads(form["variables"])
+            query = variables["params"]["bqf"]["query"].strip().lower()
+            count = int(variables.get("count") or PAGE_SIZE)
+        except (KeyError, TypeError, ValueError):
+            self._count(400)
+            return web.Response(status=400, text="Bad Request")
+
+        body, edges = self._page(self._feed(query), count, variables.get("cursor"))
+        self._count(200, edges, len(body))
+        return web.Response(body=body, content_type="application/json")
+
+    def _page(self, feed, count, cursor):
+        # El cursor fija la publicación más nueva de la primera página para que las siguientes no se corran
+        if cursor:
+            state = json.loads(base64.b64decode(cursor))
+            top, offset = state["top"], state["offset"]
+        else:
+            top, offset = feed.newest_index(time.monotonic()), 0
+        first = top - offset
+        last = max(-feed.backlog, first - count + 1)
+        edges = []
+        for index in range(first, last - 1, -1):
+            template = self.templates[index % len(self.templates)]
+            edges.append(template.replace(ID_PLACEHOLDER, str(feed.listing_id(index)))
+                                 .replace(TITLE_PLACEHOLDER, f"{feed.query} {feed.listing_id(index)}"))
+        has_next_page = last > -feed.backlog
+        page_info = {"end_cursor": base64.b64encode(json.dumps({"top": top, "offset": offset + len(edges)}).encode()).decode()
+                     if has_next_page else None,
+                     "has_next_page": has_next_page}
+        body = ('{"data":{"marketplace_search":{"feed_units":{"edges":[' + ",".join(edges) +
+                '],"page_info":' + json.dumps(page_info) + '}}},"extensions":{"is_final":true}}')
+        return body.encode(), len(edges)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fixtures", nargs="*", help="respuestas grabadas a usar como molde de los edges")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="segundos de demora por respuesta")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fracción de respuestas 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fracción de respuestas 429")
+    parser.add_argument("--new-per-minute", type=float, default=2.0, help="publicaciones nuevas por minuto en cada búsqueda")
+    args = parser.parse_args()
+
+    server = FakeGraphQLServer(args.host, args.port, latency=args.latency, error_rate=args.error_rate,
+                               throttle_rate=args.throttle_rate, new_per_minute=args.new_per_minute,
+                               fixtures=args.fixtures).start()
+    print(f"Servidor GraphQL de prueba en {server.url} (Ctrl+C para salir)")
+    try:
+        while True:
+            time.sleep(10)
+            print(server.stats())
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+"""
+Servidor local que imita a la Bot API de Telegram, para probar y medir los handlers sin pegarle a api.telegram.org.
+
+Responde los métodos que usa el bot (sendMessage, editMessageText, sendPhoto, sendMediaGroup,
+answerCallbackQuery, getUpdates, ...) con objetos válidos para telebot, registra cada llamada y
+simula los límites de Telegram: más de --chat-per-second mensajes por chat o --global-per-second en
+total devuelven 429 con retry_after. Los updates se inyectan con push_update() (o desde bench_handlers.py)
+y se entregan por getUpdates con long polling o, si el bot registró un webhook con setWebhook, con un POST
+a esa URL (como máximo max_connections a la vez, igual que Telegram).
+
+Uso:
+    python benchmarks/fake_telegram.py --port 8081
+    TELEGRAM_API_URL=http://127.0.0.1:8081/bot{0}/{1} python bot.py
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import random
+import threading
+import time
+
+import aiohttp
+from aiohttp import web
+
+# Métodos que cuentan para los límites de envío de Telegram
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendMediaGroup", "sendDocument", "editMessageText",
+                "editMessageReplyMarkup", "editMessageCaption", "copyMessage", "forwardMessage"}
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "Marketplace Bot", "username": "marketplace_bench_bot"}
+
+
+def user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"Usuario {user_id}", "language_code": "es"}
+
+
+def private_chat(chat_id):
+    return {"id": chat_id, "type": "private", "first_name": f"Usuario {chat_id}"}
+
+
+class _Window:
+    """Ventana deslizante de un segundo: cuántos envíos hubo y cuándo se libera el próximo lugar."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.times = []
+
+    def retry_after(self, now):
+        self.times = [t for t in self.times if now - t < 1.0]
+        if self.limit and len(self.times) >= self.limit:
+            return max(1, math.ceil(1.0 - (now - self.times[0])))
+        return 0
+
+
+class FakeTelegramServer:
+    """
+    Servidor aiohttp en un hilo propio. calls guarda cada llamada como
+    {"time", "method", "chat_id", "status", "update_id"} (time = time.monotonic()).
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, chat_per_second=3, global_per_second=30,
+                 throttle_rate=0.0, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.chat_per_second = chat_per_second
+        self.global_per_second = global_per_second
+        self.throttle_rate = throttle_rate
+        self._random = random.Random(seed)
+        self.calls = []
+        # pushed_at / delivered_at: { update_id: time.monotonic() } - cuándo se inyectó y cuándo lo levantó getUpdates
+        self.pushed_at = {}
+        self.delivered_at = {}
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+        # _callback_chats: { callback_query_id: (chat_id, update_id) } - answerCallbackQuery no trae chat_id
+        self._callback_chats = {}
+        # _last_update: { chat_id: update_id } - a qué update se atribuyen las llamadas a ese chat
+        self._last_update = {}
+        self._chat_windows = {}
+        self._global_window = _Window(global_per_second)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self._new_updates = None
+        # _webhook: (url, secret_token, asyncio.Semaphore) mientras haya un webhook registrado
+        self._webhook = None
+        self._client = None
+
+    @property
+    def api_url(self):
+        """Valor para telebot.apihelper.API_URL / TELEGRAM_API_URL."""
+        return f"http://{self.host}:{self.port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(started,), name="fake-telegram", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    async def _close(self):
+        if self._client is not None:
+            await self._client.close()
+        await self._runner.cleanup()
+
+    def _run(self, started):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._new_updates = asyncio.Condition()
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, self.host, self.port)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        started.set()
+        self._loop.run_forever()
+
+    # --- Updates ---
+
+    def message_update(self, user_id, text):
+        """Update de un mensaje de texto (o comando) del usuario en su chat privado."""
+        message = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": private_chat(user_id),
+                   "from": user(user_id), "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": message}
+
+    def callback_update(self, user_id, data, message_id=None):
+        """Update de un botón inline tocado sobre un mensaje del bot."""
+        message = {"message_id": message_id or next(self._message_ids), "date": int(time.time()),
+                   "chat": private_chat(user_id), "from": BOT_USER, "text": "Menú"}
+        return {"callback_query": {"id": f"cb{next(self._message_ids)}", "from": user(user_id), "chat_instance": str(user_id),
+                                   "message": message, "data": data}}
+
+    def push_update(self, update):
+        """Encola un update (de message_update/callback_update) para el próximo getUpdates. Devuelve su update_id."""
+        with self._lock:
+            update_id = next(self._update_ids)
+            update = dict(update, update_id=update_id)
+            self.pushed_at[update_id] = time.monotonic()
+            callback = update.get("callback_query")
+            if callback:
+                self._callback_chats[callback["id"]] = (callback["message"]["chat"]["id"], update_id)
+                self._last_update[callback["message"]["chat"]["id"]] = update_id
+            else:
+                self._last_update[update["message"]["chat"]["id"]] = update_id
+            self._updates.append(update)
+            webhook = self._webhook
+        if webhook is not None:
+            asyncio.run_coroutine_threadsafe(self._post_webhook(update, *webhook), self._loop)
+        else:
+            asyncio.run_coroutine_threadsafe(self._notify_updates(), self._loop)
+        return update_id
+
+    async def _post_webhook(self, update, url, secret_token, connections):
+        if self._client is None:
+            self._client = aiohttp.ClientSession()
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret_token} if secret_token else {}
+        async with connections:
+            try:
+                async with self._client.post(url, json=update, headers=headers) as response:
+                    delivered = response.status == 200
+            except aiohttp.ClientError:
+                delivered = False
+        with self._lock:
+            if delivered and update in self._updates:
+                self.delivered_at.setdefault(update["update_id"], time.monotonic())
+                self._updates.remove(update)
+
+    async def _notify_updates(self):
+        async with self._new_updates:
+            self._new_updates.notify_all()
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                # offset confirma (y descarta) todo lo anterior
+                self._updates = [update for update in self._updates if update["update_id"] >= offset]
+                batch = self._updates[:limit]
+                now = time.monotonic()
+                for update in batch:
+                    self.delivered_at.setdefault(update["update_id"], now)
+            remaining = deadline - time.monotonic()
+            if batch or remaining <= 0:
+                return batch
+            async with self._new_updates:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    # --- Métodos de la API ---
+
+    def _record(self, method, chat_id, status, update_id=None):
+        with self._lock:
+            if update_id is None and chat_id is not None:
+                update_id = self._last_update.get(chat_id)
+            self.calls.append({"time": time.monotonic(), "method": method, "chat_id": chat_id,
+                               "status": status, "update_id": update_id})
+
+    def _throttle(self, chat_id):
+        """Segundos de retry_after si el envío supera los límites, 0 si puede salir."""
+        now = time.monotonic()
+        with self._lock:
+            if self._random.random() < self.throttle_rate:
+                return self._random.randint(1, 5)
+            window = self._chat_windows.get(chat_id)
+            if window is None:
+                window = self._chat_windows[chat_id] = _Window(self.chat_per_second)
+            retry_after = max(window.retry_after(now), self._global_window.retry_after(now))
+            if not retry_after:
+                window.times.append(now)
+                self._global_window.times.append(now)
+            return retry_after
+
+    def _message(self, chat_id, params, **fields):
+        message = {"message_id": int(params.get("message_id") or next(self._message_ids)), "date": int(time.time()),
+                   "chat": private_chat(chat_id), "from": BOT_USER}
+        if params.get("text") is not None:
+            message["text"] = params["text"]
+        if params.get("caption") is not None:
+            message["caption"] = params["caption"]
+        message.update(fields)
+        return message
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        params = dict(request.query)
+        if request.can_read_body:
+            form = await request.post()
+            params.update({key: value for key, value in form.items() if isinstance(value, str)})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "setWebhook":
+            with self._lock:
+                self._webhook = (params["url"], params.get("secret_token"),
+                                 asyncio.Semaphore(int(params.get("max_connections") or 40)))
+            return web.json_response({"ok": True, "result": True, "description": "Webhook was set"})
+        if method == "deleteWebhook":
+            with self._lock:
+                self._webhook = None
+            return web.json_response({"ok": True, "result": True, "description": "Webhook was deleted"})
+        if method == "getUpdates":
+            if self._webhook is not None:
+                return web.json_response({"ok": False, "error_code": 409,
+                                          "description": "Conflict: can't use getUpdates method while webhook is active"},
+                                         status=409)
+            result = await self._get_updates(params)
+            return web.json_response({"ok": True, "result": result})
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": BOT_USER})
+
+        update_id = None
+        if method == "answerCallbackQuery":
+            chat_id, update_id = self._callback_chats.get(params.get("callback_query_id"), (None, None))
+        else:
+            try:
+                chat_id = int(params["chat_id"])
+            except (KeyError, ValueError):
+                chat_id = None
+
+        if method in SEND_METHODS and chat_id is not None:
+            retry_after = self._throttle(chat_id)
+            if retry_after:
+                self._record(method, chat_id, 429, update_id)
+                return web.json_response({"ok": False, "error_code": 429,
+                                          "description": f"Too Many Requests: retry after {retry_after}",
+                                          "parameters": {"retry_after": retry_after}}, status=429)
+        self._record(method, chat_id, 200, update_id)
+
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media") or "[]")
+            result = [self._message(chat_id, {}, photo=[{"file_id": f"f{i}", "file_unique_id": f"u{i}", "width": 1, "height": 1}],
+                                    caption=item.get("caption")) for i, item in enumerate(media)]
+        elif method in SEND_METHODS:
+            result = self._message(chat_id, params)
+        else:
+            # answerCallbackQuery, deleteMessage, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    # --- Resultados ---
+
+    def stats(self):
+        with self._lock:
+            calls = list(self.calls)
+        methods = {}
+        for call in calls:
+            counts = methods.setdefault(call["method"], {})
+            counts[call["status"]] = counts.get(call["status"], 0) + 1
+        return {"calls": len(calls), "methods": methods, "pending_updates": len(self._updates)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="segundos de demora por llamada")
+    parser.add_argument("--chat-per-second", type=int, default=3, help="envíos por segundo a un mismo chat (Telegram tolera ráfagas cortas)")
+    parser.add_argument("--global-per-second", type=int, default=30)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fracción de envíos que reciben 429 igual")
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(args.host, args.port, latency=args.latency, chat_per_second=args.chat_per_second,
+                                global_per_second=args.global_per_second, throttle_rate=args.throttle_rate).start()
+    print(f"Bot API de prueba en {server.api_url} (Ctrl+C para salir)")
+    try:
+        while True:
+            time.sleep(10)
+            print(server.stats())
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
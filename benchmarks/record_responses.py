@@ -0,0 +1,66 @@
+"""
+Graba respuestas reales de GraphQL de Marketplace para usarlas como fixtures de los benchmarks
+(bench_parse.py y fake_graphql.py). Usa FACEBOOK_COOKIE del .env y guarda el cuerpo tal cual llega.
+
+Uso:
+    python benchmarks/record_responses.py "bicicleta" "iphone 13" --pages 2 --out benchmarks/fixtures
+
+Las respuestas incluyen datos de publicaciones reales: no subirlas al repositorio.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+from marketplace_api import (build_graphql_request, get_http_session, parse_page_info, GRAPHQL_URL,
+                             DEFAULT_REQUEST_TIMEOUT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("search_terms", nargs="+")
+    parser.add_argument("--pages", type=int, default=1, help="páginas por búsqueda")
+    parser.add_argument("--out", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures"))
+    parser.add_argument("--delay", type=float, default=5, help="segundos entre peticiones")
+    parser.add_argument("--latitude", type=float, default=-32.95)
+    parser.add_argument("--longitude", type=float, default=-60.64)
+    parser.add_argument("--radius", type=int, default=65)
+    args = parser.parse_args()
+
+    load_dotenv()
+    cookie = os.getenv("FACEBOOK_COOKIE")
+    if not cookie:
+        sys.exit("Falta FACEBOOK_COOKIE en el entorno o en .env")
+    os.makedirs(args.out, exist_ok=True)
+    region = {"latitude": args.latitude, "longitude": args.longitude, "radius": args.radius}
+
+    for search_term in args.search_terms:
+        cursor = None
+        slug = re.sub(r"[^a-z0-9]+", "_", search_term.lower()).strip("_")
+        for page in range(1, args.pages + 1):
+            headers, payload = build_graphql_request(search_term, cookie, region, cursor=cursor)
+            response = get_http_session().post(GRAPHQL_URL, headers=headers, data=payload, timeout=DEFAULT_REQUEST_TIMEOUT)
+            if response.status_code != 200:
+                print(f"'{search_term}' página {page}: HTTP {response.status_code}, se corta.")
+                break
+            path = os.path.join(args.out, f"{slug}_{page}.json")
+            with open(path, "wb") as f:
+                f.write(response.content)
+            print(f"'{search_term}' página {page}: {len(response.content) / 1024:.0f} KiB -> {path}")
+            try:
+                cursor = parse_page_info(json.loads(response.content))
+            except json.JSONDecodeError:
+                cursor = None
+            if not cursor:
+                break
+            time.sleep(args.delay)
+
+
+if __name__ == "__main__":
+    main()
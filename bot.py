@@ -1,29 +1,64 @@
 import time
 import telebot
-import threading
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
 from dotenv import load_dotenv
 import os
 from telebot import types
 import logging
 import html as html_lib
 import random
+import re
 from unidecode import unidecode
 
 # Archivos propios
-from persistence import monitor_from_history, save_data, load_user_searches, load_product_history
+from persistence import monitor_from_history, JsonStorage
+from db import SQLiteStorage
 from html_response import generate_html
-from marketplace_api import fetch_products_graphql
+from marketplace_api import (fetch_products_graphql, fetch_products_graphql_async, configure_http_pool, close_async_session,
+                             configure_rate_limit, get_rate_limit_state, configure_graphql_url, get_http_session)
+from scheduler import QueryScheduler
+from async_scheduler import AsyncQueryScheduler
+from alert_history import AlertHistory
+from polling import AdaptiveInterval
+from session_pool import load_session_pool
+from rate_limit import BREAKER_STATUS_CODES
+from notifier import Notifier, DigestBuffer, PRIORITY_ALERT, PRIORITY_HISTORY, format_listing_event_header
+from webhook import UpdateDispatcher, run_webhook
+from manual_search import ManualSearchPool
+from filters import get_alert_filter, parse_filter_text
+from listing_state import ListingTracker, PollResult
+from duplicates import DuplicateDetector, ImageHasher
+from geo import make_region, within_region
+from geocoding import Geocoder, BUNDLED_LOCALITIES_FILE
+from geopy.exc import GeopyError
+from scheduler import region_key
+from product import DEFAULT_CITY
 
 USER_SEARCHES_FILE = 'user_searches.json'
 PRODUCT_HISTORY_FILE = 'product_history.json'
-
-user_searches_lock = threading.Lock()
-product_history_lock = threading.Lock()
+PRODUCT_HISTORY_LOG_FILE = 'product_history.log'
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 FACEBOOK_COOKIE = os.getenv("FACEBOOK_COOKIE")
+# API de Telegram alternativa (formato de telebot: ".../bot{0}/{1}"), ej. el servidor de prueba de benchmarks/fake_telegram.py
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+# Cómo recibir los updates: "polling" (infinity_polling) o "webhook" (servidor HTTP propio + pool de handlers)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# URL pública del webhook (el HTTPS lo termina un proxy delante) y dónde escucha el servidor local
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+# Hilos que atienden updates en modo webhook (los de un mismo usuario van siempre de a uno y en orden)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+# Archivo JSON con varias cuentas de Facebook (cookie + campos del payload); si no existe se usa sólo FACEBOOK_COOKIE
+FACEBOOK_SESSIONS_FILE = os.getenv("FACEBOOK_SESSIONS_FILE", "facebook_sessions.json")
+# Cómo repartir las búsquedas entre cuentas: "least_loaded" o "round_robin"
+SESSION_STRATEGY = os.getenv("SESSION_STRATEGY", "least_loaded").lower()
+# Cuarentena inicial (segundos) de una cuenta tras un 401/403 o un 429; se duplica si se repite
+SESSION_AUTH_QUARANTINE_SECONDS = int(os.getenv("SESSION_AUTH_QUARANTINE_SECONDS", "3600"))
+SESSION_THROTTLE_QUARANTINE_SECONDS = int(os.getenv("SESSION_THROTTLE_QUARANTINE_SECONDS", "120"))
 
 # Configuración de Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -35,8 +70,18 @@ if not BOT_TOKEN:
     logger.critical("Error: No se encontró BOT_TOKEN en las variables de entorno.")
     exit() 
 
-if not FACEBOOK_COOKIE:
-    logger.warning("Advertencia: No se encontró FACEBOOK_COOKIE en las variables de entorno. Las búsquedas de Marketplace podrían fallar.")
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    logger.critical("Error: BOT_MODE=webhook requiere WEBHOOK_URL.")
+    exit()
+
+# session_pool: cuentas de Facebook con las que se hacen las búsquedas (se pasa en lugar de la cookie)
+session_pool = load_session_pool(FACEBOOK_SESSIONS_FILE, fallback_cookie=FACEBOOK_COOKIE,
+                                 strategy=SESSION_STRATEGY,
+                                 auth_quarantine=SESSION_AUTH_QUARANTINE_SECONDS,
+                                 throttle_quarantine=SESSION_THROTTLE_QUARANTINE_SECONDS)
+
+if not session_pool:
+    logger.warning("Advertencia: No se encontró FACEBOOK_COOKIE en las variables de entorno ni sesiones en FACEBOOK_SESSIONS_FILE. Las búsquedas de Marketplace podrían fallar.")
     exit()
 
 
@@ -44,30 +89,133 @@ if not FACEBOOK_COOKIE:
 REFRESH_INTERVAL_SECONDS_MIN = 185
 REFRESH_INTERVAL_SECONDS_MAX = 353
 MAX_PRODUCT_HISTORY = 30
-
-def rand_refresh_interval():
+# Backend de almacenamiento: "sqlite" (un hilo writer con cola) o "json" (archivos, backend original)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+DB_FILE = os.getenv("DB_FILE", "marketplace_bot.db")
+# Ventana (segundos) en la que se agrupan las escrituras de user_searches.json con el backend json
+SAVE_DEBOUNCE_SECONDS = float(os.getenv("SAVE_DEBOUNCE_SECONDS", "2"))
+# Cantidad de workers del pool de monitoreo (ciclos de búsqueda simultáneos)
+MONITOR_WORKERS = int(os.getenv("MONITOR_WORKERS", "8"))
+# Motor de monitoreo: "threads" (heap + pool de hilos) o "asyncio" (corrutinas + cliente HTTP asíncrono)
+MONITOR_ENGINE = os.getenv("MONITOR_ENGINE", "threads").lower()
+# Peticiones simultáneas a Marketplace con el motor asyncio
+MONITOR_CONCURRENCY = int(os.getenv("MONITOR_CONCURRENCY", "20"))
+# Páginas máximas por ciclo de monitoreo (se deja de paginar al llegar a una publicación ya vista)
+MONITOR_MAX_PAGES = int(os.getenv("MONITOR_MAX_PAGES", "3"))
+# Páginas que recorre "Buscar Ahora" (24 publicaciones por página)
+SEARCH_NOW_MAX_PAGES = int(os.getenv("SEARCH_NOW_MAX_PAGES", "3"))
+# Hilos para las búsquedas de "Buscar Ahora" (corren fuera de los handlers; las iguales en curso se comparten)
+SEARCH_NOW_WORKERS = int(os.getenv("SEARCH_NOW_WORKERS", "4"))
+
+# Intervalo de refresco: "adaptive" (según cuántas publicaciones nuevas trae cada búsqueda) o "random" (rango fijo)
+MONITOR_INTERVAL_MODE = os.getenv("MONITOR_INTERVAL_MODE", "adaptive").lower()
+# Límites del intervalo adaptativo y presupuesto global de peticiones de monitoreo por hora (0 = sin límite)
+MONITOR_INTERVAL_MIN_SECONDS = int(os.getenv("MONITOR_INTERVAL_MIN_SECONDS", "90"))
+MONITOR_INTERVAL_MAX_SECONDS = int(os.getenv("MONITOR_INTERVAL_MAX_SECONDS", "1800"))
+MONITOR_REQUESTS_PER_HOUR = int(os.getenv("MONITOR_REQUESTS_PER_HOUR", "1200"))
+# Tope de peticiones a Marketplace por minuto y por cookie (monitoreo + búsquedas manuales) y ráfaga permitida
+MARKETPLACE_REQUESTS_PER_MINUTE = float(os.getenv("MARKETPLACE_REQUESTS_PER_MINUTE", "30"))
+MARKETPLACE_BURST = int(os.getenv("MARKETPLACE_BURST", "5"))
+# Pausa inicial y máxima (segundos) de todas las peticiones tras un 401/403/429; se duplica en cada disparo seguido
+THROTTLE_PAUSE_SECONDS = int(os.getenv("THROTTLE_PAUSE_SECONDS", "60"))
+THROTTLE_MAX_PAUSE_SECONDS = int(os.getenv("THROTTLE_MAX_PAUSE_SECONDS", "1800"))
+# Endpoint de GraphQL (vacío = facebook.com); para pruebas y benchmarks contra benchmarks/fake_graphql.py
+MARKETPLACE_GRAPHQL_URL = os.getenv("MARKETPLACE_GRAPHQL_URL", "")
+
+def rand_refresh_interval(group=None):
     return random.randint(REFRESH_INTERVAL_SECONDS_MIN, REFRESH_INTERVAL_SECONDS_MAX)
 
-
-# Coordenadas por defecto (Rosario)
+if MONITOR_INTERVAL_MODE == "adaptive":
+    refresh_interval_fn = AdaptiveInterval(MONITOR_INTERVAL_MIN_SECONDS, MONITOR_INTERVAL_MAX_SECONDS,
+                                           requests_per_hour=MONITOR_REQUESTS_PER_HOUR or None,
+                                           cold_start_range=(REFRESH_INTERVAL_SECONDS_MIN, REFRESH_INTERVAL_SECONDS_MAX))
+else:
+    refresh_interval_fn = rand_refresh_interval
+
+
+# Límites de envío de Telegram (global y por chat) y desde cuántos productos pendientes se agrupan en un álbum/lista
+TELEGRAM_MESSAGES_PER_SECOND = float(os.getenv("TELEGRAM_MESSAGES_PER_SECOND", "25"))
+TELEGRAM_CHAT_MESSAGES_PER_SECOND = float(os.getenv("TELEGRAM_CHAT_MESSAGES_PER_SECOND", "1"))
+NOTIFY_BATCH_THRESHOLD = int(os.getenv("NOTIFY_BATCH_THRESHOLD", "3"))
+# Ventanas (minutos) que se ofrecen para el modo resumen de una alerta
+DIGEST_WINDOW_OPTIONS = (15, 30, 60)
+# Publicaciones ya conocidas: se avisa si bajan al menos este porcentaje o si reaparecen tras estas horas sin verse
+PRICE_DROP_MIN_PERCENT = float(os.getenv("PRICE_DROP_MIN_PERCENT", "5"))
+RELIST_AFTER_HOURS = float(os.getenv("RELIST_AFTER_HOURS", "24"))
+# Días que se recuerda el precio de una publicación que ya no aparece en ninguna búsqueda
+LISTING_STATE_DAYS = int(os.getenv("LISTING_STATE_DAYS", "30"))
+# Republicaciones: no se avisa de una publicación que repite (título, foto y precio) otra que la alerta ya vio
+# en las últimas horas (0 = avisar todo). Con DUPLICATE_IMAGE_HASH=1 (requiere Pillow) también se comparan
+# las fotos por contenido, descargando cada una una vez
+DUPLICATE_WINDOW_HOURS = float(os.getenv("DUPLICATE_WINDOW_HOURS", "72"))
+DUPLICATE_PRICE_TOLERANCE_PERCENT = float(os.getenv("DUPLICATE_PRICE_TOLERANCE_PERCENT", "5"))
+DUPLICATE_IMAGE_HASH = os.getenv("DUPLICATE_IMAGE_HASH", "0").lower() in ("1", "true")
+
+# Coordenadas por defecto (Rosario): la zona de las alertas que no eligieron otra
 DEFAULT_LATITUDE = -32.95
 DEFAULT_LONGITUDE = -60.64
 DEFAULT_RADIUS_KM = 65
+DEFAULT_REGION_NAME = "Rosario"
+MAX_RADIUS_KM = 500
+# Alertas de la misma búsqueda con zonas superpuestas comparten un fetch sobre un círculo de hasta este radio (0 = no)
+REGION_MERGE_MAX_RADIUS_KM = float(os.getenv("REGION_MERGE_MAX_RADIUS_KM", "100"))
+# Geocodificación de las zonas y de las ciudades de las publicaciones: caché SQLite precargada con un dataset
+# de localidades (vacío = el incluido en data/) y Nominatim para lo que falte, salvo con GEOCODE_OFFLINE=1
+GEOCODE_CACHE_FILE = os.getenv("GEOCODE_CACHE_FILE", "geocode_cache.db")
+GEOCODE_COUNTRY = os.getenv("GEOCODE_COUNTRY", "Argentina")
+GEOCODE_LOCALITIES_FILE = os.getenv("GEOCODE_LOCALITIES_FILE", "") or BUNDLED_LOCALITIES_FILE
+GEOCODE_OFFLINE = os.getenv("GEOCODE_OFFLINE", "0").lower() in ("1", "true")
 
 # Inicialización del bot
-bot = telebot.TeleBot(BOT_TOKEN)
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
+# En modo webhook los handlers corren en los hilos del UpdateDispatcher, no en el pool de telebot
+bot = telebot.TeleBot(BOT_TOKEN, threaded=BOT_MODE != "webhook")
+# notifier: cola de salida hacia Telegram (límite global y por chat, reintentos de 429, agrupado de productos)
+notifier = Notifier(bot, global_per_second=TELEGRAM_MESSAGES_PER_SECOND, chat_per_second=TELEGRAM_CHAT_MESSAGES_PER_SECOND,
+                    batch_threshold=NOTIFY_BATCH_THRESHOLD)
+
+def deliver_digest(alert_key, chat_id, products):
+    user_id, search_term = alert_key
+    header = f"🗞️ Resumen de '{html_lib.escape(search_term)}': {len(products)} productos nuevos"
+    notifier.send_digest(chat_id, products, header)
+
+# digest_buffer: productos nuevos de las alertas en modo resumen, a la espera de que cierre su ventana
+digest_buffer = DigestBuffer(deliver_digest)
 
 # --- Estructuras de datos globales ---
 # user_searches: { user_id: { search_term: {'active': bool, 'chat_id': int}, ... } } - Guarda las alertas configuradas y su estado
 user_searches = defaultdict(dict)
-# product_history: { user_id: { search_term: deque([product_dict, ...], maxlen=MAX_PRODUCT_HISTORY) } } - Guarda el historial reciente de productos encontrados
-product_history = defaultdict(lambda: defaultdict(lambda: deque(maxlen=MAX_PRODUCT_HISTORY)))
-# active_monitoring_threads: { f"{user_id}_{search_term}": threading.Event() } - Para controlar la ejecución de los hilos de monitoreo
-active_monitoring_threads = {}
+# product_history: { user_id: { search_term: AlertHistory([product_dict, ...], maxlen=MAX_PRODUCT_HISTORY) } } - Guarda el historial reciente de productos encontrados
+# (AlertHistory es un deque con índice de IDs para saber en O(1) si un producto ya fue visto)
+product_history = defaultdict(lambda: defaultdict(lambda: AlertHistory(maxlen=MAX_PRODUCT_HISTORY)))
+# storage: persistencia de alertas e historial (SQLiteStorage o JsonStorage, misma interfaz)
+def create_json_storage():
+    return JsonStorage(USER_SEARCHES_FILE, PRODUCT_HISTORY_FILE, PRODUCT_HISTORY_LOG_FILE,
+                       lambda: user_searches, lambda: product_history, MAX_PRODUCT_HISTORY,
+                       save_delay=SAVE_DEBOUNCE_SECONDS)
+
+if STORAGE_BACKEND == "json":
+    storage = create_json_storage()
+else:
+    storage = SQLiteStorage(DB_FILE, MAX_PRODUCT_HISTORY)
+# listing_tracker: último precio y última vez vista de cada publicación (bajas de precio y republicaciones)
+listing_tracker = ListingTracker(storage.save_listings, storage.prune_listings, min_drop_percent=PRICE_DROP_MIN_PERCENT,
+                                 relist_after=RELIST_AFTER_HOURS * 3600, retention=LISTING_STATE_DAYS * 86400)
 # first_scrape_done: { f"{user_id}_{search_term}": bool } - Flag para la primera búsqueda (no notificar los productos iniciales)
 first_scrape_done = defaultdict(bool)
 # search_in_progress: { user_id: bool } - Flag para evitar que un usuario inicie múltiples búsquedas manuales a la vez
 search_in_progress = defaultdict(bool)
+# last_search_results: { (user_id, search_term): [product, ...] } - Resultado completo del último "Buscar Ahora" (puede superar al historial).
+# Sólo los LAST_SEARCH_RESULTS_MAX más recientes (LRU): el resto se sirve desde el historial
+last_search_results = OrderedDict()
+LAST_SEARCH_RESULTS_MAX = 200
+# waiting_for_filters: { user_id: search_term } - Alerta cuyos filtros está escribiendo el usuario
+waiting_for_filters = {}
+# waiting_for_region: { user_id: search_term } - Alerta cuya zona está eligiendo el usuario (texto o ubicación)
+waiting_for_region = {}
+# geocoder: nombre de lugar -> coordenadas (dataset de localidades + caché; cada nombre se consulta una sola vez)
+geocoder = Geocoder(GEOCODE_CACHE_FILE, country=GEOCODE_COUNTRY, offline=GEOCODE_OFFLINE)
 
 # --- Funciones Auxiliares ---
 
@@ -81,14 +229,19 @@ def create_inline_keyboard(options=None, back_button=True, back_callback="main_m
             types.InlineKeyboardButton("🔍 Nueva Alerta", callback_data="new_search"), # Cambiado a "Alerta"
             types.InlineKeyboardButton("📋 Mis Alertas", callback_data="list_alerts"),
             types.InlineKeyboardButton("🔔 Activar Notif.", callback_data="select_alert_activate"),
+            types.InlineKeyboardButton("🗞️ Modo Resumen", callback_data="select_alert_digest"),
             types.InlineKeyboardButton("🔕 Desactivar Notif.", callback_data="select_alert_deactivate"),
             types.InlineKeyboardButton("🔄 Buscar Ahora", callback_data="select_alert_search_now"),
-            types.InlineKeyboardButton("❌ Eliminar Alerta", callback_data="select_alert_delete")
+            types.InlineKeyboardButton("❌ Eliminar Alerta", callback_data="select_alert_delete"),
+            types.InlineKeyboardButton("🎚️ Filtros", callback_data="select_alert_filters"),
+            types.InlineKeyboardButton("📍 Zona", callback_data="select_alert_region")
         ]
         # Organiza en filas
         markup.add(buttons[0], buttons[1])
         markup.add(buttons[2], buttons[3])
         markup.add(buttons[4], buttons[5])
+        markup.add(buttons[6], buttons[7])
+        markup.add(buttons[8])
     else:
         button_list = [types.InlineKeyboardButton(text, callback_data=callback) for text, callback in options.items()]
         markup.add(*button_list)
@@ -101,154 +254,212 @@ def create_inline_keyboard(options=None, back_button=True, back_callback="main_m
 def is_valid_search_term(term):
     return (term and term.strip())
 
-def send_product_message(chat_id, product, reply_markup=None):
-    """Envía un mensaje de Telegram con la información de un producto."""
-    title = html_lib.escape(product.get('titulo', 'Sin título'))
-    price = html_lib.escape(product.get('precio', 'Sin precio'))
-    url = html_lib.escape(product.get('url', '#'))
-    city = html_lib.escape(product.get('ciudad', 'Ubicación desconocida'))
-    image_url = product.get('imagen_url')
-
-    message = (
-        f"🛍️ Nuevo Producto:\n\n"
-        f"<b>{title}</b>\n\n"
-        f"💰 <b>Precio:</b> {price}\n"
-        f"📍 <b>Ubicación:</b> {city}\n"
-        f"🔗 <a href='{url}'>Ver en Facebook Marketplace</a>"
-    )
-    
-    try:
-        # Intentar enviar con foto si hay URL de imagen
-        if image_url:
-            bot.send_photo(
-                chat_id,
-                photo=image_url,
-                caption=message,
-                parse_mode='HTML',
-                reply_markup=reply_markup
-            )
-        else:
-            # Enviar como mensaje de texto si no hay foto
-            bot.send_message(
-                chat_id,
-                message,
-                parse_mode='HTML',
-                disable_web_page_preview=True, # Desactivar preview si no hay foto adjunta
-                reply_markup=reply_markup
-            )
-    except Exception as e:
-        logger.error(f"Error enviando mensaje de producto al chat {chat_id}: {e}")
-        # Si falla send_photo o send_message, intentar enviar solo el enlace como fallback
-        try:
-             bot.send_message(
-                chat_id,
-                f"🛍️ Nuevo Producto: <a href='{url}'>{title} - {price}</a>",
-                parse_mode='HTML',
-                disable_web_page_preview=False
-            )
-        except Exception as e_fallback:
-             logger.error(f"Error en fallback enviando enlace de producto al chat {chat_id}: {e_fallback}")
+def send_product_message(chat_id, product, reply_markup=None, priority=PRIORITY_ALERT, header=None):
+    """Encola la notificación de un producto (la envía el hilo del notifier respetando los límites de Telegram)."""
+    notifier.send_product(chat_id, product, priority=priority, reply_markup=reply_markup, header=header)
+
+def get_alert_region(user_id, search_term):
+    """Región de búsqueda de una alerta: la que eligió con "Zona" o la de por defecto."""
+    alert_details = user_searches.get(user_id, {}).get(search_term)
+    region = alert_details.get('region') if isinstance(alert_details, dict) else None
+    return region or make_region(DEFAULT_LATITUDE, DEFAULT_LONGITUDE, DEFAULT_RADIUS_KM, DEFAULT_REGION_NAME)
 
-def monitor_search(user_id, chat_id, search_term, stop_event: threading.Event):
+def filter_by_region(products, region):
     """
-    Hilo de monitoreo para una búsqueda específica.
-    Usa fetch_products_graphql y notifica nuevos productos.
+    Deja los productos cuya ciudad cae dentro de la región. Se usa cuando el grupo pidió un círculo más
+    grande que el de la alerta, así que lo de ubicación desconocida queda afuera: podría ser de cualquier
+    punto del círculo grande. Lo que todavía se está geocodificando (en segundo plano) no entra al historial,
+    así que se vuelve a evaluar en el próximo ciclo, ya con su ubicación.
     """
-    key = f"{user_id}_{search_term}"
-    logger.info(f"Hilo de monitoreo iniciado para '{search_term}' (Usuario: {user_id})")
-
-    # Obtener la cookie del archivo .env
-    user_cookie = FACEBOOK_COOKIE
-
-    if not user_cookie:
+    kept = []
+    for product in products:
+        city = product.get('ciudad')
+        position = geocoder.locate(city) if city and city != DEFAULT_CITY else None
+        if position is not None and within_region(position[0], position[1], region):
+            kept.append(product)
+    return kept
+
+def track_listings(products, region):
+    """
+    Compara los resultados de un fetch de grupo con el estado de cada publicación (una vez por fetch,
+    no por alerta) y los devuelve con los eventos detectados y la región pedida para que monitor_search
+    los reparta.
+    """
+    if products is None:
+        return None
+    return PollResult(products, listing_tracker.observe(products), region)
+
+def fetch_for_scheduler(search_term, region, seen_ids, price_bounds=None):
+    # Primer ciclo (línea base, no notifica): una sola página alcanza
+    max_pages = MONITOR_MAX_PAGES if seen_ids else 1
+    return track_listings(fetch_products_graphql(search_term, session_pool, region, logger, max_pages=max_pages,
+                                                 seen_ids=seen_ids, price_bounds=price_bounds), region)
+
+async def fetch_for_async_scheduler(search_term, region, seen_ids, price_bounds=None):
+    max_pages = MONITOR_MAX_PAGES if seen_ids else 1
+    return track_listings(await fetch_products_graphql_async(search_term, session_pool, region, logger, max_pages=max_pages,
+                                                             seen_ids=seen_ids, price_bounds=price_bounds), region)
+
+def fetch_for_search_now(search_term, region, price_bounds):
+    return fetch_products_graphql(search_term, session_pool, region, logger, max_pages=SEARCH_NOW_MAX_PAGES,
+                                  price_bounds=price_bounds)
+
+# Con varias cuentas, los 401/403/429 ponen en cuarentena sólo a la cuenta afectada (ver SessionPool);
+# el bot entero se frena recién cuando no queda ninguna disponible
+configure_rate_limit(MARKETPLACE_REQUESTS_PER_MINUTE, burst=MARKETPLACE_BURST,
+                     base_pause=THROTTLE_PAUSE_SECONDS, max_pause=THROTTLE_MAX_PAUSE_SECONDS,
+                     breaker_status_codes=BREAKER_STATUS_CODES if len(session_pool) == 1 else ())
+
+configure_graphql_url(MARKETPLACE_GRAPHQL_URL)
+
+# Pool de conexiones HTTP a facebook.com: una por búsqueda simultánea posible, más margen para búsquedas manuales
+configure_http_pool((MONITOR_CONCURRENCY if MONITOR_ENGINE == "asyncio" else MONITOR_WORKERS) + 4)
+
+# query_scheduler: un único fetch por (búsqueda normalizada, región) repartido a todas las alertas activas
+if MONITOR_ENGINE == "asyncio":
+    query_scheduler = AsyncQueryScheduler(fetch_for_async_scheduler, refresh_interval_fn,
+                                          max_concurrency=MONITOR_CONCURRENCY, max_workers=MONITOR_WORKERS,
+                                          on_shutdown=close_async_session, max_cover_radius=REGION_MERGE_MAX_RADIUS_KM)
+else:
+    query_scheduler = QueryScheduler(fetch_for_scheduler, refresh_interval_fn, max_workers=MONITOR_WORKERS,
+                                     max_cover_radius=REGION_MERGE_MAX_RADIUS_KM)
+
+# manual_searches: pool de "Buscar Ahora"; los pedidos iguales en curso comparten un único fetch
+manual_searches = ManualSearchPool(fetch_for_search_now, max_workers=SEARCH_NOW_WORKERS)
+
+def fetch_image(url):
+    response = get_http_session().get(url, timeout=10)
+    response.raise_for_status()
+    return response.content
+
+if DUPLICATE_IMAGE_HASH and not ImageHasher.available():
+    logger.warning("DUPLICATE_IMAGE_HASH activado pero Pillow no está instalado: las fotos se comparan sólo por URL.")
+# duplicate_detector: publicaciones recientes de cada alerta, para no avisar de las republicaciones (None = desactivado)
+duplicate_detector = DuplicateDetector(
+    window=DUPLICATE_WINDOW_HOURS * 3600, price_tolerance_percent=DUPLICATE_PRICE_TOLERANCE_PERCENT,
+    image_hasher=ImageHasher(fetch_image) if DUPLICATE_IMAGE_HASH and ImageHasher.available() else None
+) if DUPLICATE_WINDOW_HOURS > 0 else None
+
+def start_monitoring(user_id, chat_id, search_term):
+    """Suscribe una alerta al scheduler compartido. Devuelve False si ya estaba monitoreada."""
+    if not session_pool:
         logger.error(f"Monitoreo para '{search_term}' cancelado: No se encontró FACEBOOK_COOKIE.")
         bot.send_message(chat_id, f"❌ No puedo monitorear '{html_lib.escape(search_term)}'. Falta configurar la cookie de Facebook.", parse_mode='HTML')
-        # Limpiar estado de monitoreo para esta alerta
         user_searches[user_id][search_term]['active'] = False
-        if key in active_monitoring_threads:
-            del active_monitoring_threads[key]
-        return
-
-    if not first_scrape_done[key]:
-        logger.info(f"Realizando primer scrapeo (no notificar) para '{search_term}' (Usuario: {user_id})")
-        products = fetch_products_graphql(search_term, 
-                                          user_cookie,
-                                          {"latitude": DEFAULT_LATITUDE,
-                                           "longitude": DEFAULT_LONGITUDE,
-                                           "radius": DEFAULT_RADIUS_KM},
-                                          logger)
-
-        if products:
-            # Añadir todos los productos encontrados en el primer scrapeo al historial y notificados
-            logger.info(f"Primer scrapeo para '{search_term}': Encontrados {len(products)} productos. Añadiendo a historial y notificados.")
-            for product in products:
-                product_id = product.get('id')
-                if product_id:
-                    product_history[user_id][search_term].appendleft(product)
-            save_data(product_history, PRODUCT_HISTORY_FILE, product_history_lock)
-                    
-            first_scrape_done[key] = True
-        else:
-            logger.warning(f"Primer scrapeo para '{search_term}' no devolvió productos o falló.")
+        return False
+
+    logger.info(f"Monitoreo iniciado para '{search_term}' (Usuario: {user_id})")
+    alert_filter = get_alert_filter(user_searches[user_id].get(search_term))
+    return query_scheduler.subscribe(
+        user_id,
+        search_term,
+        get_alert_region(user_id, search_term),
+        lambda products: monitor_search(user_id, chat_id, search_term, products),
+        price_bounds=alert_filter.price_bounds()
+    )
 
-    # Bucle principal de monitoreo
-    while not stop_event.is_set() and user_searches.get(user_id, {}).get(search_term, {}).get('active', False):
-        logger.info(f"Monitoreando: Buscando nuevos productos para '{search_term}' (Usuario: {user_id})")
-        
-        products = fetch_products_graphql(search_term, 
-                                          user_cookie,
-                                          {"latitude": DEFAULT_LATITUDE,
-                                           "longitude": DEFAULT_LONGITUDE,
-                                           "radius": DEFAULT_RADIUS_KM},
-                                          logger)
-        
-        refresh_interval = rand_refresh_interval()
-        
-        if products is None:
-            logger.warning(f"La búsqueda GraphQL para '{search_term}' falló en este ciclo. Reintentando en {refresh_interval}s.")
+def stop_monitoring(user_id, search_term):
+    """Quita una alerta del scheduler compartido."""
+    stopped = query_scheduler.unsubscribe(user_id, search_term)
+    # Lo que estaba esperando en el resumen se entrega ya
+    digest_buffer.flush((user_id, search_term))
+    if stopped:
+        logger.info(f"Monitoreo detenido para '{search_term}' (Usuario: {user_id})")
+    return stopped
 
-        elif not products:
-             logger.info(f"Búsqueda para '{search_term}' completada, no se encontraron productos.")
+def monitor_search(user_id, chat_id, search_term, products):
+    """
+    Procesa el resultado de un ciclo del grupo de búsqueda para una alerta específica.
+    El primer resultado sólo llena el historial; los siguientes notifican productos nuevos.
+    """
+    key = f"{user_id}_{search_term}"
+    alert_details = user_searches.get(user_id, {}).get(search_term, {})
 
-        else:
-            new_products = []
-            for product in products:
-                product_id = product.get('id')
-                if product_id and product_not_in_history(product_id, user_id, search_term):
-                    # ¡Producto nuevo encontrado!
-                    logger.info(f"¡Nuevo producto encontrado para '{search_term}': {product.get('titulo', 'N/A')} ({product_id})")
-                    product_history[user_id][search_term].appendleft(product)
-                    
-                    new_products.append(product)
-            save_data(product_history, PRODUCT_HISTORY_FILE, product_history_lock)
+    if not alert_details.get('active', False):
+        # La alerta dejó de estar activa sin pasar por stop_monitoring
+        if stop_monitoring(user_id, search_term):
+            bot.send_message(chat_id, f"ℹ️ Monitoreo para '{html_lib.escape(search_term)}' se ha detenido.", parse_mode='HTML')
+        return
 
-            # Notificar solo si hay productos nuevos Y ya se hizo el primer scrapeo
-            if first_scrape_done[key] and new_products:
-                logger.info(f"Notificando {len(new_products)} productos nuevos para '{search_term}'")
-                for product in new_products:
-                    send_product_message(chat_id, product)
+    if products is None:
+        logger.warning(f"La búsqueda GraphQL para '{search_term}' falló en este ciclo (Usuario: {user_id}).")
+        return
 
+    # Bajas de precio y republicaciones detectadas en este fetch del grupo ({ listing_id: ListingEvent })
+    events = getattr(products, 'events', None)
+    fetched_region = getattr(products, 'region', None)
+    alert_region = get_alert_region(user_id, search_term)
+    if fetched_region is not None and region_key(fetched_region) != region_key(alert_region):
+        # El grupo pidió un círculo que cubre a varias alertas: quedarse con lo que cae en el de esta
+        products = filter_by_region(products, alert_region)
+    # Lo que no pasa los filtros de la alerta no ocupa historial, escrituras ni mensajes
+    products = get_alert_filter(alert_details).apply(products)
 
-        logger.info(f"Monitoreo para '{search_term}' (Usuario: {user_id}) esperando {refresh_interval} segundos.")
-        # Usa wait() con timeout para que el hilo pueda detenerse rápidamente si se llama stop_event.set()
-        stop_event.wait(refresh_interval)
+    if not first_scrape_done[key]:
+        # Añadir todos los productos encontrados en el primer scrapeo al historial sin notificar
+        logger.info(f"Primer scrapeo para '{search_term}' (Usuario: {user_id}): {len(products)} productos. Añadiendo a historial.")
+        added_products = []
+        for product in products:
+            product_id = product.get('id')
+            if product_id and product_not_in_history(product_id, user_id, search_term):
+                product_history[user_id][search_term].appendleft(product)
+                added_products.append(product)
+        storage.add_products(user_id, search_term, added_products)
+        if duplicate_detector is not None:
+            duplicate_detector.add((user_id, search_term), products)
+        first_scrape_done[key] = True
+        return
 
+    if not products:
+        logger.info(f"Búsqueda para '{search_term}' completada, no se encontraron productos.")
+        return
 
-    # El bucle terminó (por stop_event.is_set() o user_searches[user_id][search_term]['active'] == False)
-    logger.info(f"Hilo de monitoreo detenido para '{search_term}' (Usuario: {user_id})")
-    # Eliminar el evento de parada de la lista de hilos activos
-    if key in active_monitoring_threads:
-        del active_monitoring_threads[key]
-    if not stop_event.is_set():
-        bot.send_message(chat_id, f"ℹ️ Monitoreo para '{html_lib.escape(search_term)}' se ha detenido.", parse_mode='HTML')
+    new_products = []
+    seen_products = []
+    for product in products:
+        product_id = product.get('id')
+        if product_id and product_not_in_history(product_id, user_id, search_term):
+            # Va al historial aunque sea una republicación: así no se vuelve a evaluar en cada ciclo
+            product_history[user_id][search_term].appendleft(product)
+            seen_products.append(product)
+            original_id = duplicate_detector.check((user_id, search_term), product) if duplicate_detector is not None else None
+            if original_id is not None:
+                logger.info(f"Republicación omitida en '{search_term}': {product.get('titulo', 'N/A')} ({product_id}, repite {original_id})")
+                continue
+            # ¡Producto nuevo encontrado!
+            logger.info(f"¡Nuevo producto encontrado para '{search_term}': {product.get('titulo', 'N/A')} ({product_id})")
+            new_products.append(product)
+        elif events and product_id in events:
+            # Publicación que la alerta ya conocía: bajó de precio o volvió a aparecer.
+            # Sale sola y al instante aunque la alerta esté en modo resumen (son pocas y es lo que se espera).
+            event = events[product_id]
+            logger.info(f"Evento '{event.kind}' en '{search_term}': {product.get('titulo', 'N/A')} ({product_id})")
+            # El historial (y lo guardado) pasa a tener el precio nuevo: "Ver en chat", el HTML y el orden por precio
+            product_history[user_id][search_term].replace(product)
+            seen_products.append(product)
+            send_product_message(chat_id, product, header=format_listing_event_header(event, product))
+
+    if seen_products:
+        storage.add_products(user_id, search_term, seen_products)
+    if new_products:
+        digest_minutes = alert_details.get('digest_minutes', 0)
+        if digest_minutes:
+            logger.info(f"Agregando {len(new_products)} productos nuevos al resumen de '{search_term}' ({digest_minutes} min)")
+            digest_buffer.add((user_id, search_term), chat_id, new_products, digest_minutes * 60)
+        else:
+            logger.info(f"Notificando {len(new_products)} productos nuevos para '{search_term}'")
+            for product in new_products:
+                send_product_message(chat_id, product)
 
 def product_not_in_history(product_id, user_id, search_term):
-    product_id not in product_history[user_id][search_term]
+    return not product_history[user_id][search_term].contains_id(product_id)
 
 # --- Handlers de Mensajes y Callbacks (Adaptados) ---
 
 @bot.message_handler(commands=['start', 'help'])
 def send_welcome(message):
+    waiting_for_filters.pop(message.from_user.id, None)
+    waiting_for_region.pop(message.from_user.id, None)
     welcome_msg = (
         "🛍️ <b>Bot de Alertas Marketplace</b>\n\n"
         "¡Te avisaré de nuevos productos en Facebook Marketplace!\n\n"
@@ -312,7 +523,7 @@ def save_search(message):
     # --- SAVE NEW ALERT ---
     # Si no es inválido y no existe, guardar la nueva alerta con el término normalizado
     user_searches[user_id][normalized_search_term] = {'active': False, 'chat_id': chat_id}
-    save_data(user_searches, USER_SEARCHES_FILE, user_searches_lock)
+    storage.save_alert(user_id, normalized_search_term, user_searches[user_id][normalized_search_term])
     
     logger.info(f"save_search - New alert saved for user {user_id}: '{normalized_search_term}' (Chat: {chat_id})")
 
@@ -358,6 +569,8 @@ def handle_new_search_callback(call):
      )
      # Establecer el estado de espera para este usuario
      user_searches[user_id]['waiting_for_search'] = True
+     waiting_for_filters.pop(user_id, None)
+     waiting_for_region.pop(user_id, None)
      bot.answer_callback_query(call.id)
 
 @bot.callback_query_handler(func=lambda call: call.data == "list_alerts")
@@ -379,7 +592,9 @@ def handle_list_alerts(call):
             for search in alert_terms:
                 is_active = searches[search].get('active', False)
                 status_icon = "🔔" if is_active else "🔕"
-                alert_lines.append(f"{status_icon} {html_lib.escape(search)}") # Usar html.escape
+                digest_minutes = searches[search].get('digest_minutes', 0)
+                digest_note = f" (🗞️ resumen cada {digest_minutes} min)" if digest_minutes else ""
+                alert_lines.append(f"{status_icon} {html_lib.escape(search)}{digest_note}") # Usar html.escape
 
             message_text = "📋 <b>Tus Alertas:</b>\n\n" + "\n".join(alert_lines)
             markup = create_inline_keyboard() # Volver al menú principal
@@ -503,7 +718,7 @@ def handle_select_alert_search_now_action(call):
             except: pass
         except: pass
 
-@bot.callback_query_handler(func=lambda call: call.data in ["select_alert_activate", "select_alert_deactivate", "select_alert_delete"])
+@bot.callback_query_handler(func=lambda call: call.data in ["select_alert_activate", "select_alert_deactivate", "select_alert_delete", "select_alert_digest", "select_alert_filters", "select_alert_region"])
 def handle_select_alert_action(call):
 
     """Muestra la lista de alertas para que el usuario seleccione una para activar/desactivar/buscar/eliminar."""
@@ -530,7 +745,10 @@ def handle_select_alert_action(call):
             "activate": "activar notificaciones para",
             "deactivate": "desactivar notificaciones para",
             "search_now": "buscar ahora para",
-            "delete": "eliminar"
+            "delete": "eliminar",
+            "digest": "configurar el modo resumen de",
+            "filters": "configurar los filtros de",
+            "region": "cambiar la zona de"
         }
         action_text = action_text_map.get(action_prefix, "seleccionar alerta:")
 
@@ -619,9 +837,9 @@ def handle_toggle_monitoring(call):
                 bot.answer_callback_query(call.id, f"Las notificaciones ya están activas para '{html_lib.escape(search_term)}'.", show_alert=False)
                 msg = f"🔔 Notificaciones ya estaban activas para: '{html_lib.escape(search_term)}'"
             else:
-                # Verificar si ya hay un hilo activo con la MISMA clave (por si acaso)
-                if key in active_monitoring_threads and active_monitoring_threads[key].is_set():
-                     logger.warning(f"Intento de activar hilo para '{search_term}' ({user_id}) pero ya existe un evento activo.")
+                # Verificar si la alerta ya está suscripta al scheduler (por si acaso)
+                if query_scheduler.is_subscribed(user_id, search_term):
+                     logger.warning(f"Intento de activar monitoreo para '{search_term}' ({user_id}) pero ya está suscripta.")
                      bot.answer_callback_query(call.id, "Ya hay un proceso activo para esta alerta.", show_alert=True)
                      msg = f"🔔 Notificaciones ya estaban activas para: '{html_lib.escape(search_term)}'" # Mensaje para la edición
 
@@ -629,21 +847,14 @@ def handle_toggle_monitoring(call):
                     # Marcar como activa y resetear flag de primera búsqueda
                     user_searches[user_id][search_term]['active'] = True
                     user_searches[user_id][search_term]['chat_id'] = chat_id # Asegurar que el chat_id esté guardado
-                    save_data(user_searches, USER_SEARCHES_FILE, user_searches_lock)
+                    storage.save_alert(user_id, search_term, user_searches[user_id][search_term])
                     
                     first_scrape_done[key] = False # Resetear para forzar primer scrapeo al iniciar
 
                     logger.info(f"Activando monitoreo para '{search_term}' (Usuario: {user_id}, Chat: {chat_id})")
 
-                    # Crear y empezar el hilo de monitoreo
-                    stop_event = threading.Event()
-                    active_monitoring_threads[key] = stop_event # Guardar el evento para poder detenerlo
-                    thread = threading.Thread(
-                        target=monitor_search,
-                        args=(user_id, chat_id, search_term, stop_event), 
-                        daemon=True
-                    )
-                    thread.start()
+                    # Suscribir la alerta al scheduler compartido
+                    start_monitoring(user_id, chat_id, search_term)
 
                     msg = f"🔔 Notificaciones ACTIVADAS para: '{html_lib.escape(search_term)}'"
                     bot.answer_callback_query(call.id, msg, show_alert=False) # Responder al callback antes de editar el mensaje
@@ -655,18 +866,14 @@ def handle_toggle_monitoring(call):
             else:
                 # Marcar como inactiva en la estructura principal
                 user_searches[user_id][search_term]['active'] = False
-                save_data(user_searches, USER_SEARCHES_FILE, user_searches_lock)
+                storage.save_alert(user_id, search_term, user_searches[user_id][search_term])
                 
                 msg = f"🔕 Notificaciones DESACTIVADAS para: '{html_lib.escape(search_term)}'"
                 logger.info(f"Desactivando monitoreo para '{search_term}' (Usuario: {user_id})")
 
-                # Detener el hilo si existe
-                if key in active_monitoring_threads:
-                    stop_event = active_monitoring_threads.pop(key) # Quita la referencia del diccionario
-                    stop_event.set() # Señala al hilo que debe detenerse
-                    logger.info(f"Evento de parada enviado para el hilo de '{search_term}' (Usuario: {user_id})")
-                else:
-                     logger.warning(f"Se intentó desactivar monitoreo para '{search_term}' ({user_id}) pero no se encontró un hilo activo registrado.")
+                # Quitar la alerta del scheduler si estaba suscripta
+                if not stop_monitoring(user_id, search_term):
+                     logger.warning(f"Se intentó desactivar monitoreo para '{search_term}' ({user_id}) pero no estaba suscripta al scheduler.")
 
 
                 bot.answer_callback_query(call.id, msg, show_alert=False) # Responder al callback antes de editar el mensaje
@@ -700,24 +907,33 @@ def handle_toggle_monitoring(call):
             except: pass
         except: pass
 
+def remember_search_results(user_id, search_term, products):
+    last_search_results[(user_id, search_term)] = products
+    last_search_results.move_to_end((user_id, search_term))
+    while len(last_search_results) > LAST_SEARCH_RESULTS_MAX:
+        last_search_results.popitem(last=False)
+
 def delete_alert(key, search_term, user_id):
-    if key in active_monitoring_threads:
-        stop_event = active_monitoring_threads.pop(key)
-        stop_event.set()
-        logger.info(f"Evento de parada enviado al eliminar alerta '{search_term}' (Usuario: {user_id})")
+    digest_buffer.discard((user_id, search_term))
+    last_search_results.pop((user_id, search_term), None)
+    if duplicate_detector is not None:
+        duplicate_detector.forget((user_id, search_term))
+    if stop_monitoring(user_id, search_term):
+        logger.info(f"Monitoreo detenido al eliminar alerta '{search_term}' (Usuario: {user_id})")
 
     del user_searches[user_id][search_term]
-    save_data(user_searches, USER_SEARCHES_FILE, user_searches_lock)
     
     if not user_searches[user_id]:
         del user_searches[user_id]
 
     if user_id in product_history and search_term in product_history[user_id]:
         del product_history[user_id][search_term]
-        save_data(product_history, PRODUCT_HISTORY_FILE, product_history_lock)
         if not product_history[user_id]:
             del product_history[user_id]
 
+    # Borra la alerta y su historial del almacenamiento
+    storage.delete_alert(user_id, search_term)
+
     if key in first_scrape_done:
             del first_scrape_done[key]
                 
@@ -776,6 +992,304 @@ def handle_delete_alert(call):
         except: pass
 
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith("digest_"))
+def handle_digest_options(call):
+    """Muestra las opciones del modo resumen para una alerta."""
+    try:
+        _, search_term = call.data.split("_", 1)
+        user_id = call.from_user.id
+        chat_id = call.message.chat.id
+
+        alert_details = user_searches.get(user_id, {}).get(search_term)
+        if not isinstance(alert_details, dict):
+            bot.answer_callback_query(call.id, "No se encontró la alerta.", show_alert=True)
+            return
+
+        current = alert_details.get('digest_minutes', 0)
+        options = {("✅ " if not current else "") + "Cada producto al instante": f"setdigest_0_{search_term}"}
+        for minutes in DIGEST_WINDOW_OPTIONS:
+            options[("✅ " if current == minutes else "") + f"Resumen cada {minutes} min"] = f"setdigest_{minutes}_{search_term}"
+
+        bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=call.message.message_id,
+            text=f"🗞️ ¿Cómo quieres recibir los productos nuevos de '{html_lib.escape(search_term)}'?\n\n"
+                 "En modo resumen se juntan durante la ventana elegida y llegan en un solo mensaje.",
+            reply_markup=create_inline_keyboard(options, back_callback="select_alert_digest"),
+            parse_mode='HTML'
+        )
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        logger.exception(f"Error mostrando opciones de resumen: {e}")
+        bot.answer_callback_query(call.id, "❌ Error al procesar la solicitud.", show_alert=True)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("setdigest_"))
+def handle_set_digest(call):
+    """Guarda la ventana del modo resumen (0 = notificar cada producto al instante)."""
+    try:
+        _, minutes_str, search_term = call.data.split("_", 2)
+        minutes = int(minutes_str)
+        user_id = call.from_user.id
+        chat_id = call.message.chat.id
+
+        alert_details = user_searches.get(user_id, {}).get(search_term)
+        if not isinstance(alert_details, dict):
+            bot.answer_callback_query(call.id, "No se encontró la alerta.", show_alert=True)
+            return
+
+        if minutes:
+            alert_details['digest_minutes'] = minutes
+            msg = f"🗞️ '{html_lib.escape(search_term)}': resumen cada {minutes} minutos."
+        else:
+            alert_details.pop('digest_minutes', None)
+            # Lo que estaba esperando en el resumen se entrega ya
+            digest_buffer.flush((user_id, search_term))
+            msg = f"🔔 '{html_lib.escape(search_term)}': cada producto nuevo se notifica al instante."
+        storage.save_alert(user_id, search_term, alert_details)
+        logger.info(f"Modo resumen de '{search_term}' (Usuario: {user_id}): {minutes} min")
+
+        bot.answer_callback_query(call.id)
+        bot.edit_message_text(chat_id=chat_id, message_id=call.message.message_id,
+                              text=f"{msg}\n\n¿Qué más deseas hacer?",
+                              reply_markup=create_inline_keyboard(), parse_mode='HTML')
+    except Exception as e:
+        logger.exception(f"Error configurando modo resumen: {e}")
+        bot.answer_callback_query(call.id, "❌ Error al configurar el modo resumen.", show_alert=True)
+
+FILTERS_HELP = (
+    "Escribe los filtros, uno por línea:\n"
+    "<code>precio 1000-50000</code> (o <code>precio -50000</code>, <code>precio 1000-</code>; en dólares <code>precio US$100-500</code>)\n"
+    "<code>incluir: 128gb, negro</code> (tienen que estar todas)\n"
+    "<code>excluir: roto, repuesto</code>\n"
+    "<code>ciudad: Rosario, Funes</code>\n\n"
+    "Las líneas que no escribas quedan sin filtro. Envía <code>borrar</code> para quitarlos todos."
+)
+
+def update_alert_filters(user_id, search_term, alert_filter):
+    """Guarda los filtros de una alerta y, si está monitoreándose, la vuelve a suscribir con sus cotas de precio."""
+    alert_details = user_searches[user_id][search_term]
+    if alert_filter:
+        alert_details['filters'] = alert_filter.to_spec()
+    else:
+        alert_details.pop('filters', None)
+    storage.save_alert(user_id, search_term, alert_details)
+    logger.info(f"Filtros de '{search_term}' (Usuario: {user_id}): {alert_details.get('filters', {})}")
+    restart_alert_monitoring(user_id, search_term)
+
+def restart_alert_monitoring(user_id, search_term):
+    """Vuelve a suscribir una alerta activa para que el scheduler tome sus nuevos filtros o zona."""
+    alert_details = user_searches[user_id][search_term]
+    if alert_details.get('active') and query_scheduler.is_subscribed(user_id, search_term):
+        query_scheduler.unsubscribe(user_id, search_term)
+        # El próximo resultado es la nueva línea base: lo que recién ahora entra en la alerta no es "nuevo"
+        first_scrape_done[f"{user_id}_{search_term}"] = False
+        start_monitoring(user_id, alert_details.get('chat_id'), search_term)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("filters_"))
+def handle_filter_options(call):
+    """Muestra los filtros de una alerta y espera los nuevos por mensaje."""
+    try:
+        _, search_term = call.data.split("_", 1)
+        user_id = call.from_user.id
+        chat_id = call.message.chat.id
+
+        alert_details = user_searches.get(user_id, {}).get(search_term)
+        if not isinstance(alert_details, dict):
+            bot.answer_callback_query(call.id, "No se encontró la alerta.", show_alert=True)
+            return
+
+        waiting_for_region.pop(user_id, None)
+        waiting_for_filters[user_id] = search_term
+        current = get_alert_filter(alert_details)
+        options = {"🗑️ Quitar filtros": f"clearfilters_{search_term}"} if current else {}
+        bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=call.message.message_id,
+            text=f"🎚️ Filtros de '{html_lib.escape(search_term)}':\n{html_lib.escape(current.describe())}\n\n{FILTERS_HELP}",
+            reply_markup=create_inline_keyboard(options, back_callback="select_alert_filters") if options
+                         else create_inline_keyboard({"⬅️ Volver": "select_alert_filters"}, back_button=False),
+            parse_mode='HTML'
+        )
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        logger.exception(f"Error mostrando filtros: {e}")
+        bot.answer_callback_query(call.id, "❌ Error al procesar la solicitud.", show_alert=True)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("clearfilters_"))
+def handle_clear_filters(call):
+    """Quita todos los filtros de una alerta."""
+    try:
+        _, search_term = call.data.split("_", 1)
+        user_id = call.from_user.id
+        chat_id = call.message.chat.id
+
+        if not isinstance(user_searches.get(user_id, {}).get(search_term), dict):
+            bot.answer_callback_query(call.id, "No se encontró la alerta.", show_alert=True)
+            return
+
+        waiting_for_filters.pop(user_id, None)
+        update_alert_filters(user_id, search_term, get_alert_filter({}))
+        bot.answer_callback_query(call.id)
+        bot.edit_message_text(chat_id=chat_id, message_id=call.message.message_id,
+                              text=f"🎚️ '{html_lib.escape(search_term)}' ya no tiene filtros.\n\n¿Qué más deseas hacer?",
+                              reply_markup=create_inline_keyboard(), parse_mode='HTML')
+    except Exception as e:
+        logger.exception(f"Error quitando filtros: {e}")
+        bot.answer_callback_query(call.id, "❌ Error al quitar los filtros.", show_alert=True)
+
+@bot.message_handler(func=lambda m: m.from_user.id in waiting_for_filters)
+def save_filters(message):
+    """Captura los filtros escritos por el usuario después de elegir una alerta en 'Filtros'."""
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+    search_term = waiting_for_filters.get(user_id)
+
+    if not isinstance(user_searches.get(user_id, {}).get(search_term), dict):
+        waiting_for_filters.pop(user_id, None)
+        bot.send_message(chat_id, "❌ La alerta ya no existe.", reply_markup=create_inline_keyboard())
+        return
+
+    text = (message.text or "").strip()
+    if text.lower() in ("borrar", "ninguno", "quitar"):
+        alert_filter = get_alert_filter({})
+    else:
+        try:
+            alert_filter = parse_filter_text(text)
+        except ValueError as e:
+            # Sigue esperando: el usuario puede corregir y volver a enviar
+            bot.send_message(chat_id, f"❌ {html_lib.escape(str(e))}\n\n{FILTERS_HELP}", parse_mode='HTML')
+            return
+
+    waiting_for_filters.pop(user_id, None)
+    update_alert_filters(user_id, search_term, alert_filter)
+    bot.send_message(
+        chat_id,
+        f"✅ Filtros de '{html_lib.escape(search_term)}':\n{html_lib.escape(alert_filter.describe())}\n\n¿Qué más deseas hacer?",
+        reply_markup=create_inline_keyboard(),
+        parse_mode='HTML'
+    )
+
+REGION_HELP = (
+    "Escribe la ciudad o zona donde buscar, con el radio en km si quieres otro "
+    "(ej. <code>Córdoba</code> o <code>Mar del Plata 30 km</code>), o comparte tu ubicación con el botón de abajo.\n"
+    "Envía <code>borrar</code> para volver a la zona por defecto."
+)
+REGION_RADIUS_PATTERN = re.compile(r'^(.*?)[\s,]+(\d+(?:[.,]\d+)?)\s*(?:km|kms)?\.?$', re.IGNORECASE)
+
+def describe_region(region):
+    name = region.get('name') or f"{region['latitude']:.3f}, {region['longitude']:.3f}"
+    return f"{name} ({region['radius']:g} km)"
+
+def parse_region_text(text):
+    """'Córdoba' / 'Mar del Plata 30 km' -> (lugar, radio en km o None)."""
+    match = REGION_RADIUS_PATTERN.match(text.strip())
+    if match and match.group(1).strip():
+        return match.group(1).strip(), float(match.group(2).replace(',', '.'))
+    return text.strip(), None
+
+def update_alert_region(user_id, search_term, region):
+    """Guarda la zona de una alerta (None = la de por defecto) y la vuelve a suscribir si está activa."""
+    alert_details = user_searches[user_id][search_term]
+    if region:
+        alert_details['region'] = region
+    else:
+        alert_details.pop('region', None)
+    storage.save_alert(user_id, search_term, alert_details)
+    logger.info(f"Zona de '{search_term}' (Usuario: {user_id}): {describe_region(get_alert_region(user_id, search_term))}")
+    restart_alert_monitoring(user_id, search_term)
+
+def confirm_region(chat_id, user_id, search_term):
+    # Quita el teclado de "Compartir ubicación" y vuelve al menú
+    region = get_alert_region(user_id, search_term)
+    bot.send_message(chat_id, f"📍 Zona de '{html_lib.escape(search_term)}': {html_lib.escape(describe_region(region))}",
+                     reply_markup=types.ReplyKeyboardRemove(), parse_mode='HTML')
+    bot.send_message(chat_id, "¿Qué más deseas hacer?", reply_markup=create_inline_keyboard())
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("region_"))
+def handle_region_options(call):
+    """Muestra la zona de una alerta y espera una nueva (texto o ubicación compartida)."""
+    try:
+        _, search_term = call.data.split("_", 1)
+        user_id = call.from_user.id
+        chat_id = call.message.chat.id
+
+        if not isinstance(user_searches.get(user_id, {}).get(search_term), dict):
+            bot.answer_callback_query(call.id, "No se encontró la alerta.", show_alert=True)
+            return
+
+        waiting_for_filters.pop(user_id, None)
+        waiting_for_region[user_id] = search_term
+        region = get_alert_region(user_id, search_term)
+        bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=call.message.message_id,
+            text=f"📍 Zona de '{html_lib.escape(search_term)}': {html_lib.escape(describe_region(region))}",
+            reply_markup=create_inline_keyboard({"⬅️ Volver": "select_alert_region"}, back_button=False),
+            parse_mode='HTML'
+        )
+        # El botón de ubicación sólo existe en los teclados de respuesta: va en un mensaje aparte
+        location_keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+        location_keyboard.add(types.KeyboardButton("📍 Compartir ubicación", request_location=True))
+        bot.send_message(chat_id, REGION_HELP, reply_markup=location_keyboard, parse_mode='HTML')
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        logger.exception(f"Error mostrando la zona: {e}")
+        bot.answer_callback_query(call.id, "❌ Error al procesar la solicitud.", show_alert=True)
+
+@bot.message_handler(content_types=['location'], func=lambda m: m.from_user.id in waiting_for_region)
+def save_region_location(message):
+    """Zona a partir de una ubicación compartida: centro en ese punto, con el radio que ya tenía la alerta."""
+    user_id = message.from_user.id
+    search_term = waiting_for_region.pop(user_id, None)
+    if not isinstance(user_searches.get(user_id, {}).get(search_term), dict):
+        bot.send_message(message.chat.id, "❌ La alerta ya no existe.", reply_markup=types.ReplyKeyboardRemove())
+        return
+    radius = get_alert_region(user_id, search_term)['radius']
+    update_alert_region(user_id, search_term, make_region(message.location.latitude, message.location.longitude,
+                                                          radius, "Ubicación compartida"))
+    confirm_region(message.chat.id, user_id, search_term)
+
+@bot.message_handler(func=lambda m: m.from_user.id in waiting_for_region)
+def save_region_text(message):
+    """Zona a partir del nombre de un lugar (geocodificado una sola vez y cacheado)."""
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+    search_term = waiting_for_region.get(user_id)
+    if not isinstance(user_searches.get(user_id, {}).get(search_term), dict):
+        waiting_for_region.pop(user_id, None)
+        bot.send_message(chat_id, "❌ La alerta ya no existe.", reply_markup=types.ReplyKeyboardRemove())
+        return
+
+    text = (message.text or "").strip()
+    if text.lower() in ("borrar", "ninguno", "por defecto"):
+        waiting_for_region.pop(user_id, None)
+        update_alert_region(user_id, search_term, None)
+        confirm_region(chat_id, user_id, search_term)
+        return
+
+    # Sigue esperando mientras no haya una zona válida: el usuario puede corregir y volver a enviar
+    place, radius = parse_region_text(text)
+    if radius is None:
+        radius = get_alert_region(user_id, search_term)['radius']
+    if not 1 <= radius <= MAX_RADIUS_KM:
+        bot.send_message(chat_id, f"❌ El radio tiene que estar entre 1 y {MAX_RADIUS_KM} km.")
+        return
+    try:
+        location = geocoder.geocode(place)
+    except GeopyError as e:
+        logger.warning(f"Error geocodificando '{place}': {e}")
+        bot.send_message(chat_id, "❌ No pude consultar el mapa en este momento. Inténtalo de nuevo en un rato.")
+        return
+    if location is None:
+        bot.send_message(chat_id, f"❌ No encontré '{html_lib.escape(place)}'. Prueba con otro nombre (ej. 'Villa María, Córdoba').",
+                         parse_mode='HTML')
+        return
+
+    waiting_for_region.pop(user_id, None)
+    latitude, longitude, _ = location
+    update_alert_region(user_id, search_term, make_region(latitude, longitude, radius, place.title()))
+    confirm_region(chat_id, user_id, search_term)
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith("search_now_"))
 def handle_search_now_specific(call):
     """Inicia una búsqueda inmediata para una alerta seleccionada."""
@@ -784,6 +1298,9 @@ def handle_search_now_specific(call):
     callback_data = call.data # Guarda el dato original del callback para depuración
 
     logger.debug(f"handle_search_now_specific - Received callback data: {callback_data}") # LOG: Muestra el callback exacto recibido
+    search_term = None
+    loading_message = None
+    submitted = False # Si la búsqueda quedó en el pool, finish_search_now resetea search_in_progress
 
     try:
         # Extraer el término de búsqueda del callback data.
@@ -845,40 +1362,75 @@ def handle_search_now_specific(call):
                  logger.error(f"handle_search_now_specific - Unexpected error sending new loading message: {e_send_loading}")
                  loading_message = None # Asegurar que es None si falla el envío
 
-        logger.info(f"handle_search_now_specific - Calling fetch_products_graphql for '{search_term}' (User: {user_id})")
-        products = fetch_products_graphql(search_term, 
-                                          FACEBOOK_COOKIE,
-                                          {"latitude": DEFAULT_LATITUDE,
-                                           "longitude": DEFAULT_LONGITUDE,
-                                           "radius": DEFAULT_RADIUS_KM},
-                                          logger)
+        # La búsqueda corre en el pool de "Buscar Ahora": el handler libera el hilo de Telegram enseguida
+        region = get_alert_region(user_id, search_term)
+        alert_filter = get_alert_filter(user_searches.get(user_id, {}).get(search_term))
+        logger.info(f"handle_search_now_specific - Submitting search for '{search_term}' to the manual search pool (User: {user_id})")
+        future = manual_searches.submit(search_term, region, alert_filter.price_bounds())
+        submitted = True
+        future.add_done_callback(lambda f: finish_search_now(user_id, chat_id, search_term, loading_message, alert_filter, f))
+
+    except Exception as e:
+        logger.exception(f"handle_search_now_specific - Unhandled error for '{search_term}': {e}")
+        # Responder al callback con una alerta de error genérica
+        bot.answer_callback_query(call.id, "❌ Ocurrió un error inesperado durante la búsqueda.", show_alert=True)
+        # Intentar enviar un mensaje de error al usuario
+        try:
+            bot.send_message(chat_id, f"❌ Ocurrió un error inesperado durante la búsqueda de '{html_lib.escape(search_term)}'. Por favor, inténtalo de nuevo más tarde.", reply_markup=create_inline_keyboard(), parse_mode='HTML')
+            # Intentar borrar el mensaje de carga si existía
+            if loading_message:
+                 try: bot.delete_message(chat_id, loading_message.message_id)
+                 except telebot.apihelper.ApiTelegramException: pass
+                 except Exception as e_delete: logger.error(f"handle_search_now_specific - Error deleting loading message {loading_message.message_id} in error handler: {e_delete}")
+        except Exception as e_fallback:
+             logger.error(f"handle_search_now_specific - Error sending fallback message in error handler: {e_fallback}")
+
+    finally:
+        # Asegurar que la bandera search_in_progress se resetee si la búsqueda no llegó al pool
+        if not submitted and user_id in search_in_progress:
+             search_in_progress[user_id] = False
+             logger.info(f"handle_search_now_specific - Search in progress flag reset for user {user_id} in finally block.")
 
 
+def finish_search_now(user_id, chat_id, search_term, loading_message, alert_filter, future):
+    """Muestra el resultado de una búsqueda de "Buscar Ahora" (corre en el hilo del pool que la resolvió)."""
+    try:
+        found = future.result()
+        found_count = len(found) if found else 0
+        products = alert_filter.apply(found)
+
         # --- Manejar Resultados de la Búsqueda ---
         if products is None:
-             logger.error(f"handle_search_now_specific - fetch_products_graphql returned None for '{search_term}'.")
+             logger.error(f"finish_search_now - search returned None for '{search_term}'.")
              error_message = f"❌ Ocurrió un error al buscar productos para '{html_lib.escape(search_term)}'. Revisa los logs del bot para más detalles (puede ser un problema con la cookie)."
+             rate_limit_state = get_rate_limit_state()
+             sessions_retry_in = session_pool.next_available_in()
+             if rate_limit_state["state"] != "closed" or sessions_retry_in > 0:
+                 retry_minutes = max(1, round(max(rate_limit_state["retry_in"], sessions_retry_in) / 60))
+                 error_message = f"⏸️ Marketplace está limitando las búsquedas. Intentá de nuevo en {retry_minutes} minuto(s)."
              try:
                  if loading_message:
                       bot.edit_message_text(chat_id=chat_id, message_id=loading_message.message_id, text=error_message, reply_markup=create_inline_keyboard(), parse_mode='HTML')
                  else: 
                       bot.send_message(chat_id, error_message, reply_markup=create_inline_keyboard(), parse_mode='HTML')
              except Exception as e_msg:
-                 logger.error(f"handle_search_now_specific - Error sending/editing error message: {e_msg}")
+                 logger.error(f"finish_search_now - Error sending/editing error message: {e_msg}")
                  try: bot.send_message(chat_id, "❌ Error en la búsqueda.")
                  except: pass
              return
 
         elif not products: # Búsqueda exitosa pero sin resultados
-            logger.info(f"handle_search_now_specific - fetch_products_graphql found 0 products for '{search_term}'.")
+            logger.info(f"finish_search_now - Search found 0 products for '{search_term}' ({found_count} before filters).")
             success_message = f"✅ No se encontraron productos para '{html_lib.escape(search_term)}'."
+            if found_count:
+                success_message = f"✅ Se encontraron {found_count} productos para '{html_lib.escape(search_term)}', pero ninguno pasa tus filtros."
             try:
                 if loading_message: # Si enviamos un mensaje de carga, intentar editarlo
-                     bot.edit_message_text(chat_id=chat_id, message_id=loading_message.messsage_id, text=success_message, reply_markup=create_inline_keyboard(), parse_mode='HTML')
+                     bot.edit_message_text(chat_id=chat_id, message_id=loading_message.message_id, text=success_message, reply_markup=create_inline_keyboard(), parse_mode='HTML')
                 else: # Si no, enviar un nuevo mensaje
                      bot.send_message(chat_id, success_message, reply_markup=create_inline_keyboard(), parse_mode='HTML')
             except Exception as e_msg:
-                logger.error(f"handle_search_now_specific - Error sending/editing success message: {e_msg}")
+                logger.error(f"finish_search_now - Error sending/editing success message: {e_msg}")
                 # Fallback: enviar un mensaje simple
                 try: bot.send_message(chat_id, "✅ Búsqueda completada sin resultados.")
                 except: pass
@@ -886,30 +1438,31 @@ def handle_search_now_specific(call):
 
 
         # --- Si se encontraron productos ---
-        logger.info(f"handle_search_now_specific - Search for '{search_term}' successful. Found {len(products)} products.")
+        logger.info(f"finish_search_now - Search for '{search_term}' successful. Found {len(products)} products.")
+        remember_search_results(user_id, search_term, products)
 
         # --- Actualizar Historial ---
         current_history = product_history[user_id][search_term]
-        newly_added_to_history = 0
+        added_products = []
         
         # Añadir productos encontrados al historial (deque con maxlen)
         # Iterar sobre los productos encontrados y añadirlos al historial si no están ya
         for product in reversed(products):
              product_id = product.get('id')
              # Verificar si el producto (por ID) ya está en el historial actual para evitar duplicados
-             # Usar any() para una verificación eficiente en el deque
-             if product_id and not any(p.get('id') == product_id for p in current_history):
+             if product_id and not current_history.contains_id(product_id):
                  current_history.appendleft(product)
-                 newly_added_to_history += 1
+                 added_products.append(product)
 
-        if newly_added_to_history > 0:
-             logger.info(f"handle_search_now_specific - Added {newly_added_to_history} products to history for '{search_term}'. History size: {len(current_history)}.")
+        if added_products:
+             storage.add_products(user_id, search_term, added_products)
+             logger.info(f"finish_search_now - Added {len(added_products)} products to history for '{search_term}'. History size: {len(current_history)}.")
         else:
-             logger.info(f"handle_search_now_specific - No new products to add to history for '{search_term}'. History size: {len(current_history)}.")
+             logger.info(f"finish_search_now - No new products to add to history for '{search_term}'. History size: {len(current_history)}.")
 
 
         # Ofrecer opciones de visualización/descarga (basado en el historial actual, no solo los productos de esta búsqueda)
-        logger.info(f"handle_search_now_specific - Offering display options for search '{search_term}'.")
+        logger.info(f"finish_search_now - Offering display options for search '{search_term}'.")
         markup = types.InlineKeyboardMarkup()
         history_count = len(current_history)
 
@@ -920,6 +1473,9 @@ def handle_search_now_specific(call):
                 types.InlineKeyboardButton(f"📱 Ver en chat ({min(ELEMENTS_SHOW_CHAT, history_count)})", callback_data=f"show_history_{search_term}_{min(ELEMENTS_SHOW_CHAT, history_count)}"),
                 types.InlineKeyboardButton(f"📄 Descargar HTML ({history_count})", callback_data=f"download_history_{search_term}_all")
              )
+             if len(products) > history_count:
+                  # La búsqueda recorrió más páginas de las que entran en el historial
+                  markup.add(types.InlineKeyboardButton(f"📄 Descargar búsqueda completa ({len(products)})", callback_data=f"download_history_{search_term}_search"))
         else:
              # Esto no debería ocurrir si products > 0 y el historial se actualizó, pero es un caso de seguridad
              markup.add(types.InlineKeyboardButton("❌ No hay resultados recientes en historial", callback_data="main_menu"))
@@ -944,9 +1500,9 @@ def handle_search_now_specific(call):
                      reply_markup=markup,
                      parse_mode='HTML'
                  )
-                 logger.info(f"handle_search_now_specific - Edited loading message {loading_message.message_id} to show display options.")
+                 logger.info(f"finish_search_now - Edited loading message {loading_message.message_id} to show display options.")
              except telebot.apihelper.ApiTelegramException as e_edit_final:
-                 logger.warning(f"handle_search_now_specific - Could not edit final message {loading_message.message_id} with display options: {e_edit_final}. Sending new message.")
+                 logger.warning(f"finish_search_now - Could not edit final message {loading_message.message_id} with display options: {e_edit_final}. Sending new message.")
                  # Si falla la edición, enviar uno nuevo
                  bot.send_message(
                      chat_id,
@@ -955,14 +1511,14 @@ def handle_search_now_specific(call):
                      parse_mode='HTML'
                  )
              except Exception as e_edit_final_unexpected:
-                  logger.error(f"handle_search_now_specific - Unexpected error editing final message {loading_message.message_id}: {e_edit_final_unexpected}")
+                  logger.error(f"finish_search_now - Unexpected error editing final message {loading_message.message_id}: {e_edit_final_unexpected}")
                   # Fallback: enviar nuevo mensaje simple
                   try: bot.send_message(chat_id, "Búsqueda completa. Error mostrando opciones.")
                   except: pass
 
         else:
              # Si no se pudo enviar/editar un mensaje de carga inicialmente, simplemente enviar el mensaje final con opciones
-             logger.warning("handle_search_now_specific - No loading message found. Sending final message with options.")
+             logger.warning("finish_search_now - No loading message found. Sending final message with options.")
              try:
                  bot.send_message(
                      chat_id,
@@ -971,33 +1527,24 @@ def handle_search_now_specific(call):
                      parse_mode='HTML'
                  )
              except Exception as e_send_final:
-                  logger.error(f"handle_search_now_specific - Unexpected error sending final message with options: {e_send_final}")
+                  logger.error(f"finish_search_now - Unexpected error sending final message with options: {e_send_final}")
                   # Fallback: enviar un mensaje simple
                   try: bot.send_message(chat_id, "Búsqueda completa. Error mostrando opciones.")
                   except: pass
 
-
     except Exception as e:
-        logger.exception(f"handle_search_now_specific - Unhandled error for '{search_term}': {e}")
-        # Responder al callback con una alerta de error genérica
-        bot.answer_callback_query(call.id, "❌ Ocurrió un error inesperado durante la búsqueda.", show_alert=True)
-        # Intentar enviar un mensaje de error al usuario
+        logger.exception(f"finish_search_now - Unhandled error for '{search_term}': {e}")
         try:
             bot.send_message(chat_id, f"❌ Ocurrió un error inesperado durante la búsqueda de '{html_lib.escape(search_term)}'. Por favor, inténtalo de nuevo más tarde.", reply_markup=create_inline_keyboard(), parse_mode='HTML')
-            # Intentar borrar el mensaje de carga si existía
             if loading_message:
                  try: bot.delete_message(chat_id, loading_message.message_id)
                  except telebot.apihelper.ApiTelegramException: pass
-                 except Exception as e_delete: logger.error(f"handle_search_now_specific - Error deleting loading message {loading_message.message_id} in error handler: {e_delete}")
         except Exception as e_fallback:
-             logger.error(f"handle_search_now_specific - Error sending fallback message in error handler: {e_fallback}")
+             logger.error(f"finish_search_now - Error sending fallback message in error handler: {e_fallback}")
 
     finally:
-        # Asegurar que la bandera search_in_progress se resetee siempre al finalizar el handler
-        if user_id in search_in_progress:
-             search_in_progress[user_id] = False
-             logger.info(f"handle_search_now_specific - Search in progress flag reset for user {user_id} in finally block.")
-
+        search_in_progress[user_id] = False
+        logger.info(f"finish_search_now - Search in progress flag reset for user {user_id}.")
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith(("show_history_", "download_history_")))
@@ -1014,8 +1561,13 @@ def handle_display_history_results(call):
         user_id = call.from_user.id
         chat_id = call.message.chat.id
 
-        # Obtener productos del historial
-        products_from_history = list(product_history.get(user_id, {}).get(search_term, deque()))
+        # Obtener productos del historial (o el resultado completo del último "Buscar Ahora")
+        search_results = last_search_results.get((user_id, search_term)) if quantity_str.lower() == "search" else None
+        if search_results is not None:
+            products_from_history = list(search_results)
+        else:
+            # Sin "Buscar Ahora" reciente (o ya salió del LRU): el historial de la alerta
+            products_from_history = list(product_history.get(user_id, {}).get(search_term, deque()))
 
         if not products_from_history:
             bot.answer_callback_query(call.id, "No hay productos recientes en el historial para esta alerta.", show_alert=True)
@@ -1027,7 +1579,7 @@ def handle_display_history_results(call):
             return
 
         # Determinar cuántos productos procesar
-        if quantity_str.lower() == "all":
+        if quantity_str.lower() in ("all", "search"):
             products_to_process = products_from_history # Todos del historial
         else:
             try:
@@ -1052,14 +1604,15 @@ def handle_display_history_results(call):
              # No es crítico si no se puede editar
 
         if action_type == "show":
-            bot.send_message(
+            # Todo por la cola del notifier con prioridad baja, para que salga en orden y sin frenar alertas en vivo
+            notifier.send_message(
                  chat_id,
                  f"👇 Mostrando {len(products_to_process)} productos recientes para '{html_lib.escape(search_term)}':",
+                 priority=PRIORITY_HISTORY,
                  parse_mode='HTML'
             )
             for product in products_to_process:
-                 send_product_message(chat_id, product)
-                 time.sleep(0.1)
+                 send_product_message(chat_id, product, priority=PRIORITY_HISTORY)
 
         elif action_type == "download":
             html_content = generate_html(products_to_process, search_term)
@@ -1083,10 +1636,11 @@ def handle_display_history_results(call):
                     os.remove(filename) # Limpiar archivo temporal
 
 
-        # Enviar menú principal después de la acción
-        bot.send_message(
+        # Enviar menú principal después de la acción (por la cola, detrás de los productos)
+        notifier.send_message(
             chat_id,
             "¿Qué más deseas hacer?",
+            priority=PRIORITY_HISTORY,
             reply_markup=create_inline_keyboard()
         )
         # Intentar eliminar el mensaje "Procesando..." si aún existe
@@ -1112,6 +1666,8 @@ def handle_display_history_results(call):
 def return_to_main_menu(call):
     """Vuelve a mostrar el mensaje de bienvenida con el teclado principal."""
     try:
+        waiting_for_filters.pop(call.from_user.id, None)
+        waiting_for_region.pop(call.from_user.id, None)
         welcome_msg = (
             "🛍️ <b>Bot de Alertas Marketplace</b>\n\n"
             "¡Te avisaré de nuevos productos en Facebook Marketplace!\n\n"
@@ -1150,14 +1706,28 @@ def return_to_main_menu(call):
         except Exception as e_fallback:
             logger.error(f"Error en fallback al enviar menú: {e_fallback}")
 
+def load_storage():
+    """Carga alertas e historial. Con SQLite vacío, migra los datos de los JSON si existen."""
+    listing_tracker.load(storage.load_listings(time.time() - listing_tracker.retention))
+    if STORAGE_BACKEND != "json" and storage.is_empty():
+        json_storage = create_json_storage()
+        if json_storage.has_data():
+            logger.info(f"Base de datos {DB_FILE} vacía. Migrando alertas e historial desde los archivos JSON...")
+            loaded_user_searches, loaded_product_history = json_storage.load(user_searches, product_history)
+            storage.import_data(loaded_user_searches, loaded_product_history)
+            storage.start()
+            storage.flush()
+            return loaded_user_searches, loaded_product_history
+    return storage.load(user_searches, product_history)
+
 # --- Main execution block ---
 if __name__ == '__main__':
     logger.info("Iniciando Bot de Telegram...")
     logger.info("Verificando cookies...")
-    if not FACEBOOK_COOKIE:
+    if not session_pool:
          logger.warning("FACEBOOK_COOKIE no configurada en .env. El bot puede no funcionar correctamente para Marketplace.")
     else:
-         logger.info("FACEBOOK_COOKIE encontrada. Procediendo.")
+         logger.info(f"{len(session_pool)} sesión(es) de Facebook configuradas. Procediendo.")
 
     """ for user_id in list(user_searches.keys()):
         if 'waiting_for_search' in user_searches[user_id]:
@@ -1165,18 +1735,31 @@ if __name__ == '__main__':
             save_data(user_searches, USER_SEARCHES_FILE, user_searches_lock) """
             
     try:
-        user_searches = load_user_searches(USER_SEARCHES_FILE=USER_SEARCHES_FILE, 
-                                           user_searches=user_searches)
-        
-        product_history = load_product_history(PRODUCT_HISTORY_FILE=PRODUCT_HISTORY_FILE, 
-                                               product_history=product_history, 
-                                               MAX_PRODUCT_HISTORY=MAX_PRODUCT_HISTORY)
+        geocoder.warm_up(GEOCODE_LOCALITIES_FILE)
+        user_searches, product_history = load_storage()
+        notifier.start()
+        digest_buffer.start()
         
         monitor_from_history(user_searches=user_searches, 
-                             active_monitoring_threads=active_monitoring_threads, 
-                             monitor_search=monitor_search)
+                             start_monitoring=start_monitoring)
         
-        bot.infinity_polling()          
+        if BOT_MODE == "webhook":
+            update_dispatcher = UpdateDispatcher(bot.process_new_updates, max_workers=UPDATE_WORKERS)
+            try:
+                run_webhook(bot, update_dispatcher, WEBHOOK_URL, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                            secret_token=WEBHOOK_SECRET_TOKEN)
+            finally:
+                update_dispatcher.shutdown()
+        else:
+            bot.infinity_polling()          
          
     except Exception as e:
-        logger.critical(f"Error crítico en bot.infinity_polling(): {e}")
\ No newline at end of file
+        logger.critical(f"Error crítico recibiendo updates ({BOT_MODE}): {e}")
+    finally:
+        # Primero el monitoreo: sus workers escriben en storage y encolan en el notifier
+        query_scheduler.stop()
+        manual_searches.shutdown(wait=False)
+        geocoder.close()
+        digest_buffer.stop()
+        notifier.stop()
+        storage.close()
\ No newline at end of file
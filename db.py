@@ -0,0 +1,264 @@
+import gc
+import itertools
+import json
+import queue
+import sqlite3
+import threading
+import logging
+from collections import defaultdict
+
+from alert_history import AlertHistory
+from product import products_from_dicts, product_to_json
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS alerts (
+    user_id INTEGER NOT NULL,
+    search_term TEXT NOT NULL,
+    active INTEGER NOT NULL DEFAULT 0,
+    chat_id INTEGER NOT NULL DEFAULT 0,
+    extra TEXT,
+    PRIMARY KEY (user_id, search_term)
+);
+CREATE TABLE IF NOT EXISTS products (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    search_term TEXT NOT NULL,
+    product_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    UNIQUE (user_id, search_term, product_id)
+);
+CREATE INDEX IF NOT EXISTS idx_products_alert_seq ON products (user_id, search_term, seq);
+CREATE TABLE IF NOT EXISTS listings (
+    listing_id TEXT PRIMARY KEY,
+    price_cents INTEGER,
+    currency TEXT,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_listings_last_seen ON listings (last_seen);
+"""
+
+# Cuántas mutaciones como máximo entran en una misma transacción del writer
+WRITER_BATCH_SIZE = 500
+
+
+class SQLiteStorage:
+    """
+    Almacenamiento de alertas e historial en SQLite (modo WAL).
+    Todas las escrituras pasan por una cola que drena un único hilo writer en transacciones por lote,
+    así los handlers y el monitoreo nunca esperan al disco ni compiten por un lock global.
+    """
+
+    def __init__(self, db_path, MAX_PRODUCT_HISTORY):
+        self.db_path = db_path
+        self.max_product_history = MAX_PRODUCT_HISTORY
+        self._queue = queue.Queue()
+        self._writer = None
+        self._init_schema()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+            conn.commit()
+        finally:
+            conn.close()
+
+    # --- API de escritura (encola y vuelve inmediatamente) ---
+
+    def save_alert(self, user_id, search_term, alert_details):
+        extra = {k: v for k, v in alert_details.items() if k not in ('active', 'chat_id')}
+        self._queue.put(("save_alert", (user_id, search_term, int(bool(alert_details.get('active', False))),
+                                        int(alert_details.get('chat_id', 0) or 0),
+                                        json.dumps(extra, ensure_ascii=False) if extra else None)))
+
+    def delete_alert(self, user_id, search_term):
+        self._queue.put(("delete_alert", (user_id, search_term)))
+
+    def add_products(self, user_id, search_term, products):
+        """Agrega productos al historial de la alerta (en el orden en que se hizo appendleft)."""
+        rows = [(user_id, search_term, str(product.get('id')), json.dumps(product, ensure_ascii=False, default=product_to_json))
+                for product in products if product.get('id')]
+        if rows:
+            self._queue.put(("add_products", (user_id, search_term, rows)))
+
+    def save_listings(self, rows):
+        """Guarda el estado de publicaciones: filas (listing_id, price_cents, currency, first_seen, last_seen)."""
+        if rows:
+            self._queue.put(("save_listings", rows))
+
+    def prune_listings(self, before):
+        """Borra el estado de las publicaciones que no se ven desde antes de before (epoch)."""
+        self._queue.put(("prune_listings", (before,)))
+
+    def flush(self, timeout=None):
+        """Espera a que el writer haya escrito todo lo encolado hasta ahora."""
+        if self._writer is None:
+            return
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        done.wait(timeout)
+
+    def close(self):
+        """Escribe lo pendiente y detiene el hilo writer."""
+        if self._writer is None:
+            return
+        self._queue.put(("stop", None))
+        self._writer.join()
+        self._writer = None
+
+    # --- Writer ---
+
+    def start(self):
+        if self._writer is not None:
+            return
+        self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer.start()
+
+    def _writer_loop(self):
+        conn = self._connect()
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < WRITER_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            waiters = []
+            mutations = []
+            for op, args in batch:
+                if op == "flush":
+                    waiters.append(args)
+                elif op == "stop":
+                    running = False
+                else:
+                    mutations.append((op, args))
+            try:
+                self._write(conn, mutations)
+            except Exception as e:
+                # Un lote fallido no se descarta entero: se reintenta operación por operación
+                # y sólo se pierde la que vuelve a fallar
+                logger.exception(f"Error escribiendo lote de {len(mutations)} operaciones en {self.db_path}: {e}. "
+                                 f"Reintentando de a una.")
+                for mutation in mutations:
+                    try:
+                        self._write(conn, [mutation])
+                    except Exception as op_error:
+                        logger.error(f"Operación '{mutation[0]}' descartada: {op_error}")
+            finally:
+                for done in waiters:
+                    done.set()
+        conn.close()
+        logger.info("Hilo writer de la base de datos detenido.")
+
+    def _write(self, conn, mutations):
+        """Aplica las mutaciones en una única transacción (si una falla, no queda ninguna)."""
+        # alerts_to_trim: alertas con productos nuevos en este lote, se recortan a MAX_PRODUCT_HISTORY una sola vez
+        alerts_to_trim = set()
+        with conn:
+            for op, args in mutations:
+                if op == "save_alert":
+                    conn.execute(
+                        "INSERT INTO alerts (user_id, search_term, active, chat_id, extra) VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT(user_id, search_term) DO UPDATE SET active=excluded.active, chat_id=excluded.chat_id, extra=excluded.extra",
+                        args)
+                elif op == "delete_alert":
+                    conn.execute("DELETE FROM alerts WHERE user_id=? AND search_term=?", args)
+                    conn.execute("DELETE FROM products WHERE user_id=? AND search_term=?", args)
+                    alerts_to_trim.discard(args)
+                elif op == "add_products":
+                    user_id, search_term, rows = args
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO products (user_id, search_term, product_id, data) VALUES (?, ?, ?, ?)",
+                        rows)
+                    alerts_to_trim.add((user_id, search_term))
+                elif op == "save_listings":
+                    conn.executemany(
+                        "INSERT INTO listings (listing_id, price_cents, currency, first_seen, last_seen) VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT(listing_id) DO UPDATE SET price_cents=excluded.price_cents, "
+                        "currency=excluded.currency, last_seen=excluded.last_seen",
+                        args)
+                elif op == "prune_listings":
+                    conn.execute("DELETE FROM listings WHERE last_seen < ?", args)
+            for user_id, search_term in alerts_to_trim:
+                conn.execute(
+                    "DELETE FROM products WHERE user_id=? AND search_term=? AND seq <= ("
+                    "SELECT seq FROM products WHERE user_id=? AND search_term=? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                    (user_id, search_term, user_id, search_term, self.max_product_history))
+
+    # --- Carga ---
+
+    def is_empty(self):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT 1 FROM alerts LIMIT 1").fetchone() is None
+        finally:
+            conn.close()
+
+    def load(self, user_searches, product_history):
+        """Carga alertas e historial en las estructuras en memoria del bot y arranca el writer."""
+        conn = self._connect()
+        # La carga crea millones de objetos que sobreviven: el GC cíclico sólo agregaría pasadas inútiles
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            alert_count = 0
+            for user_id, search_term, active, chat_id, extra in conn.execute(
+                    "SELECT user_id, search_term, active, chat_id, extra FROM alerts"):
+                alert_details = json.loads(extra) if extra else {}
+                alert_details['active'] = bool(active)
+                alert_details['chat_id'] = chat_id
+                user_searches[user_id][search_term] = alert_details
+                alert_count += 1
+
+            product_count = 0
+            # Filas ordenadas por alerta y del más reciente al más viejo (mismo orden que en memoria);
+            # cada historial se arma como un único JSON y se parsea de una vez
+            rows = conn.execute("SELECT user_id, search_term, data FROM products "
+                                "ORDER BY user_id, search_term, seq DESC")
+            for (user_id, search_term), alert_rows in itertools.groupby(rows, key=lambda row: (row[0], row[1])):
+                products = json.loads('[' + ','.join(row[2] for row in alert_rows) + ']')
+                if user_id not in product_history:
+                    product_history[user_id] = defaultdict(lambda: AlertHistory(maxlen=self.max_product_history))
+                history = AlertHistory(products_from_dicts(products), maxlen=self.max_product_history)
+                product_history[user_id][search_term] = history
+                product_count += len(history)
+        finally:
+            conn.close()
+            if gc_was_enabled:
+                gc.enable()
+
+        logger.info(f"Cargadas {alert_count} alertas y {product_count} productos de historial desde {self.db_path}")
+        self.start()
+        return user_searches, product_history
+
+    def load_listings(self, since):
+        """Estado de las publicaciones vistas desde since (epoch), para ListingTracker.load."""
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT listing_id, price_cents, currency, first_seen, last_seen FROM listings "
+                                "WHERE last_seen >= ?", (since,)).fetchall()
+        finally:
+            conn.close()
+
+    def import_data(self, user_searches, product_history):
+        """Importa alertas e historial ya cargados en memoria (migración desde los JSON)."""
+        for user_id, alerts_for_user in user_searches.items():
+            for search_term, alert_details in alerts_for_user.items():
+                if search_term == 'waiting_for_search' or not isinstance(alert_details, dict):
+                    continue
+                self.save_alert(user_id, search_term, alert_details)
+        for user_id, searches in product_history.items():
+            for search_term, history in searches.items():
+                # El historial está del más reciente al más viejo; se inserta en orden de appendleft
+                self.add_products(user_id, search_term, list(reversed(history)))
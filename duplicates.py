@@ -0,0 +1,296 @@
+import functools
+import hashlib
+import io
+import re
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+
+try:
+    # Hash perceptual de las fotos (opcional: sin Pillow sólo se comparan títulos, precios y URLs de imagen)
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from filters import normalize_text
+
+logger = logging.getLogger(__name__)
+
+SIMHASH_BITS = 64
+# Títulos a esta distancia de Hamming (de 64 bits) o menos se consideran el mismo texto
+SIMHASH_MAX_DISTANCE = 10
+# Fotos (dHash de 64 bits) a esta distancia o menos se consideran la misma foto
+IMAGE_HASH_MAX_DISTANCE = 6
+NON_ALNUM_PATTERN = re.compile(r'[^a-z0-9]+')
+# "128 gb" y "128gb" son la misma palabra
+NUMBER_UNIT_PATTERN = re.compile(r'\b(\d+) (gb|tb|mb|kg|g|cc|hp|w|hz|mah|lts?|cm|mm|m|pulgadas|pulg)\b')
+# Palabras que no identifican al artículo: conectores y lo que se agrega al republicar
+FILLER_WORDS = frozenset((
+    'a', 'al', 'con', 'de', 'del', 'el', 'en', 'la', 'las', 'lo', 'los', 'para', 'por', 'sin', 'un', 'una', 'y',
+    'vendo', 'venta', 'oferta', 'liquido', 'urgente', 'permuto', 'envio', 'envios', 'gratis', 'impecable',
+    'excelente', 'estado', 'nuevo', 'nueva', 'usado', 'usada', 'oportunidad', 'unico', 'dueno',
+))
+
+
+def _bit_count(value):
+    return bin(value).count('1')
+
+def title_features(title):
+    """
+    Palabras de un título que identifican al artículo (normalizadas, sin relleno) con su peso: las que
+    tienen números (modelo, capacidad, rodado) pesan el doble.
+    """
+    text = NUMBER_UNIT_PATTERN.sub(r'\1\2', NON_ALNUM_PATTERN.sub(' ', normalize_text(title)))
+    return {word: 2 if any(char.isdigit() for char in word) else 1
+            for word in text.split() if word not in FILLER_WORDS}
+
+@functools.lru_cache(maxsize=8192)
+def title_simhash(title):
+    """
+    (SimHash de 64 bits de las palabras del título, conjunto de sus palabras con números).
+    El orden de las palabras no importa y un título con una palabra de más o de menos queda a pocos bits;
+    las palabras con números tienen que coincidir todas ("iPhone 12" no repite a "iPhone 13").
+    None si el título no tiene palabras que sirvan.
+    """
+    features = title_features(title)
+    if not features:
+        return None
+    weights = [0] * SIMHASH_BITS
+    for word, weight in features.items():
+        digest = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=SIMHASH_BITS // 8).digest(), 'big')
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += weight if digest >> bit & 1 else -weight
+    simhash = sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+    return simhash, frozenset(word for word, weight in features.items() if weight > 1)
+
+def title_signature(title):
+    return title_simhash(title) if isinstance(title, str) else None
+
+def image_key(url):
+    """
+    Identidad de una foto de Marketplace: el nombre del archivo en el CDN. La URL completa cambia
+    entre respuestas (firmas y parámetros de tamaño), el archivo no.
+    """
+    if not url:
+        return None
+    return urlsplit(url).path.rsplit('/', 1)[-1] or None
+
+def _bands(max_distance, bits=SIMHASH_BITS):
+    # Dos hashes a distancia <= max_distance coinciden por completo en al menos una de max_distance + 1
+    # franjas (principio del palomar): cada franja es un índice exacto y sólo se comparan sus candidatos
+    count = max_distance + 1
+    bands, start = [], 0
+    for band in range(count):
+        width = bits // count + (1 if band < bits % count else 0)
+        bands.append((start, (1 << width) - 1))
+        start += width
+    return bands
+
+
+class ImageHasher:
+    """
+    dHash de 64 bits de las fotos (requiere Pillow), descargando cada foto una sola vez:
+    el resultado queda en un LRU por image_key(). fetch_image(url) -> bytes.
+    """
+
+    def __init__(self, fetch_image, max_entries=4096):
+        self._fetch_image = fetch_image
+        self.max_entries = max_entries
+        # _hashes: { image_key: hash | None } en orden de uso
+        self._hashes = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def available():
+        return Image is not None
+
+    def hash(self, url):
+        key = image_key(url)
+        if key is None or Image is None:
+            return None
+        with self._lock:
+            if key in self._hashes:
+                self._hashes.move_to_end(key)
+                return self._hashes[key]
+        try:
+            with Image.open(io.BytesIO(self._fetch_image(url))) as image:
+                # 9x8 en escala de grises: cada bit dice si un píxel es más claro que su vecino de la derecha
+                pixels = list(image.convert('L').resize((9, 8)).getdata())
+            value = 0
+            for row in range(8):
+                for column in range(8):
+                    value = value << 1 | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+        except Exception as e:
+            logger.warning(f"No se pudo calcular el hash de la imagen {key}: {e}")
+            value = None
+        with self._lock:
+            self._hashes[key] = value
+            if len(self._hashes) > self.max_entries:
+                self._hashes.popitem(last=False)
+        return value
+
+
+class _Entry:
+    __slots__ = ('listing_id', 'seen_at', 'title_hash', 'title_numbers', 'image_key', 'image_hash', 'price_cents',
+                 'currency')
+
+    def __init__(self, listing_id, seen_at, title_signature, image_key, image_hash, price_cents, currency):
+        self.listing_id = listing_id
+        self.seen_at = seen_at
+        self.title_hash, self.title_numbers = title_signature or (None, None)
+        self.image_key = image_key
+        self.image_hash = image_hash
+        self.price_cents = price_cents
+        self.currency = currency
+
+
+class _AlertIndex:
+    """Publicaciones vistas por una alerta dentro de la ventana, indexadas por franjas de hash y por foto."""
+
+    def __init__(self, title_bands, image_bands):
+        self.ids = set()
+        self.entries = deque()
+        # by_title / by_image: [ ((inicio, máscara) de la franja, { valor de la franja: [entry, ...] }), ... ]
+        self.by_title = [(band, {}) for band in title_bands]
+        self.by_image = [(band, {}) for band in image_bands]
+        # by_image_key: { image_key: [entry, ...] }
+        self.by_image_key = {}
+
+    def _hash_indexes(self, entry):
+        return ((self.by_title, entry.title_hash), (self.by_image, entry.image_hash))
+
+    def add(self, entry):
+        self.ids.add(entry.listing_id)
+        self.entries.append(entry)
+        for index, value in self._hash_indexes(entry):
+            if value is not None:
+                for (start, mask), buckets in index:
+                    buckets.setdefault(value >> start & mask, []).append(entry)
+        if entry.image_key:
+            self.by_image_key.setdefault(entry.image_key, []).append(entry)
+
+    def prune(self, before):
+        while self.entries and self.entries[0].seen_at < before:
+            entry = self.entries.popleft()
+            self.ids.discard(entry.listing_id)
+            for index, value in self._hash_indexes(entry):
+                if value is not None:
+                    for (start, mask), buckets in index:
+                        self._remove(buckets, value >> start & mask, entry)
+            if entry.image_key:
+                self._remove(self.by_image_key, entry.image_key, entry)
+
+    @staticmethod
+    def _remove(index, key, entry):
+        bucket = index.get(key)
+        if bucket is None:
+            return
+        bucket.remove(entry)
+        if not bucket:
+            del index[key]
+
+    @staticmethod
+    def candidates(value, index):
+        if value is None:
+            return
+        for (start, mask), buckets in index:
+            yield from buckets.get(value >> start & mask, ())
+
+
+class DuplicateDetector:
+    """
+    Detecta republicaciones: publicaciones con otro ID (del mismo vendedor o de otro) que repiten una
+    ya vista por la alerta dentro de la ventana. Es duplicado si el precio es el mismo (con una tolerancia
+    en porcentaje, misma moneda) y además coincide la foto (mismo archivo o, con image_hasher, dHash
+    cercano) o el título (SimHash cercano y las mismas palabras con números). Cada alerta tiene su propio índice.
+    """
+
+    def __init__(self, window=72 * 3600, price_tolerance_percent=5, image_hasher=None,
+                 max_title_distance=SIMHASH_MAX_DISTANCE, max_image_distance=IMAGE_HASH_MAX_DISTANCE):
+        self.window = window
+        self.price_tolerance_percent = price_tolerance_percent
+        self.image_hasher = image_hasher
+        self.max_title_distance = max_title_distance
+        self.max_image_distance = max_image_distance
+        self._title_bands = _bands(max_title_distance)
+        self._image_bands = _bands(max_image_distance)
+        # _alerts: { alert_key: _AlertIndex }
+        self._alerts = {}
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def _entry(self, product, now):
+        url = product.get('imagen_url')
+        image_hash = self.image_hasher.hash(url) if self.image_hasher is not None and url else None
+        return _Entry(product.get('id'), now, title_signature(product.get('titulo')), image_key(url), image_hash,
+                      product.get('precio_centavos'), product.get('moneda'))
+
+    def _index(self, alert_key):
+        index = self._alerts.get(alert_key)
+        if index is None:
+            index = self._alerts[alert_key] = _AlertIndex(self._title_bands, self._image_bands)
+        return index
+
+    def _same_price(self, a, b):
+        if a.currency != b.currency:
+            return False
+        if a.price_cents is None or b.price_cents is None:
+            return a.price_cents == b.price_cents
+        return abs(a.price_cents - b.price_cents) * 100 <= max(a.price_cents, b.price_cents) * self.price_tolerance_percent
+
+    def _find(self, index, entry):
+        matches = []
+        if entry.image_key:
+            matches.append(index.by_image_key.get(entry.image_key, ()))
+        matches.append(other for other in index.candidates(entry.title_hash, index.by_title)
+                       if _bit_count(entry.title_hash ^ other.title_hash) <= self.max_title_distance
+                       and entry.title_numbers == other.title_numbers)
+        matches.append(other for other in index.candidates(entry.image_hash, index.by_image)
+                       if _bit_count(entry.image_hash ^ other.image_hash) <= self.max_image_distance)
+        for candidates in matches:
+            for other in candidates:
+                if other.listing_id != entry.listing_id and self._same_price(entry, other):
+                    return other
+        return None
+
+    def add(self, alert_key, products, now=None):
+        """Registra publicaciones ya conocidas por la alerta (línea base), sin buscar duplicados."""
+        now = time.time() if now is None else now
+        entries = [self._entry(product, now) for product in products if product.get('id') is not None]
+        with self._lock:
+            index = self._index(alert_key)
+            index.prune(now - self.window)
+            for entry in entries:
+                if entry.listing_id not in index.ids:
+                    index.add(entry)
+
+    def check(self, alert_key, product, now=None):
+        """
+        ID de la publicación ya vista que esta repite, o None si es nueva. En ambos casos queda registrada:
+        una cadena de republicaciones se sigue detectando mientras cada una caiga dentro de la ventana.
+        """
+        now = time.time() if now is None else now
+        entry = self._entry(product, now)
+        with self._lock:
+            index = self._index(alert_key)
+            index.prune(now - self.window)
+            if entry.listing_id in index.ids:
+                return None
+            original = self._find(index, entry)
+            if entry.listing_id is not None:
+                index.add(entry)
+            if original is None:
+                return None
+            self._suppressed += 1
+            return original.listing_id
+
+    def forget(self, alert_key):
+        with self._lock:
+            self._alerts.pop(alert_key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"alerts": len(self._alerts), "listings": sum(len(index.entries) for index in self._alerts.values()),
+                    "suppressed": self._suppressed}
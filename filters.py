@@ -0,0 +1,187 @@
+import functools
+import json
+import re
+import logging
+from unidecode import unidecode
+
+from prices import parse_formatted_price, CENTS, CURRENCY_SYMBOLS, DEFAULT_CURRENCY
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text):
+    """Minúsculas, sin tildes y con espacios simples: lo que se compara contra los filtros."""
+    return unidecode(' '.join(str(text or '').lower().split()))
+
+@functools.lru_cache(maxsize=8192)
+def _normalized_title(title):
+    # Las alertas de un mismo grupo filtran los mismos títulos: se normalizan una sola vez
+    return normalize_text(title)
+
+def parse_price(text):
+    """Monto en unidades enteras de un precio escrito por el usuario ("50000", "$ 150.000"). None si no tiene número."""
+    cents, _ = parse_formatted_price(text)
+    return None if cents is None else cents // CENTS
+
+def _keyword_pattern(keywords):
+    # Con search() alcanza con que aparezca una: la alternancia prueba todas en cada posición.
+    # Bordes con lookarounds y no \b: "c++" o ".net" empiezan o terminan en algo que no es letra
+    return re.compile(r'(?<!\w)(?:' + '|'.join(sorted(re.escape(keyword) for keyword in keywords)) + r')(?!\w)')
+
+
+class AlertFilter:
+    """
+    Filtro de una alerta, compilado una vez: rango de precio (en la moneda de la alerta), palabras que
+    deben estar (todas), palabras excluidas (ninguna) y ciudades permitidas. Cada incluida se busca por
+    separado y las excluidas con una sola regex: una palabra puede contener a otra ("iphone 13" e "iphone")
+    y en una alternancia compartida la más larga taparía a la más corta.
+    """
+
+    def __init__(self, min_price=None, max_price=None, include=(), exclude=(), cities=(), currency=None):
+        self.min_price = min_price
+        self.max_price = max_price
+        self.currency = currency or DEFAULT_CURRENCY
+        self.include = frozenset(normalize_text(word) for word in include if normalize_text(word))
+        self.exclude = frozenset(normalize_text(word) for word in exclude if normalize_text(word))
+        self.cities = frozenset(normalize_text(city) for city in cities if normalize_text(city))
+        self._include_patterns = tuple(_keyword_pattern((word,)) for word in sorted(self.include))
+        self._exclude_pattern = _keyword_pattern(self.exclude) if self.exclude else None
+
+    @classmethod
+    def from_spec(cls, spec):
+        spec = spec or {}
+        return cls(spec.get('min_price'), spec.get('max_price'), spec.get('include', ()),
+                   spec.get('exclude', ()), spec.get('cities', ()), spec.get('currency'))
+
+    def to_spec(self):
+        """Dict para guardar en los detalles de la alerta (sólo los campos usados)."""
+        spec = {'min_price': self.min_price, 'max_price': self.max_price, 'include': sorted(self.include),
+                'exclude': sorted(self.exclude), 'cities': sorted(self.cities),
+                'currency': self.currency if self.currency != DEFAULT_CURRENCY else None}
+        return {key: value for key, value in spec.items() if value not in (None, [])}
+
+    def __bool__(self):
+        return bool(self.min_price is not None or self.max_price is not None or self.include or self.exclude
+                    or self.cities)
+
+    def price_bounds(self):
+        """
+        (mínimo, máximo) en unidades, None donde no hay cota. GraphQL filtra en la moneda local:
+        un rango en otra moneda no se le pide (lo filtra matches()).
+        """
+        if self.currency != DEFAULT_CURRENCY:
+            return (None, None)
+        return (self.min_price, self.max_price)
+
+    def matches(self, product):
+        if self.min_price is not None or self.max_price is not None:
+            cents, currency = product.get('precio_centavos'), product.get('moneda')
+            if cents is None:
+                # Productos sin el campo numérico (dicts viejos): el parser está cacheado por formato
+                cents, currency = parse_formatted_price(product.get('precio'))
+            if cents is None:
+                return False
+            # Sin conversión entre monedas: un precio en otra moneda no se puede comparar con el rango
+            if (currency or DEFAULT_CURRENCY) != self.currency:
+                return False
+            if self.min_price is not None and cents < self.min_price * CENTS:
+                return False
+            if self.max_price is not None and cents > self.max_price * CENTS:
+                return False
+        if self.cities and normalize_text(product.get('ciudad')) not in self.cities:
+            return False
+        if self.include or self.exclude:
+            title = _normalized_title(product.get('titulo') or '')
+            if self._exclude_pattern is not None and self._exclude_pattern.search(title):
+                return False
+            if not all(pattern.search(title) for pattern in self._include_patterns):
+                return False
+        return True
+
+    def apply(self, products):
+        """Los productos que pasan el filtro (la misma lista si no hay filtro)."""
+        if not self or products is None:
+            return products
+        return [product for product in products if self.matches(product)]
+
+    def describe(self):
+        """Texto para mostrarle al usuario los filtros activos."""
+        parts = []
+        if self.min_price is not None or self.max_price is not None:
+            symbol = CURRENCY_SYMBOLS.get(self.currency, self.currency)
+            low = f"{symbol}{self.min_price:,}" if self.min_price is not None else "0"
+            high = f"{symbol}{self.max_price:,}" if self.max_price is not None else "sin tope"
+            parts.append(f"💲 Precio: {low} - {high}")
+        if self.include:
+            parts.append(f"➕ Incluir: {', '.join(sorted(self.include))}")
+        if self.exclude:
+            parts.append(f"➖ Excluir: {', '.join(sorted(self.exclude))}")
+        if self.cities:
+            parts.append(f"📍 Ciudades: {', '.join(sorted(self.cities))}")
+        return '\n'.join(parts) if parts else "Sin filtros"
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(spec_json):
+    return AlertFilter.from_spec(json.loads(spec_json))
+
+def get_alert_filter(alert_details):
+    """AlertFilter de los detalles de una alerta (compilado una vez por especificación distinta)."""
+    spec = (alert_details or {}).get('filters') if isinstance(alert_details, dict) else None
+    return _compile(json.dumps(spec or {}, sort_keys=True))
+
+def parse_filter_text(text):
+    """
+    Lee los filtros escritos por el usuario, una línea (o ';') por filtro:
+        precio 1000-50000      (o "precio -50000", "precio 1000-", "precio US$100-500")
+        incluir: 128gb, negro
+        excluir: roto, repuesto
+        ciudad: Rosario, Funes
+    Devuelve un AlertFilter; ValueError con un mensaje para el usuario si algo no se entiende.
+    """
+    spec = {}
+    for line in re.split(r'[;\n]', text):
+        line = line.strip()
+        if not line:
+            continue
+        key, _, value = line.partition(':') if ':' in line else line.partition(' ')
+        key = normalize_text(key)
+        values = [item.strip() for item in value.split(',') if item.strip()]
+        if key in ('precio', 'price'):
+            low, separator, high = value.replace(' ', '').partition('-')
+            if not separator:
+                raise ValueError("El precio va como rango: 'precio 1000-50000', 'precio -50000' o 'precio 1000-'.")
+            spec['min_price'] = parse_price(low) if low else None
+            spec['max_price'] = parse_price(high) if high else None
+            if (low and spec['min_price'] is None) or (high and spec['max_price'] is None):
+                raise ValueError(f"No entiendo el precio '{value.strip()}'.")
+            currencies = {currency for _, currency in (parse_formatted_price(low), parse_formatted_price(high)) if currency}
+            if len(currencies) > 1:
+                raise ValueError("El rango de precio tiene que estar en una sola moneda.")
+            spec['currency'] = currencies.pop() if currencies else None
+            if spec['min_price'] is not None and spec['max_price'] is not None and spec['min_price'] > spec['max_price']:
+                raise ValueError("El precio mínimo es mayor que el máximo.")
+        elif key in ('incluir', 'include'):
+            spec['include'] = values
+        elif key in ('excluir', 'exclude'):
+            spec['exclude'] = values
+        elif key in ('ciudad', 'ciudades', 'city'):
+            spec['cities'] = values
+        else:
+            raise ValueError(f"No entiendo '{line}'. Usa precio, incluir, excluir o ciudad.")
+    return AlertFilter.from_spec(spec)
+
+def merge_price_bounds(bounds):
+    """
+    Cotas de precio que cubren a todas las alertas de un grupo (la más baja de las mínimas y la más
+    alta de las máximas; None si alguna no tiene cota de ese lado). Es lo que se le pide a GraphQL:
+    cada alerta después filtra su propio rango.
+    """
+    bounds = list(bounds)
+    if not bounds:
+        return (None, None)
+    lows = [low for low, _ in bounds]
+    highs = [high for _, high in bounds]
+    low = None if any(value is None for value in lows) else min(lows)
+    high = None if any(value is None for value in highs) else max(highs)
+    return (low, high)
@@ -0,0 +1,54 @@
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+# Margen que se suma al radio de un círculo que cubre a otros (la fusión usa una aproximación plana)
+COVER_MARGIN = 1.01
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Distancia en km sobre la esfera entre dos puntos (grados)."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def make_region(latitude, longitude, radius, name=None):
+    """Región de búsqueda: círculo {'latitude', 'longitude', 'radius'} (radio en km) y un nombre para mostrar."""
+    region = {"latitude": float(latitude), "longitude": float(longitude), "radius": float(radius)}
+    if name:
+        region["name"] = name
+    return region
+
+def region_distance_km(a, b):
+    """Distancia entre los centros de dos regiones."""
+    return haversine_km(a["latitude"], a["longitude"], b["latitude"], b["longitude"])
+
+def regions_overlap(a, b):
+    return region_distance_km(a, b) < float(a["radius"]) + float(b["radius"])
+
+def _merge_two(a, b):
+    # Círculo que cubre a y b: si uno contiene al otro, el mayor; si no, el que toca a ambos por fuera
+    distance = region_distance_km(a, b)
+    radius_a, radius_b = float(a["radius"]), float(b["radius"])
+    if distance + radius_b <= radius_a:
+        return a
+    if distance + radius_a <= radius_b:
+        return b
+    radius = (distance + radius_a + radius_b) / 2
+    # Centro sobre la recta entre ambos centros (aproximación plana, suficiente para unos cientos de km)
+    t = (radius - radius_a) / distance
+    return make_region(a["latitude"] + t * (b["latitude"] - a["latitude"]),
+                       a["longitude"] + t * (b["longitude"] - a["longitude"]),
+                       round(radius * COVER_MARGIN, 1))
+
+def covering_region(regions):
+    """Un círculo que contiene a todas las regiones (no necesariamente el mínimo)."""
+    regions = list(regions)
+    if not regions:
+        return None
+    covering = regions[0]
+    for region in regions[1:]:
+        covering = _merge_two(covering, region)
+    return covering
+
+def within_region(latitude, longitude, region):
+    return haversine_km(latitude, longitude, region["latitude"], region["longitude"]) <= float(region["radius"])
@@ -0,0 +1,250 @@
+import csv
+import os
+import queue
+import sqlite3
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+from geopy.geocoders import Nominatim
+from geopy.exc import GeopyError
+
+from filters import normalize_text
+
+logger = logging.getLogger(__name__)
+
+GEOCODER_USER_AGENT = "marketplace-alerts-telegram-bot"
+# Política de uso de Nominatim: como mucho una petición por segundo
+NOMINATIM_MIN_INTERVAL = 1.0
+# Tras un error de red no se vuelve a consultar Nominatim por este tiempo (sólo caché y dataset)
+NETWORK_RETRY_SECONDS = 300
+# Localidades de Argentina incluidas en el repo (mismas columnas que el CSV de localidades de Georef,
+# https://datosgobar.github.io/georef-ar-api/: se puede reemplazar por la versión completa)
+BUNDLED_LOCALITIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "localidades_ar.csv")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS places (
+    key TEXT PRIMARY KEY,
+    latitude REAL,
+    longitude REAL,
+    address TEXT,
+    source TEXT NOT NULL,
+    updated REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Lugar que todavía no está en la memoria (distinto de None, que es "no existe")
+_MISSING = object()
+
+
+class Geocoder:
+    """
+    Nombre de lugar -> (latitud, longitud, nombre completo).
+    Los resultados (también los "no encontrado") quedan en una tabla SQLite, precargada con un dataset
+    de localidades (warm_up), y los nombres más usados en un LRU en memoria: ubicar la ciudad de una
+    publicación es un acceso a un dict. Lo que no está en ningún lado se consulta a Nominatim (geopy),
+    salvo en modo offline o durante NETWORK_RETRY_SECONDS después de un error de red.
+    geocode() bloquea (lo que escribe el usuario); locate() nunca bloquea: si el lugar no se conoce
+    devuelve None y lo busca en segundo plano para la próxima vez.
+    """
+
+    def __init__(self, cache_file, country=None, offline=False, memory_size=4096,
+                 user_agent=GEOCODER_USER_AGENT, timeout=10):
+        self.country = country
+        self.offline = offline
+        self.memory_size = memory_size
+        self._conn = sqlite3.connect(cache_file, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        self._db_lock = threading.Lock()
+        # _memory: { nombre tal como llega: (lat, lon, nombre completo) | None } en orden de uso (LRU)
+        self._memory = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._geolocator = None if offline else Nominatim(user_agent=user_agent, timeout=timeout)
+        self._request_lock = threading.Lock()
+        self._last_request = 0.0
+        self._network_retry_at = 0.0
+        # Búsquedas en segundo plano de locate(): una cola y un único hilo (Nominatim no admite ráfagas)
+        self._pending = queue.Queue()
+        self._queued = set()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    # --- Dataset de localidades ---
+
+    def warm_up(self, localities_file=BUNDLED_LOCALITIES_FILE):
+        """
+        Carga un CSV de localidades (columnas nombre, provincia_nombre, centroide_lat, centroide_lon)
+        en la caché, en una sola transacción. Cada localidad queda como "nombre" y "nombre, provincia";
+        si el nombre se repite en varias provincias, el "nombre" solo es la primera del archivo.
+        No vuelve a leer el archivo si no cambió desde la última carga. Devuelve cuántos nombres cargó.
+        """
+        try:
+            stat = os.stat(localities_file)
+        except OSError as e:
+            logger.warning(f"No se pudo leer el dataset de localidades {localities_file}: {e}")
+            return 0
+        signature = f"{os.path.abspath(localities_file)}:{stat.st_size}:{int(stat.st_mtime)}"
+        with self._db_lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'localities'").fetchone()
+        if row and row[0] == signature:
+            return 0
+
+        now = time.time()
+        # places: { nombre normalizado: fila }; "nombre" se queda con la primera, "nombre, provincia" es única
+        places = {}
+        with open(localities_file, newline='', encoding='utf-8') as f:
+            for record in csv.DictReader(f):
+                try:
+                    latitude, longitude = float(record['centroide_lat']), float(record['centroide_lon'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                name, province = record.get('nombre', '').strip(), record.get('provincia_nombre', '').strip()
+                if not name:
+                    continue
+                address = f"{name}, {province}" if province else name
+                row = (latitude, longitude, address, "dataset", now)
+                places.setdefault(normalize_text(name), row)
+                if province:
+                    places[normalize_text(address)] = row
+        with self._db_lock:
+            with self._conn:
+                # El dataset tiene prioridad sobre lo que haya respondido Nominatim para el mismo nombre
+                self._conn.execute("DELETE FROM places WHERE source = 'dataset'")
+                self._conn.executemany("INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?, ?, ?)",
+                                       [(key, *row) for key, row in places.items()])
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('localities', ?)", (signature,))
+        with self._lock:
+            self._memory.clear()
+        logger.info(f"Dataset de localidades cargado: {len(places)} nombres desde {localities_file}")
+        return len(places)
+
+    # --- Caché ---
+
+    def _remember(self, name, result):
+        with self._lock:
+            self._memory[name] = result
+            self._memory.move_to_end(name)
+            if len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _recall(self, name):
+        with self._lock:
+            result = self._memory.get(name, _MISSING)
+            if result is _MISSING:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._memory.move_to_end(name)
+            return result
+
+    def _load(self, key):
+        """(lat, lon, nombre completo), None si se sabe que no existe, _MISSING si nunca se buscó."""
+        with self._db_lock:
+            row = self._conn.execute("SELECT latitude, longitude, address FROM places WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return _MISSING
+        return row if row[0] is not None else None
+
+    def _store(self, key, result):
+        latitude, longitude, address = result if result else (None, None, None)
+        with self._db_lock:
+            with self._conn:
+                self._conn.execute("INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?, 'nominatim', ?)",
+                                   (key, latitude, longitude, address, time.time()))
+
+    # --- Consultas ---
+
+    def _network_available(self):
+        return not self.offline and time.monotonic() >= self._network_retry_at
+
+    def _query(self, name):
+        # Sin país explícito ("Córdoba" en vez de "Córdoba, Argentina") se busca dentro del país configurado
+        return f"{name}, {self.country}" if self.country and ',' not in name else name
+
+    def geocode(self, name):
+        """
+        (lat, lon, nombre completo) de un lugar, o None si no existe (o no se conoce, en modo offline).
+        GeopyError si hay que consultar Nominatim y no hay red.
+        """
+        key = normalize_text(name)
+        if not key:
+            return None
+        cached = self._load(key)
+        if cached is not _MISSING:
+            return cached
+        if self.offline:
+            return None
+        if not self._network_available():
+            raise GeopyError("Nominatim no disponible (error de red reciente)")
+        with self._request_lock:
+            wait = self._last_request + NOMINATIM_MIN_INTERVAL - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                location = self._geolocator.geocode(self._query(name.strip()), language="es")
+            except GeopyError:
+                self._network_retry_at = time.monotonic() + NETWORK_RETRY_SECONDS
+                raise
+            finally:
+                self._last_request = time.monotonic()
+        result = (location.latitude, location.longitude, location.address) if location else None
+        self._store(key, result)
+        return result
+
+    def locate(self, name):
+        """(lat, lon) de un lugar conocido; si no se conoce, None (y se busca en segundo plano si hay red)."""
+        result = self._recall(name)
+        if result is _MISSING:
+            key = normalize_text(name)
+            result = self._load(key) if key else None
+            if result is _MISSING:
+                if self._network_available():
+                    self._enqueue(key, name)
+                    return None
+                if not self.offline:
+                    # Sin red por un rato: no se recuerda, se vuelve a intentar cuando vuelva
+                    return None
+                result = None
+            self._remember(name, result)
+        return (result[0], result[1]) if result else None
+
+    def _enqueue(self, key, name):
+        with self._lock:
+            if key in self._queued:
+                return
+            self._queued.add(key)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work, name="geocoder", daemon=True)
+                self._worker.start()
+        self._pending.put((key, name))
+
+    def _work(self):
+        while True:
+            key, name = self._pending.get()
+            try:
+                if self._network_available():
+                    self.geocode(name)
+            except GeopyError as e:
+                logger.warning(f"No se pudo geocodificar '{name}': {e}. Sin consultas a Nominatim por {NETWORK_RETRY_SECONDS} s.")
+            except Exception as e:
+                logger.exception(f"Error inesperado geocodificando '{name}': {e}")
+            finally:
+                with self._lock:
+                    self._queued.discard(key)
+
+    def stats(self):
+        with self._lock:
+            return {"memory": len(self._memory), "hits": self._hits, "misses": self._misses,
+                    "pending": len(self._queued)}
+
+    def close(self):
+        with self._db_lock:
+            self._conn.close()
@@ -1,7 +1,20 @@
 import html as html_lib
 
-def generate_html(products, search_term):
-    """Genera un archivo HTML con los productos."""
+# Orden en el HTML: como vienen (más recientes primero) o por precio
+SORT_OPTIONS = {"recientes": "Más recientes", "precio_asc": "Menor precio", "precio_desc": "Mayor precio"}
+
+def sort_products_by_price(products, descending=False):
+    """Ordena por el monto en centavos; los que no tienen precio numérico van al final."""
+    priced = [product for product in products if product.get('precio_centavos') is not None]
+    unpriced = [product for product in products if product.get('precio_centavos') is None]
+    priced.sort(key=lambda product: product.get('precio_centavos'), reverse=descending)
+    return priced + unpriced
+
+def generate_html(products, search_term, sort_by="recientes"):
+    """
+    Genera un archivo HTML con los productos. sort_by es el orden inicial (ver SORT_OPTIONS);
+    el selector de la página reordena sin volver a pedir nada al bot.
+    """
     # Usar html_lib.escape para seguridad
     safe_search_term = html_lib.escape(search_term)
     html_content = f"""<!DOCTYPE html>
@@ -31,6 +44,7 @@ def generate_html(products, search_term):
         a:hover {{ text-decoration: underline; }}
         h1 {{ color: #333; border-bottom: 2px solid #1877f2; padding-bottom: 10px; }}
         p {{ margin: 0 0 10px 0; }}
+        .sort {{ margin-bottom: 15px; }}
     </style>
 </head>
 <body>
@@ -40,6 +54,16 @@ def generate_html(products, search_term):
     if not products:
         html_content += "<p>No se encontraron productos recientes para esta búsqueda.</p>"
     else:
+        # data-index guarda el orden original para poder volver a "Más recientes"
+        recency = {id(product): index for index, product in enumerate(products)}
+        if sort_by in ("precio_asc", "precio_desc"):
+            products = sort_products_by_price(products, descending=sort_by == "precio_desc")
+        options = "".join(f'<option value="{value}"{" selected" if value == sort_by else ""}>{label}</option>'
+                          for value, label in SORT_OPTIONS.items())
+        html_content += f"""
+    <div class="sort">Ordenar por: <select id="sort" onchange="sortProducts(this.value)">{options}</select></div>
+    <div id="products">
+"""
         for product in products:
             # Usar .get() con valores por defecto por si falta algún campo
             title = html_lib.escape(product.get('titulo', 'Sin título'))
@@ -47,9 +71,10 @@ def generate_html(products, search_term):
             url = html_lib.escape(product.get('url', '#'))
             image_url = html_lib.escape(product.get('imagen_url', ''))
             city = html_lib.escape(product.get('ciudad', 'Ubicación desconocida'))
+            cents = product.get('precio_centavos')
 
             html_content += f"""
-    <div class="product">
+    <div class="product" data-index="{recency[id(product)]}" data-price="{'' if cents is None else cents}">
         {"<img src='{image_url}' alt='Imagen del producto'>" if image_url else ""}
         <div class="product-info">
             <p class="title"><a href="{url}" target="_blank">{title}</a></p>
@@ -59,6 +84,25 @@ def generate_html(products, search_term):
     </div>
 """
 
+        html_content += """
+    </div>
+    <script>
+        // Reordena las tarjetas con el monto numérico (data-price); las que no tienen precio quedan al final
+        function sortProducts(order) {
+            const container = document.getElementById("products");
+            const cards = Array.from(container.children);
+            const price = card => card.dataset.price === "" ? null : Number(card.dataset.price);
+            cards.sort((a, b) => {
+                if (order === "recientes") return a.dataset.index - b.dataset.index;
+                const pa = price(a), pb = price(b);
+                if (pa === null || pb === null) return (pa === null) - (pb === null);
+                return order === "precio_asc" ? pa - pb : pb - pa;
+            });
+            cards.forEach(card => container.appendChild(card));
+        }
+    </script>
+"""
+
     html_content += """
 </body>
 </html>
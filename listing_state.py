@@ -0,0 +1,150 @@
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Tipos de evento de una publicación ya conocida
+PRICE_DROP = "price_drop"
+BACK_ONLINE = "back_online"
+
+
+class ListingState:
+    """Lo que se sabe de una publicación: último precio, cuándo se vio por primera y por última vez."""
+
+    __slots__ = ('price_cents', 'currency', 'first_seen', 'last_seen', 'saved_seen')
+
+    def __init__(self, price_cents, currency, first_seen, last_seen):
+        self.price_cents = price_cents
+        self.currency = currency
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        # last_seen tal como quedó guardado (se persiste cada tanto, no en cada ciclo)
+        self.saved_seen = last_seen
+
+    def row(self, listing_id):
+        return (listing_id, self.price_cents, self.currency, self.first_seen, self.last_seen)
+
+
+class ListingEvent:
+    """Cambio detectado en un ciclo: bajó el precio o volvió a aparecer tras un tiempo sin verse."""
+
+    __slots__ = ('kind', 'old_price_cents', 'absent_seconds')
+
+    def __init__(self, kind, old_price_cents=None, absent_seconds=0.0):
+        self.kind = kind
+        self.old_price_cents = old_price_cents
+        self.absent_seconds = absent_seconds
+
+    def __repr__(self):
+        return f"ListingEvent({self.kind!r}, old_price_cents={self.old_price_cents!r})"
+
+
+class PollResult(list):
+    """
+    Productos de un ciclo de un grupo de búsqueda, con los eventos detectados ({ listing_id: ListingEvent })
+    y la región que se pidió (puede cubrir las de varias alertas).
+    """
+
+    def __init__(self, products, events, region=None):
+        super().__init__(products)
+        self.events = events
+        self.region = region
+
+
+class ListingTracker:
+    """
+    Estado de cada publicación vista, indexado por ID y compartido por todas las alertas.
+    observe() se llama una vez por fetch de grupo: compara cada resultado con su estado en O(1),
+    devuelve los eventos y manda los cambios a guardar en un solo lote (save_rows(rows)).
+    """
+
+    def __init__(self, save_rows=None, delete_before=None, min_drop_percent=5, relist_after=24 * 3600,
+                 retention=30 * 24 * 3600, persist_every=600):
+        self._save_rows = save_rows
+        self._delete_before = delete_before
+        self.min_drop_percent = min_drop_percent
+        self.relist_after = relist_after
+        self.retention = retention
+        self.persist_every = persist_every
+        # _states: { listing_id: ListingState }
+        self._states = {}
+        self._next_prune = 0.0
+        self._events = 0
+        self._lock = threading.Lock()
+
+    def load(self, rows):
+        """Carga filas (listing_id, price_cents, currency, first_seen, last_seen) guardadas."""
+        with self._lock:
+            for listing_id, price_cents, currency, first_seen, last_seen in rows:
+                self._states[listing_id] = ListingState(price_cents, currency, first_seen, last_seen)
+        logger.info(f"Estado de {len(self._states)} publicaciones cargado.")
+
+    def get(self, listing_id):
+        with self._lock:
+            return self._states.get(listing_id)
+
+    def observe(self, products, now=None):
+        """Actualiza el estado con los resultados de un ciclo y devuelve { listing_id: ListingEvent }."""
+        now = time.time() if now is None else now
+        events = {}
+        rows = []
+        with self._lock:
+            for product in products:
+                listing_id = product.id
+                if listing_id is None:
+                    continue
+                price_cents = product.precio_centavos
+                state = self._states.get(listing_id)
+                if state is None:
+                    state = ListingState(price_cents, product.moneda, now, now)
+                    self._states[listing_id] = state
+                    rows.append(state.row(listing_id))
+                    continue
+
+                event = self._compare(state, price_cents, product.moneda, now)
+                if event is not None:
+                    events[listing_id] = event
+                changed = price_cents != state.price_cents or product.moneda != state.currency
+                state.price_cents = price_cents
+                state.currency = product.moneda
+                state.last_seen = now
+                if changed or event is not None or now - state.saved_seen >= self.persist_every:
+                    state.saved_seen = now
+                    rows.append(state.row(listing_id))
+            self._events += len(events)
+            prune = now >= self._next_prune
+            if prune:
+                self._next_prune = now + 3600
+        if rows and self._save_rows is not None:
+            self._save_rows(rows)
+        if prune:
+            self.prune(now)
+        return events
+
+    def _compare(self, state, price_cents, currency, now):
+        # Requiere self._lock
+        absent_seconds = now - state.last_seen
+        if absent_seconds >= self.relist_after:
+            return ListingEvent(BACK_ONLINE, state.price_cents, absent_seconds)
+        if (price_cents is not None and state.price_cents and currency == state.currency
+                and price_cents < state.price_cents
+                and (state.price_cents - price_cents) * 100 >= state.price_cents * self.min_drop_percent):
+            return ListingEvent(PRICE_DROP, state.price_cents)
+        return None
+
+    def prune(self, now=None):
+        """Olvida las publicaciones que no se ven hace más de retention segundos."""
+        before = (time.time() if now is None else now) - self.retention
+        with self._lock:
+            stale = [listing_id for listing_id, state in self._states.items() if state.last_seen < before]
+            for listing_id in stale:
+                del self._states[listing_id]
+        if stale:
+            logger.info(f"Olvidando {len(stale)} publicaciones sin ver desde hace más de {self.retention // 86400:.0f} días.")
+        if self._delete_before is not None:
+            self._delete_before(before)
+
+    def stats(self):
+        with self._lock:
+            return {"listings": len(self._states), "events": self._events}
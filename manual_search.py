@@ -0,0 +1,58 @@
+import threading
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from scheduler import normalize_query, region_key
+
+logger = logging.getLogger(__name__)
+
+
+class ManualSearchPool:
+    """
+    Búsquedas manuales ("Buscar Ahora") en un pool de hilos propio, fuera de los handlers de Telegram.
+    Si varios usuarios piden la misma búsqueda (consulta normalizada, región y cotas de precio) mientras
+    una igual está en curso, se suman a ese fetch en vez de hacer otro.
+    """
+
+    def __init__(self, fetch_products, max_workers=4):
+        # fetch_products(search_term, region, price_bounds) -> list | None
+        self._fetch_products = fetch_products
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="search-now")
+        # _in_flight: { (query, region_key, price_bounds): Future }
+        self._in_flight = {}
+        self._submitted = 0
+        self._coalesced = 0
+        self._lock = threading.Lock()
+
+    def submit(self, search_term, region, price_bounds=(None, None)):
+        """Devuelve un Future con la lista de productos (o None si la búsqueda falló)."""
+        key = (normalize_query(search_term), region_key(region), tuple(price_bounds))
+        with self._lock:
+            self._submitted += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self._coalesced += 1
+                logger.info(f"Búsqueda manual '{key[0]}' ya en curso: se comparte el resultado.")
+                return future
+            future = Future()
+            self._in_flight[key] = future
+        self._executor.submit(self._run, key, future, search_term, region, tuple(price_bounds))
+        return future
+
+    def _run(self, key, future, search_term, region, price_bounds):
+        try:
+            products = self._fetch_products(search_term, region, price_bounds)
+        except Exception as e:
+            logger.exception(f"Error en la búsqueda manual de '{search_term}': {e}")
+            products = None
+        # Sale de _in_flight antes de resolverse: un pedido posterior hace una búsqueda nueva
+        with self._lock:
+            self._in_flight.pop(key, None)
+        future.set_result(products)
+
+    def stats(self):
+        with self._lock:
+            return {"submitted": self._submitted, "coalesced": self._coalesced, "in_flight": len(self._in_flight)}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -1,49 +1,184 @@
+import asyncio
+import http.cookiejar
 import json
+import re
+import threading
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    # Parseo incremental de las respuestas de GraphQL (opcional: sin ijson se parsea el JSON completo)
+    import ijson
+except ImportError:
+    ijson = None
+
+from product import make_product, DEFAULT_CITY
+from prices import parse_formatted_price, CENTS
+from rate_limit import RateLimiter, BREAKER_STATUS_CODES
+from session_pool import MarketplaceSession, SessionPool
 
 DEFAULT_REQUEST_TIMEOUT = 30
+DEFAULT_GRAPHQL_URL = "https://www.facebook.com/api/graphql/"
+GRAPHQL_URL = DEFAULT_GRAPHQL_URL
+# Conexiones keep-alive por defecto hacia facebook.com (ver configure_http_pool)
+DEFAULT_POOL_SIZE = 10
+# Parsear las respuestas a medida que llegan (sólo con ijson instalado)
+STREAMING_PARSE = ijson is not None
+JSON_PARSE_ERRORS = (json.JSONDecodeError, ijson.JSONError) if ijson is not None else (json.JSONDecodeError,)
+# Publicaciones por página de resultados (lo que pide la web de Marketplace)
+PAGE_SIZE = 24
+# Cotas de precio por defecto de la web (en centavos): sin filtro
+PRICE_LOWER_BOUND = 0
+PRICE_UPPER_BOUND = 214748364700
+
+# --- Encabezados (Headers) fijos: 'cookie' y 'referer' se agregan en cada petición ---
+STATIC_HEADERS = {
+    'accept': '*/*',
+    'accept-language': 'es-ES,es;q=0.6',
+    'cache-control': 'no-cache',
+    'content-type': 'application/x-www-form-urlencoded',
+    'origin': 'https://www.facebook.com',
+    'pragma': 'no-cache',
+    'priority': 'u=1, i',
+    'sec-ch-ua': '"Brave";v="135", "Not-A.Brand";v="8", "Chromium";v="135"',
+    'sec-ch-ua-full-version-list': '"Brave";v="135.0.0.0", "Not-A.Brand";v="8.0.0.0", "Chromium";v="135.0.0.0"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Windows"',
+    'sec-ch-ua-platform-version': '"10.0.0"',
+    'sec-fetch-dest': 'empty',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-site': 'same-origin',
+    'sec-gpc': '1',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36',
+    'x-asbd-id': '359341',
+    'x-fb-friendly-name': 'CometMarketplaceSearchContentPaginationQuery',
+    'x-fb-lsd': 'AVqOd7icdFk',
+}
+
+# --- Payload (Datos del Formulario) sin 'variables' ---
+STATIC_PAYLOAD = {
+    'av': '0',
+    '__user': '0',
+    '__a': '1',
+    '__req': 'f',
+    '__hs': '20200.HYP:comet_loggedout_pkg.2.1...0', 
+    'dpr': '1',
+    '__ccg': 'EXCELLENT',
+    '__rev': '1022128419', 
+    '__s': 'gcqwir:m2h11o:eb9hn4', 
+    '__hsi': '7496285990794582045', 
+    '__dyn': '7xeUmwlEnwn8K2Wmh0no6u5U4e1ZyUW3q32360CEbo19oe8hw2nVE4W0qa0FE2awpUO0n24oaEd82lwv89k2C1Fwc60D85m1mzXw8W58jwGzE6G1iwJK14xm0zK5o4q0Gpo8o1o8bUGdw46wbS1LwTwNwLwFg2Xwr86C13G1-w8eEb8uwm85K0UE62', 
+    '__csr': 'gjYQiIAldf9YyGG_-sxu_jylLHBy95WEwCq9hVFUG6pBiG9y9XnCDACAy8nCxyqezGguyppA9Ury98N4CyryEjxm7F-qE8FpEepoy7oO1wDyE4ep0Lxq78hw8G01qBw0NYLw4kw1jC00gL66808jE0PkE0KG0PS4oB03cU3Qw7Iw0HPwl822w0Myweq08iqxx1JiFU0pmw0Kiw3RU0k9w1LLw2SE1380knw3J41aQ0afw2VoeEcUdonw6Vw', 
+    '__comet_req': '15',
+    'lsd': 'AVqOd7icdFk', 
+    'jazoest': '2979', 
+    '__spin_r': '1022128419', 
+    '__spin_b': 'trunk',
+    '__spin_t': '1745365092', 
+    '__crn': 'comet.fbweb.CometMarketplaceSearchRoute', 
+    'fb_api_caller_class': 'RelayModern', 
+    'fb_api_req_friendly_name': 'CometMarketplaceSearchContentPaginationQuery', 
+    'server_timestamps': 'true', 
+    'doc_id': '9082812915151057' # El ID de la query GraphQL
+}
+
+# --- Límite de peticiones ---
+# Compartido por el monitoreo (sync y async) y las búsquedas manuales: token bucket por cookie
+# y circuit breaker que pausa todas las peticiones ante 401/403/429
+_rate_limiter = RateLimiter()
+
+def configure_rate_limit(requests_per_minute, burst=5, base_pause=60, max_pause=1800,
+                         breaker_status_codes=BREAKER_STATUS_CODES):
+    global _rate_limiter
+    _rate_limiter = RateLimiter(requests_per_minute=requests_per_minute, burst=burst,
+                                base_pause=base_pause, max_pause=max_pause,
+                                breaker_status_codes=breaker_status_codes)
+
+def configure_graphql_url(url):
+    """Cambia el endpoint de GraphQL (ej. un servidor local con respuestas grabadas, ver benchmarks/fake_graphql.py)."""
+    global GRAPHQL_URL
+    GRAPHQL_URL = url or DEFAULT_GRAPHQL_URL
+
+def get_rate_limit_state():
+    """Estado del limitador para monitoreo (ver RateLimiter.state)."""
+    return _rate_limiter.state()
+
+# --- Sesión HTTP compartida ---
+# Una sola requests.Session con pool de conexiones keep-alive: cada búsqueda reutiliza una conexión
+# TCP+TLS ya abierta en vez de hacer un handshake nuevo contra facebook.com.
+_http_session = None
+_http_session_lock = threading.Lock()
+_pool_size = DEFAULT_POOL_SIZE
+
+def configure_http_pool(pool_size):
+    """Fija el tamaño del pool de conexiones (sync y async). Conviene que sea >= a los workers que buscan a la vez."""
+    global _pool_size, _http_session
+    with _http_session_lock:
+        _pool_size = max(1, int(pool_size))
+        if _http_session is not None:
+            _http_session.close()
+            _http_session = None
+
+def get_http_session():
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_pool_size, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            # La cookie va explícita en cada petición: no acumular las Set-Cookie de las respuestas
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            _http_session = session
+        return _http_session
 
-def fetch_products_graphql(search_term, user_cookie, region, logger):
+def get_connection_stats():
+    """Peticiones hechas por la sesión compartida y cuántas necesitaron abrir una conexión nueva."""
+    with _http_session_lock:
+        session = _http_session
+        pool_size = _pool_size
+    total_requests = 0
+    new_connections = 0
+    if session is not None:
+        adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                if pool is not None:
+                    total_requests += pool.num_requests
+                    new_connections += pool.num_connections
+    return {
+        "requests": total_requests,
+        "new_connections": new_connections,
+        "reused_connections": max(0, total_requests - new_connections),
+        "pool_size": pool_size,
+    }
+
+def build_graphql_request(search_term, user_cookie, region, cursor=None, count=PAGE_SIZE, session_payload=None,
+                          price_bounds=None):
+    """
+    Arma los headers y el payload del POST a GraphQL para una búsqueda (cursor: página siguiente).
+    session_payload: campos propios de la cuenta (lsd, __hs, __spin_*...) que reemplazan a los de STATIC_PAYLOAD.
+    price_bounds: (mínimo, máximo) en unidades de la moneda; None (o None de un lado) = sin cota.
+    """
     latitude = region["latitude"]
     longitude = region["longitude"]
     radius = region["radius"]
-    
-    if not user_cookie:
-        logger.error(f"Intento de búsqueda sin cookie para '{search_term}'")
-        return None
-    request_url = "https://www.facebook.com/api/graphql/"
+    min_price, max_price = price_bounds or (None, None)
 
     # --- Encabezados (Headers) ---
-    headers = {
-        'accept': '*/*',
-        'accept-language': 'es-ES,es;q=0.6',
-        'cache-control': 'no-cache',
-        'content-type': 'application/x-www-form-urlencoded',
-        'cookie': user_cookie,
-        'origin': 'https://www.facebook.com',
-        'pragma': 'no-cache',
-        'priority': 'u=1, i',
-        'referer': f'https://www.facebook.com/marketplace/search?sortBy=creation_time_descend&query={search_term.replace(" ", "%20")}&exact=false',
-        'sec-ch-ua': '"Brave";v="135", "Not-A.Brand";v="8", "Chromium";v="135"',
-        'sec-ch-ua-full-version-list': '"Brave";v="135.0.0.0", "Not-A.Brand";v="8.0.0.0", "Chromium";v="135.0.0.0"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"Windows"',
-        'sec-ch-ua-platform-version': '"10.0.0"',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-origin',
-        'sec-gpc': '1',
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36',
-        'x-asbd-id': '359341',
-        'x-fb-friendly-name': 'CometMarketplaceSearchContentPaginationQuery',
-        'x-fb-lsd': 'AVqOd7icdFk',
-    }
+    # Sólo cookie y referer cambian por petición; el resto es STATIC_HEADERS
+    headers = dict(STATIC_HEADERS)
+    headers['cookie'] = user_cookie
+    headers['referer'] = f'https://www.facebook.com/marketplace/search?sortBy=creation_time_descend&query={search_term.replace(" ", "%20")}&exact=false'
 
     # --- Payload (Datos del Formulario) ---
     # Usar los parámetros pasados a la función en lugar de variables hardcodeadas
     variables_dict = {
-        "count": 24,
-        "cursor": None, 
+        "count": count,
+        "cursor": cursor,
         "params": {
             "bqf": {
                 "callsite": "COMMERCE_MKTPLACE_WWW",
@@ -59,8 +194,8 @@ def fetch_products_graphql(search_term, user_cookie, region, logger):
                 'commerce_search_sort_by': 'CREATION_TIME_DESCEND',
                 "filter_location_latitude": latitude, 
                 "filter_location_longitude": longitude, 
-                "filter_price_lower_bound": 0,
-                "filter_price_upper_bound": 214748364700,
+                "filter_price_lower_bound": PRICE_LOWER_BOUND if min_price is None else int(min_price) * CENTS,
+                "filter_price_upper_bound": PRICE_UPPER_BOUND if max_price is None else int(max_price) * CENTS,
                 "filter_radius_km": radius
             },
             "custom_request_params": {
@@ -79,98 +214,251 @@ def fetch_products_graphql(search_term, user_cookie, region, logger):
 
     variables_json_string = json.dumps(variables_dict)
 
-    payload_data = {
-        'av': '0',
-        '__user': '0',
-        '__a': '1',
-        '__req': 'f',
-        '__hs': '20200.HYP:comet_loggedout_pkg.2.1...0', 
-        'dpr': '1',
-        '__ccg': 'EXCELLENT',
-        '__rev': '1022128419', 
-        '__s': 'gcqwir:m2h11o:eb9hn4', 
-        '__hsi': '7496285990794582045', 
-        '__dyn': '7xeUmwlEnwn8K2Wmh0no6u5U4e1ZyUW3q32360CEbo19oe8hw2nVE4W0qa0FE2awpUO0n24oaEd82lwv89k2C1Fwc60D85m1mzXw8W58jwGzE6G1iwJK14xm0zK5o4q0Gpo8o1o8bUGdw46wbS1LwTwNwLwFg2Xwr86C13G1-w8eEb8uwm85K0UE62', 
-        '__csr': 'gjYQiIAldf9YyGG_-sxu_jylLHBy95WEwCq9hVFUG6pBiG9y9XnCDACAy8nCxyqezGguyppA9Ury98N4CyryEjxm7F-qE8FpEepoy7oO1wDyE4ep0Lxq78hw8G01qBw0NYLw4kw1jC00gL66808jE0PkE0KG0PS4oB03cU3Qw7Iw0HPwl822w0Myweq08iqxx1JiFU0pmw0Kiw3RU0k9w1LLw2SE1380knw3J41aQ0afw2VoeEcUdonw6Vw', 
-        '__comet_req': '15',
-        'lsd': 'AVqOd7icdFk', 
-        'jazoest': '2979', 
-        '__spin_r': '1022128419', 
-        '__spin_b': 'trunk',
-        '__spin_t': '1745365092', 
-        '__crn': 'comet.fbweb.CometMarketplaceSearchRoute', 
-        'fb_api_caller_class': 'RelayModern', 
-        'fb_api_req_friendly_name': 'CometMarketplaceSearchContentPaginationQuery', 
-        'variables': variables_json_string, 
-        'server_timestamps': 'true', 
-        'doc_id': '9082812915151057' # El ID de la query GraphQL
-    }
+    payload_data = dict(STATIC_PAYLOAD)
+    if session_payload:
+        payload_data.update(session_payload)
+    # El token lsd del header tiene que ser el mismo del payload (el de la cuenta, si trae uno propio)
+    headers['x-fb-lsd'] = payload_data['lsd']
+    payload_data['variables'] = variables_json_string
+
+    return headers, payload_data
+
+def parse_graphql_response(data, logger):
+    """Extrae los productos no vendidos de la respuesta JSON de GraphQL."""
+    feed_units = data.get('data', {}).get('marketplace_search', {}).get('feed_units', {})
+    edges = feed_units.get('edges', [])
+
+    logger.info(f"GraphQL response: Found {len(edges)} edges.")
+
+    productos_encontrados = []
+    for edge in edges:
+        product = product_from_edge(edge, logger)
+        if product is not None:
+            productos_encontrados.append(product)
+    return productos_encontrados
+
+def listing_price_amount(price_obj, formatted):
+    """
+    (centavos, moneda) de un listing_price. Usa el monto numérico de la API si viene
+    (amount_with_offset_in_currency ya está en centavos); si no, parsea el texto formateado.
+    """
+    parsed_cents, parsed_currency = parse_formatted_price(formatted)
+    currency = price_obj.get('currency') or parsed_currency
+    try:
+        return (int(price_obj['amount_with_offset_in_currency']), currency)
+    except (KeyError, TypeError, ValueError):
+        pass
+    try:
+        return (round(float(price_obj['amount']) * CENTS), currency)
+    except (KeyError, TypeError, ValueError):
+        return (parsed_cents, currency)
+
+def product_from_edge(edge, logger):
+    """Convierte un edge de feed_units en Product; None si no es una publicación válida o está vendida."""
+    node = edge.get('node', {})
+    if not node:
+        return None
+
+    listing = node.get('listing', {})
+    if not listing:
+        return None
+
+    listing_id = listing.get('id')
+    if not listing_id:
+         logger.warning("Listado encontrado sin ID en la respuesta. Saltando.")
+         return None
+
+    titulo = listing.get('marketplace_listing_title', 'Sin título')
+
+    precio_obj = listing.get('listing_price') or {}
+    precio = precio_obj.get('formatted_amount', 'Sin precio')
+    precio_centavos, moneda = listing_price_amount(precio_obj, precio)
+
+    imagen_url = None
+    primary_photo = listing.get('primary_listing_photo', {})
+    if primary_photo:
+        image_data = primary_photo.get('image', {})
+        if image_data:
+            imagen_url = image_data.get('uri')
+
+    ciudad = DEFAULT_CITY
+    location_data = listing.get('location', {})
+    if location_data:
+        reverse_geocode = location_data.get('reverse_geocode', {})
+        if reverse_geocode:
+            ciudad = reverse_geocode.get('city', ciudad)
+
+    # Verifica si está vendido y solo añade si NO está vendido
+    if listing.get('is_sold', False):
+        return None
+    # La URL se deriva del id (Product.url); la misma publicación se comparte entre alertas
+    return make_product(listing_id, titulo, precio, imagen_url, ciudad, precio_centavos, moneda)
+
+def parse_page_info(data):
+    """Devuelve el end_cursor de la respuesta, o None si no hay más páginas."""
+    feed_units = data.get('data', {}).get('marketplace_search', {}).get('feed_units', {})
+    return _end_cursor(feed_units.get('page_info') or {})
+
+def _end_cursor(page_info):
+    if not page_info.get('has_next_page'):
+        return None
+    return page_info.get('end_cursor')
+
+# --- Parseo incremental ---
+# Sólo se arma en memoria un edge a la vez (con el parser en C de ijson); el resto del árbol
+# (tracking, filtros, extensions...) se descarta a medida que se lee
+EDGES_PREFIX = 'data.marketplace_search.feed_units.edges.item'
+PAGE_INFO_PATTERN = re.compile(rb'"page_info"\s*:\s*(\{[^{}]*\})')
+PAGE_INFO_MARKER = b'"page_info"'
+
+class _PageInfoTap:
+    """
+    Envuelve el stream de la respuesta y guarda sólo los bloques donde aparece "page_info",
+    así se obtiene el cursor sin una segunda pasada ni un parser de eventos en Python.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        # _tail: final del bloque anterior, por si la clave queda partida entre dos lecturas
+        self._tail = b''
+        self._captured = []
+        self._capturing = False
+
+    def _tap(self, data):
+        if self._capturing:
+            self._captured.append(data)
+            # page_info no tiene objetos anidados: la primera '}' lo cierra
+            self._capturing = b'}' not in data
+        else:
+            window = self._tail + data
+            start = window.find(PAGE_INFO_MARKER, max(0, len(self._tail) - len(PAGE_INFO_MARKER) + 1))
+            if start >= 0:
+                self._captured.append(window[start:])
+                self._capturing = b'}' not in window[start:]
+        self._tail = (self._tail + data)[-len(PAGE_INFO_MARKER):]
+        return data
+
+    def read(self, size=-1):
+        return self._tap(self._stream.read(size))
+
+    def page_info(self):
+        matches = PAGE_INFO_PATTERN.findall(b''.join(self._captured))
+        if not matches:
+            return {}
+        try:
+            return json.loads(matches[-1])
+        except json.JSONDecodeError:
+            return {}
+
+class _AsyncPageInfoTap(_PageInfoTap):
+    async def read(self, size=-1):
+        return self._tap(await self._stream.read(size))
+
+def _products_from_edges(edges, logger):
+    productos_encontrados = []
+    edge_count = 0
+    for edge in edges:
+        edge_count += 1
+        product = product_from_edge(edge, logger)
+        if product is not None:
+            productos_encontrados.append(product)
+    logger.info(f"GraphQL response (stream): Found {edge_count} edges.")
+    return productos_encontrados
+
+async def _products_from_edges_async(edges, logger):
+    # Igual que _products_from_edges: cada edge se convierte apenas llega y se descarta
+    productos_encontrados = []
+    edge_count = 0
+    async for edge in edges:
+        edge_count += 1
+        product = product_from_edge(edge, logger)
+        if product is not None:
+            productos_encontrados.append(product)
+    logger.info(f"GraphQL response (stream): Found {edge_count} edges.")
+    return productos_encontrados
+
+def parse_graphql_stream(stream, logger):
+    """
+    Igual que parse_graphql_response + parse_page_info, pero leyendo de un archivo/stream de bytes
+    sin cargar la respuesta entera. Devuelve (productos, end_cursor). Requiere ijson.
+    """
+    tap = _PageInfoTap(stream)
+    productos_encontrados = _products_from_edges(ijson.items(tap, EDGES_PREFIX), logger)
+    return productos_encontrados, _end_cursor(tap.page_info())
+
+async def parse_graphql_stream_async(stream, logger):
+    """Versión para streams asíncronos (ej. aiohttp response.content)."""
+    tap = _AsyncPageInfoTap(stream)
+    productos_encontrados = await _products_from_edges_async(ijson.items_async(tap, EDGES_PREFIX), logger)
+    return productos_encontrados, _end_cursor(tap.page_info())
+
+def _should_fetch_next_page(products, end_cursor, pages_fetched, max_pages, seen_ids):
+    if end_cursor is None or pages_fetched >= max_pages:
+        return False
+    # Resultados ordenados por CREATION_TIME_DESCEND: si aparece algo ya visto, lo que sigue es más viejo
+    if seen_ids and any(product.id in seen_ids for product in products):
+        return False
+    return True
+
+def _acquire_session(user_cookie, search_term, logger):
+    """
+    user_cookie puede ser una cookie (una sola cuenta) o un SessionPool con varias.
+    Devuelve (sesión, pool) o (None, pool) si todas las cuentas están en cuarentena.
+    """
+    if isinstance(user_cookie, SessionPool):
+        session = user_cookie.acquire()
+        if session is None:
+            logger.warning(f"Petición GraphQL para '{search_term}' omitida: todas las sesiones de Facebook están en cuarentena "
+                           f"(la próxima se libera en {user_cookie.next_available_in():.0f}s).")
+        return session, user_cookie
+    return MarketplaceSession("cookie", user_cookie), None
+
+def _release_session(pool, session, status_code):
+    if pool is not None:
+        pool.release(session, status_code)
+
+def fetch_page_graphql(search_term, user_cookie, region, logger, cursor=None, price_bounds=None):
+    """
+    Pide una página de resultados. Devuelve (productos, end_cursor) o None si la petición falló.
+    user_cookie: cookie de Facebook o SessionPool (se usa la cuenta que asigne el pool).
+    """
+    if not user_cookie:
+        logger.error(f"Intento de búsqueda sin cookie para '{search_term}'")
+        return None
+    session, pool = _acquire_session(user_cookie, search_term, logger)
+    if session is None:
+        return None
+    headers, payload_data = build_graphql_request(search_term, session.cookie, region, cursor=cursor,
+                                                  session_payload=session.payload, price_bounds=price_bounds)
+
+    rate_limiter = _rate_limiter
+    if not rate_limiter.acquire(session.cookie, session.requests_per_minute):
+        if pool is not None:
+            pool.cancel(session)
+        logger.warning(f"Petición GraphQL para '{search_term}' omitida: Marketplace en pausa por circuit breaker ({rate_limiter.breaker.state()['retry_in']}s).")
+        return None
 
     # --- Realizar la Petición POST ---
+    status_code = None
+    response = None
     try:
-        logger.info(f"Realizando petición GraphQL para: '{search_term}'")
-        response = requests.post(request_url, headers=headers, data=payload_data, timeout=DEFAULT_REQUEST_TIMEOUT)
+        logger.info(f"Realizando petición GraphQL para: '{search_term}'" + (" (página siguiente)" if cursor else ""))
+        response = get_http_session().post(GRAPHQL_URL, headers=headers, data=payload_data, timeout=DEFAULT_REQUEST_TIMEOUT,
+                                           stream=STREAMING_PARSE)
+        status_code = response.status_code
         response.raise_for_status()
 
         # Procesar la respuesta JSON
-        data = response.json()
-
-        # --- Extraer la información ---
-        feed_units = data.get('data', {}).get('marketplace_search', {}).get('feed_units', {})
-        edges = feed_units.get('edges', [])
-
-        logger.info(f"GraphQL response: Found {len(edges)} edges.")
-
-        productos_encontrados = []
-        for edge in edges:
-            node = edge.get('node', {})
-            if not node:
-                continue
-
-            listing = node.get('listing', {})
-            if not listing:
-                continue
-
-            listing_id = listing.get('id')
-            if not listing_id:
-                 logger.warning("Listado encontrado sin ID en la respuesta. Saltando.")
-                 continue
-
-            titulo = listing.get('marketplace_listing_title', 'Sin título')
-
-            precio_obj = listing.get('listing_price', {})
-            precio = precio_obj.get('formatted_amount', 'Sin precio')
-
-            imagen_url = None
-            primary_photo = listing.get('primary_listing_photo', {})
-            if primary_photo:
-                image_data = primary_photo.get('image', {})
-                if image_data:
-                    imagen_url = image_data.get('uri')
-
-            url_listing = f"https://www.facebook.com/marketplace/item/{listing_id}/"
-
-            ciudad = "Ubicación desconocida"
-            location_data = listing.get('location', {})
-            if location_data:
-                reverse_geocode = location_data.get('reverse_geocode', {})
-                if reverse_geocode:
-                    ciudad = reverse_geocode.get('city', ciudad)
-
-            # Verifica si está vendido y solo añade si NO está vendido
-            esta_vendido = listing.get('is_sold', False)
-            if not esta_vendido:
-                productos_encontrados.append({
-                    'id': listing_id,
-                    'titulo': titulo,
-                    'precio': precio,
-                    'url': url_listing,
-                    'imagen_url': imagen_url,
-                    'ciudad': ciudad
-                })
-
-        logger.info(f"fetch_products_graphql para '{search_term}' completada. Encontrados {len(productos_encontrados)} productos válidos.")
-        return productos_encontrados
+        if STREAMING_PARSE:
+            response.raw.decode_content = True
+            productos_encontrados, end_cursor = parse_graphql_stream(response.raw, logger)
+        else:
+            data = response.json()
+            productos_encontrados = parse_graphql_response(data, logger)
+            end_cursor = parse_page_info(data)
+
+        logger.info(f"fetch_page_graphql para '{search_term}' completada. Encontrados {len(productos_encontrados)} productos válidos.")
+        return productos_encontrados, end_cursor
 
     except requests.exceptions.Timeout:
         logger.error(f"Timeout ({DEFAULT_REQUEST_TIMEOUT}s) durante petición GraphQL para '{search_term}'")
@@ -187,16 +475,159 @@ def fetch_products_graphql(search_term, user_cookie, region, logger):
                  logger.error(f"Respuesta del servidor (JSON, primeros 500 chars):\n{response.text[:500]}...")
 
             if e.response.status_code in [401, 403]:
-                 logger.critical(f"¡¡ERROR DE AUTENTICACIÓN/AUTORIZACIÓN!! Revisa FACEBOOK_COOKIE en tu .env. Asegúrate de incluir 'c_user' y 'xs'.")
+                 logger.critical(f"¡¡ERROR DE AUTENTICACIÓN/AUTORIZACIÓN!! Revisa la cookie de la sesión '{session.name}' (FACEBOOK_COOKIE o archivo de sesiones). Asegúrate de incluir 'c_user' y 'xs'.")
             elif e.response.status_code == 429:
                  logger.warning("¡Demasiadas peticiones! Facebook está limitando las solicitudes.")
         return None
-    except json.JSONDecodeError as e:
+    except JSON_PARSE_ERRORS as e:
         logger.error(f"Error decodificando JSON de GraphQL para '{search_term}': {e}")
-        # Si la respuesta no fue JSON, response.text debería estar disponible
-        if 'response' in locals() and response is not None:
+        # Si la respuesta no fue JSON, response.text debería estar disponible (con streaming ya se consumió)
+        if response is not None and not STREAMING_PARSE:
             logger.error(f"Respuesta recibida (primeros 500 chars):\n{response.text[:500]}...")
         return None
     except Exception as e:
-        logger.exception(f"Ocurrió un error inesperado en fetch_products_graphql para '{search_term}': {e}")
-        return None
\ No newline at end of file
+        logger.exception(f"Ocurrió un error inesperado en fetch_page_graphql para '{search_term}': {e}")
+        return None
+    finally:
+        if response is not None:
+            # Con stream=True la conexión vuelve al pool recién al cerrar la respuesta
+            response.close()
+        rate_limiter.record_response(status_code)
+        _release_session(pool, session, status_code)
+
+def iter_product_pages(search_term, user_cookie, region, logger, max_pages=1, seen_ids=None, price_bounds=None):
+    """
+    Generador de páginas de resultados (listas de Product) siguiendo page_info.end_cursor,
+    hasta max_pages páginas. Con seen_ids (IDs ya vistos por la alerta) corta en la primera
+    página que contenga alguno: las búsquedas tranquilas siguen costando una sola petición.
+    Si una petición falla, termina sin más páginas.
+    """
+    cursor = None
+    pages_fetched = 0
+    while True:
+        result = fetch_page_graphql(search_term, user_cookie, region, logger, cursor=cursor, price_bounds=price_bounds)
+        if result is None:
+            return
+        products, cursor = result
+        pages_fetched += 1
+        yield products
+        if not _should_fetch_next_page(products, cursor, pages_fetched, max_pages, seen_ids):
+            return
+
+def fetch_products_graphql(search_term, user_cookie, region, logger, max_pages=1, seen_ids=None, price_bounds=None):
+    """
+    Productos de hasta max_pages páginas (ver iter_product_pages), del más nuevo al más viejo.
+    Devuelve None sólo si falló la primera página; si falla una posterior devuelve lo ya obtenido.
+    """
+    productos_encontrados = None
+    for products in iter_product_pages(search_term, user_cookie, region, logger, max_pages=max_pages, seen_ids=seen_ids,
+                                       price_bounds=price_bounds):
+        if productos_encontrados is None:
+            productos_encontrados = []
+        productos_encontrados.extend(products)
+    return productos_encontrados
+
+
+# --- Cliente asíncrono ---
+# Una única sesión aiohttp por event loop, reutilizada por todas las búsquedas del motor asyncio
+_async_session = None
+
+async def get_async_session():
+    global _async_session
+    if _async_session is None or _async_session.closed:
+        _async_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=DEFAULT_REQUEST_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=_pool_size),
+            # Igual que la sesión sync: la cookie va explícita en cada petición
+            cookie_jar=aiohttp.DummyCookieJar()
+        )
+    return _async_session
+
+async def close_async_session():
+    global _async_session
+    if _async_session is not None and not _async_session.closed:
+        await _async_session.close()
+    _async_session = None
+
+async def fetch_page_graphql_async(search_term, user_cookie, region, logger, cursor=None, price_bounds=None):
+    """Versión asyncio de fetch_page_graphql: misma petición y mismo resultado, sin bloquear un hilo."""
+    if not user_cookie:
+        logger.error(f"Intento de búsqueda sin cookie para '{search_term}'")
+        return None
+    session, pool = _acquire_session(user_cookie, search_term, logger)
+    if session is None:
+        return None
+    headers, payload_data = build_graphql_request(search_term, session.cookie, region, cursor=cursor,
+                                                  session_payload=session.payload, price_bounds=price_bounds)
+
+    rate_limiter = _rate_limiter
+    wait = rate_limiter.reserve(session.cookie, session.requests_per_minute)
+    if wait is None:
+        if pool is not None:
+            pool.cancel(session)
+        logger.warning(f"Petición GraphQL (async) para '{search_term}' omitida: Marketplace en pausa por circuit breaker ({rate_limiter.breaker.state()['retry_in']}s).")
+        return None
+
+    status_code = None
+    try:
+        if wait > 0:
+            await asyncio.sleep(wait)
+        logger.info(f"Realizando petición GraphQL (async) para: '{search_term}'" + (" (página siguiente)" if cursor else ""))
+        http_session = await get_async_session()
+        body = ""
+        async with http_session.post(GRAPHQL_URL, headers=headers, data=payload_data) as response:
+            status_code = response.status
+            if response.status < 400 and STREAMING_PARSE:
+                productos_encontrados, end_cursor = await parse_graphql_stream_async(response.content, logger)
+                logger.info(f"fetch_page_graphql_async para '{search_term}' completada. Encontrados {len(productos_encontrados)} productos válidos.")
+                return productos_encontrados, end_cursor
+            body = await response.text()
+            if response.status >= 400:
+                logger.error(f"Error en petición GraphQL (async) para '{search_term}': HTTP {response.status}")
+                logger.error(f"Respuesta del servidor (primeros 500 chars):\n{body[:500]}...")
+                if response.status in [401, 403]:
+                     logger.critical(f"¡¡ERROR DE AUTENTICACIÓN/AUTORIZACIÓN!! Revisa la cookie de la sesión '{session.name}' (FACEBOOK_COOKIE o archivo de sesiones). Asegúrate de incluir 'c_user' y 'xs'.")
+                elif response.status == 429:
+                     logger.warning("¡Demasiadas peticiones! Facebook está limitando las solicitudes.")
+                return None
+
+        data = json.loads(body)
+        productos_encontrados = parse_graphql_response(data, logger)
+
+        logger.info(f"fetch_page_graphql_async para '{search_term}' completada. Encontrados {len(productos_encontrados)} productos válidos.")
+        return productos_encontrados, parse_page_info(data)
+
+    except asyncio.TimeoutError:
+        logger.error(f"Timeout ({DEFAULT_REQUEST_TIMEOUT}s) durante petición GraphQL (async) para '{search_term}'")
+        return None
+    except aiohttp.ClientError as e:
+        logger.error(f"Error en petición GraphQL (async) para '{search_term}': {e}")
+        return None
+    except JSON_PARSE_ERRORS as e:
+        logger.error(f"Error decodificando JSON de GraphQL (async) para '{search_term}': {e}")
+        logger.error(f"Respuesta recibida (primeros 500 chars):\n{body[:500]}...")
+        return None
+    except Exception as e:
+        logger.exception(f"Ocurrió un error inesperado en fetch_page_graphql_async para '{search_term}': {e}")
+        return None
+    finally:
+        rate_limiter.record_response(status_code)
+        _release_session(pool, session, status_code)
+
+async def fetch_products_graphql_async(search_term, user_cookie, region, logger, max_pages=1, seen_ids=None, price_bounds=None):
+    """Versión asyncio de fetch_products_graphql (misma paginación y mismo corte por seen_ids)."""
+    productos_encontrados = None
+    cursor = None
+    pages_fetched = 0
+    while True:
+        result = await fetch_page_graphql_async(search_term, user_cookie, region, logger, cursor=cursor,
+                                                price_bounds=price_bounds)
+        if result is None:
+            return productos_encontrados
+        products, cursor = result
+        pages_fetched += 1
+        if productos_encontrados is None:
+            productos_encontrados = []
+        productos_encontrados.extend(products)
+        if not _should_fetch_next_page(products, cursor, pages_fetched, max_pages, seen_ids):
+            return productos_encontrados
@@ -0,0 +1,474 @@
+import heapq
+import html as html_lib
+import itertools
+import threading
+import time
+import logging
+from collections import deque
+
+from telebot import apihelper, types
+
+from product import DEFAULT_CITY
+from prices import format_cents
+from listing_state import PRICE_DROP
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Prioridades: las alertas en vivo salen antes que los volcados de historial ("Ver en chat")
+PRIORITY_ALERT = 0
+PRIORITY_HISTORY = 1
+
+# Límite de Telegram para send_media_group y largo máximo de un mensaje de texto
+MAX_MEDIA_GROUP = 10
+MAX_MESSAGE_LENGTH = 4096
+DIGEST_TITLE_LENGTH = 80
+NEW_PRODUCT_HEADER = "🛍️ Nuevo Producto:"
+
+
+def format_product_message(product, header=None):
+    """Texto HTML de la notificación de un producto (header ya en HTML, ej. "📉 Bajó de precio...")."""
+    title = html_lib.escape(product.get('titulo', 'Sin título'))
+    price = html_lib.escape(product.get('precio', 'Sin precio'))
+    url = html_lib.escape(product.get('url', '#'))
+    city = html_lib.escape(product.get('ciudad', DEFAULT_CITY))
+    return (
+        f"{header or NEW_PRODUCT_HEADER}\n\n"
+        f"<b>{title}</b>\n\n"
+        f"💰 <b>Precio:</b> {price}\n"
+        f"📍 <b>Ubicación:</b> {city}\n"
+        f"🔗 <a href='{url}'>Ver en Facebook Marketplace</a>"
+    )
+
+def format_listing_event_header(event, product):
+    """Encabezado de la notificación de una publicación conocida que bajó de precio o volvió a aparecer."""
+    old_price = format_cents(event.old_price_cents, product.get('moneda'))
+    if event.kind == PRICE_DROP:
+        return f"📉 <b>Bajó de precio</b> (antes {html_lib.escape(old_price)}):"
+    days = max(1, round(event.absent_seconds / 86400))
+    header = f"🔁 <b>Volvió a publicarse</b> (no aparecía hace {days} día{'s' if days != 1 else ''})"
+    price_cents = product.get('precio_centavos')
+    if price_cents is not None and event.old_price_cents and price_cents < event.old_price_cents:
+        header += f", antes {html_lib.escape(old_price)}"
+    return header + ":"
+
+def format_digest_line(product):
+    """Una línea compacta (título, precio, ciudad y enlace) para los mensajes con varios productos."""
+    title = product.get('titulo', 'Sin título')
+    if len(title) > DIGEST_TITLE_LENGTH:
+        title = title[:DIGEST_TITLE_LENGTH - 1] + "…"
+    return (f"• <a href='{html_lib.escape(product.get('url', '#'))}'>{html_lib.escape(title)}</a> - "
+            f"<b>{html_lib.escape(product.get('precio', 'Sin precio'))}</b> ({html_lib.escape(product.get('ciudad', DEFAULT_CITY))})")
+
+def format_digest_messages(products, header=None):
+    """Lista HTML de productos, partida en tantos mensajes como haga falta para el largo máximo de Telegram."""
+    messages = []
+    lines = [header or f"🛍️ {len(products)} productos nuevos:", ""]
+    length = sum(len(line) + 1 for line in lines)
+    for product in products:
+        line = format_digest_line(product)
+        if length + len(line) + 1 > MAX_MESSAGE_LENGTH and len(lines) > 2:
+            messages.append("\n".join(lines))
+            lines = []
+            length = 0
+        lines.append(line)
+        length += len(line) + 1
+    messages.append("\n".join(lines))
+    return messages
+
+def get_retry_after(error):
+    """Segundos de espera que pide Telegram en un 429 (None si el error no es un 429)."""
+    if not isinstance(error, apihelper.ApiTelegramException) or error.error_code != 429:
+        return None
+    parameters = (error.result_json or {}).get('parameters') or {}
+    return parameters.get('retry_after', 1)
+
+
+class _Notification:
+    __slots__ = ('kind', 'chat_id', 'payload', 'kwargs', 'priority', 'seq', 'attempts')
+
+    def __init__(self, kind, chat_id, payload, kwargs, priority, seq):
+        # kind: "product" (payload = Product), "text" (payload = texto del mensaje)
+        # o "digest" (payload = (encabezado, [Product, ...]), ver send_digest)
+        self.kind = kind
+        self.chat_id = chat_id
+        self.payload = payload
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.attempts = 0
+
+
+class _ChatQueue:
+    """Cola de un chat: una fila por prioridad, su token bucket y la pausa pedida por Telegram."""
+
+    def __init__(self, rate, burst):
+        self.lanes = (deque(), deque())
+        self.bucket = TokenBucket(rate, burst)
+        self.blocked_until = 0.0
+
+    def head(self):
+        for lane in self.lanes:
+            if lane:
+                return lane
+        return None
+
+
+class Notifier:
+    """
+    Cola de salida de mensajes a Telegram con un único hilo que envía.
+    Respeta un token bucket global (~30 msg/s) y uno por chat (~1 msg/s), reintenta los 429
+    después del retry_after que indica Telegram y prioriza las alertas sobre el historial.
+    Cuando un chat acumula batch_threshold productos o más, los manda juntos en un álbum
+    (send_media_group) y/o un mensaje con la lista, en vez de uno por producto.
+    """
+
+    def __init__(self, bot, global_per_second=30, chat_per_second=1, chat_burst=3,
+                 batch_threshold=3, max_attempts=5):
+        self.bot = bot
+        self.chat_per_second = chat_per_second
+        self.chat_burst = chat_burst
+        self.batch_threshold = batch_threshold
+        self.max_attempts = max_attempts
+        self._global_bucket = TokenBucket(global_per_second, global_per_second)
+        # _chats: { chat_id: _ChatQueue } - sólo chats con mensajes pendientes
+        self._chats = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._sender = None
+        self._stopped = False
+        self._sent = 0
+        self._batched = 0
+
+    # --- API pública ---
+
+    def start(self):
+        with self._lock:
+            if self._sender is not None:
+                return
+            self._stopped = False
+            self._sender = threading.Thread(target=self._send_loop, name="telegram-notifier", daemon=True)
+            self._sender.start()
+
+    def stop(self, timeout=10):
+        """Intenta vaciar la cola durante hasta timeout segundos y detiene el hilo."""
+        deadline = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+            sender = self._sender
+            self._sender = None
+        if sender is not None:
+            sender.join(timeout=max(0.0, deadline - time.monotonic()) + 1)
+
+    def send_product(self, chat_id, product, priority=PRIORITY_ALERT, reply_markup=None, header=None):
+        """Encola un producto; con header (ej. una baja de precio) sale siempre en su propio mensaje."""
+        kwargs = {"reply_markup": reply_markup} if reply_markup else {}
+        if header:
+            kwargs["header"] = header
+        self._enqueue("product", chat_id, product, kwargs, priority)
+
+    def send_message(self, chat_id, text, priority=PRIORITY_ALERT, **kwargs):
+        """Encola un send_message; sale en orden respecto de los productos de la misma prioridad."""
+        self._enqueue("text", chat_id, text, kwargs, priority)
+
+    def send_digest(self, chat_id, products, header, priority=PRIORITY_ALERT):
+        """Encola varios productos que salen juntos: un álbum si entran en uno, si no una lista."""
+        self._enqueue("digest", chat_id, (header, list(products)), {}, priority)
+
+    def pending(self, chat_id=None):
+        with self._lock:
+            if chat_id is None:
+                chats = list(self._chats.values())
+            else:
+                chats = [self._chats[chat_id]] if chat_id in self._chats else []
+            return sum(len(lane) for chat in chats for lane in chat.lanes)
+
+    def stats(self):
+        with self._lock:
+            pending = sum(len(lane) for chat in self._chats.values() for lane in chat.lanes)
+            return {"pending": pending, "chats": len(self._chats), "sent": self._sent, "batched_products": self._batched}
+
+    # --- Cola ---
+
+    def _enqueue(self, kind, chat_id, payload, kwargs, priority):
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = _ChatQueue(self.chat_per_second, self.chat_burst)
+                self._chats[chat_id] = chat
+            chat.lanes[priority].append(_Notification(kind, chat_id, payload, kwargs, priority, next(self._seq)))
+            self._wakeup.notify()
+
+    def _next_ready(self):
+        """
+        Elige el chat listo (sin pausa y con token) cuyo próximo mensaje tiene mayor prioridad y es
+        el más viejo. Devuelve (chat_id, None) o (None, segundos a esperar). Requiere self._lock.
+        """
+        now = time.monotonic()
+        global_wait = self._wait_for_token(self._global_bucket)
+        best = None
+        wait = None
+        for chat_id, chat in self._chats.items():
+            lane = chat.head()
+            if lane is None:
+                continue
+            chat_wait = max(chat.blocked_until - now, self._wait_for_token(chat.bucket))
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            key = (lane[0].priority, lane[0].seq)
+            if best is None or key < best[0]:
+                best = (key, chat_id)
+        if best is None:
+            return None, wait
+        if global_wait > 0:
+            return None, global_wait
+        return best[1], None
+
+    @staticmethod
+    def _wait_for_token(bucket):
+        available = bucket.available()
+        return 0.0 if available >= 1 else (1 - available) / bucket.rate
+
+    def _take_batch(self, chat_id):
+        # Requiere self._lock. Saca el próximo mensaje del chat o, si hay backlog de productos, varios juntos.
+        chat = self._chats[chat_id]
+        lane = chat.head()
+        batch = [lane.popleft()]
+        if batch[0].kind == "product" and "header" not in batch[0].kwargs and len(lane) + 1 >= self.batch_threshold:
+            while lane and lane[0].kind == "product" and "header" not in lane[0].kwargs and len(batch) < MAX_MEDIA_GROUP:
+                batch.append(lane.popleft())
+        chat.bucket.reserve()
+        self._global_bucket.reserve()
+        return batch
+
+    def _requeue(self, chat_id, batch, retry_after):
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = _ChatQueue(self.chat_per_second, self.chat_burst)
+                self._chats[chat_id] = chat
+            chat.blocked_until = time.monotonic() + retry_after
+            for notification in reversed(batch):
+                notification.attempts += 1
+                if notification.attempts >= self.max_attempts:
+                    logger.error(f"Descartando mensaje para el chat {chat_id} tras {notification.attempts} intentos.")
+                    continue
+                chat.lanes[notification.priority].appendleft(notification)
+
+    def _send_loop(self):
+        while True:
+            with self._lock:
+                while True:
+                    # Sacar de _chats los que quedaron vacíos, sin pausa y con el bucket lleno
+                    # (antes no: un chat recreado arrancaría con la ráfaga completa)
+                    now = time.monotonic()
+                    for chat_id in [cid for cid, chat in self._chats.items() if chat.head() is None
+                                    and chat.blocked_until <= now and chat.bucket.available() >= chat.bucket.capacity]:
+                        del self._chats[chat_id]
+                    if self._stopped:
+                        return
+                    chat_id, wait = self._next_ready()
+                    if chat_id is not None:
+                        break
+                    self._wakeup.wait(timeout=wait)
+                batch = self._take_batch(chat_id)
+
+            try:
+                self._send_batch(chat_id, batch)
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    logger.warning(f"Telegram pidió esperar {retry_after}s antes de escribir al chat {chat_id}. Reencolando {len(batch)} mensajes.")
+                    self._requeue(chat_id, batch, retry_after)
+                else:
+                    logger.exception(f"Error inesperado enviando mensajes al chat {chat_id}: {e}")
+
+    # --- Envío ---
+
+    def _send_batch(self, chat_id, batch):
+        if len(batch) == 1:
+            notification = batch[0]
+            if notification.kind == "text":
+                self.bot.send_message(chat_id, notification.payload, **notification.kwargs)
+            elif notification.kind == "digest":
+                header, products = notification.payload
+
+                def album_sent(remaining):
+                    # Si lo que sigue falla con 429, sólo se reencola lo que no salió en el álbum
+                    notification.payload = (header, remaining)
+                self._send_grouped(chat_id, products, header, album_sent)
+            else:
+                self._send_product(chat_id, notification.payload, **notification.kwargs)
+            self._sent += 1
+            return
+
+        def album_sent(remaining):
+            batch[:] = [notification for notification in batch if notification.payload in remaining]
+        self._send_grouped(chat_id, [notification.payload for notification in batch], None, album_sent)
+        self._sent += 1
+
+    def _send_grouped(self, chat_id, products, header, album_sent):
+        """
+        Varios productos juntos: si entran en un álbum (send_media_group) van los que tienen foto
+        y el resto en una lista; si no, todo como lista HTML. album_sent(restantes) se llama tras el álbum.
+        """
+        with_photo = [product for product in products if product.get('imagen_url')]
+        if len(with_photo) >= 2 and len(products) <= MAX_MEDIA_GROUP:
+            captions = [format_digest_line(product) for product in with_photo]
+            if header:
+                captions[0] = f"{header}\n\n{captions[0]}"
+            try:
+                self.bot.send_media_group(chat_id, [
+                    types.InputMediaPhoto(product.get('imagen_url'), caption=caption, parse_mode='HTML')
+                    for product, caption in zip(with_photo, captions)
+                ])
+                self._batched += len(with_photo)
+                products = [product for product in products if not product.get('imagen_url')]
+                header = None
+                album_sent(products)
+            except apihelper.ApiTelegramException as e:
+                if get_retry_after(e) is not None:
+                    raise
+                # Alguna imagen no se pudo descargar: todo va a la lista de texto
+                logger.warning(f"Error enviando álbum al chat {chat_id}: {e}. Enviando como lista.")
+        if products:
+            for message in format_digest_messages(products, header):
+                self.bot.send_message(chat_id, message, parse_mode='HTML', disable_web_page_preview=True)
+            self._batched += len(products)
+
+    def _send_product(self, chat_id, product, reply_markup=None, header=None):
+        """Envía un producto con foto (o como texto si no tiene); si falla, manda sólo el enlace."""
+        message = format_product_message(product, header)
+        image_url = product.get('imagen_url')
+        try:
+            # Intentar enviar con foto si hay URL de imagen
+            if image_url:
+                self.bot.send_photo(chat_id, photo=image_url, caption=message, parse_mode='HTML',
+                                    reply_markup=reply_markup)
+            else:
+                # Enviar como mensaje de texto si no hay foto
+                self.bot.send_message(chat_id, message, parse_mode='HTML',
+                                      disable_web_page_preview=True, # Desactivar preview si no hay foto adjunta
+                                      reply_markup=reply_markup)
+        except Exception as e:
+            if get_retry_after(e) is not None:
+                raise
+            logger.error(f"Error enviando mensaje de producto al chat {chat_id}: {e}")
+            # Si falla send_photo o send_message, intentar enviar solo el enlace como fallback
+            title = html_lib.escape(product.get('titulo', 'Sin título'))
+            price = html_lib.escape(product.get('precio', 'Sin precio'))
+            url = html_lib.escape(product.get('url', '#'))
+            try:
+                self.bot.send_message(chat_id, f"🛍️ Nuevo Producto: <a href='{url}'>{title} - {price}</a>",
+                                      parse_mode='HTML', disable_web_page_preview=False)
+            except Exception as e_fallback:
+                logger.error(f"Error en fallback enviando enlace de producto al chat {chat_id}: {e_fallback}")
+
+
+class DigestBuffer:
+    """
+    Acumula los productos nuevos de las alertas en modo resumen y los entrega juntos al cerrar
+    la ventana de cada una (flush_fn(key, chat_id, products)). Un solo hilo con un heap de
+    vencimientos, igual que el scheduler, en vez de un timer por alerta.
+    """
+
+    def __init__(self, flush_fn):
+        self._flush_fn = flush_fn
+        # _pending: { key: [chat_id, [product, ...], vencimiento] }
+        self._pending = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._loop, name="digest-buffer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Detiene el hilo y entrega lo acumulado sin esperar a que venzan las ventanas."""
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            thread.join()
+        self.flush_all()
+
+    def add(self, key, chat_id, products, window_seconds):
+        """Agrega productos al resumen de key; la ventana empieza con el primero que llega."""
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                due = time.monotonic() + window_seconds
+                entry = [chat_id, [], due]
+                self._pending[key] = entry
+                heapq.heappush(self._heap, (due, next(self._seq), key))
+                self._wakeup.notify()
+            entry[0] = chat_id
+            entry[1].extend(products)
+
+    def pending_count(self, key):
+        with self._lock:
+            entry = self._pending.get(key)
+            return len(entry[1]) if entry else 0
+
+    def flush(self, key):
+        """Entrega ya el resumen de key (ej. al desactivar el modo resumen)."""
+        with self._lock:
+            entry = self._pending.pop(key, None)
+        if entry:
+            self._deliver(key, entry)
+
+    def discard(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def flush_all(self):
+        with self._lock:
+            entries = list(self._pending.items())
+            self._pending.clear()
+        for key, entry in entries:
+            self._deliver(key, entry)
+
+    def _deliver(self, key, entry):
+        chat_id, products, _ = entry
+        if not products:
+            return
+        try:
+            self._flush_fn(key, chat_id, products)
+        except Exception as e:
+            logger.exception(f"Error entregando resumen de {key}: {e}")
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                while True:
+                    if self._stopped:
+                        return
+                    now = time.monotonic()
+                    # Descartar entradas del heap que ya se entregaron (flush/discard)
+                    while self._heap:
+                        due, _, key = self._heap[0]
+                        entry = self._pending.get(key)
+                        if entry is not None and entry[2] == due:
+                            break
+                        heapq.heappop(self._heap)
+                    if self._heap and self._heap[0][0] <= now:
+                        _, _, key = heapq.heappop(self._heap)
+                        entry = self._pending.pop(key)
+                        break
+                    self._wakeup.wait(timeout=(self._heap[0][0] - now) if self._heap else None)
+            self._deliver(key, entry)
@@ -5,13 +5,15 @@ from collections import defaultdict, deque
 from dotenv import load_dotenv
 import os
 import logging
+from alert_history import AlertHistory
+from product import Product, products_from_dicts, product_to_json
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 WAIT_FOR_BOT_SEC = 1
 
 
-def monitor_from_history(user_searches, active_monitoring_threads, monitor_search):
+def monitor_from_history(user_searches, start_monitoring):
     time.sleep(WAIT_FOR_BOT_SEC)
     for user_id, alerts_for_user in user_searches.items():
         alert_terms = [term for term in alerts_for_user.keys() if term != 'waiting_for_search']
@@ -21,18 +23,8 @@ def monitor_from_history(user_searches, active_monitoring_threads, monitor_searc
                 chat_id = alert_details.get('chat_id')
                 if chat_id:
                     logger.info(f"Reiniciando monitoreo para '{search_term}' (Usuario: {user_id}, Chat: {chat_id})")
-                    thread_key = f"{user_id}_{search_term}"
-                    if thread_key not in active_monitoring_threads:
-                        stop_event = threading.Event()
-                        monitor_thread = threading.Thread(
-                            target=monitor_search,
-                            args=(user_id, chat_id, search_term, stop_event),
-                            daemon=True
-                        )
-                        monitor_thread.start()
-                        active_monitoring_threads[thread_key] = stop_event
-                    else:
-                        logger.warning(f"Intento de reiniciar hilo para '{search_term}' ({user_id}) pero ya estaba registrado.")
+                    if not start_monitoring(user_id, chat_id, search_term):
+                        logger.warning(f"Intento de reiniciar monitoreo para '{search_term}' ({user_id}) pero ya estaba registrado.")
                 else:
                     logger.warning(f"Alerta activa para '{search_term}' (Usuario: {user_id}) cargada sin chat_id. No se puede reiniciar monitoreo.")
 
@@ -53,34 +45,81 @@ def load_data(filepath):
         logger.exception(f"Error inesperado al cargar datos desde {filepath}: {e}")
         return {}
 
-def save_data(data, filepath, lock):
-    # Función auxiliar para convertir deques a listas recursivamente
-    def convert_deques_to_lists(obj):
-        if isinstance(obj, deque):
-            # Si encontramos un deque, lo convertimos a lista
-            return list(obj)
-        elif isinstance(obj, dict):
-            # Si encontramos un diccionario, aplicamos la conversión a sus valores
-            return {k: convert_deques_to_lists(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            # Si encontramos una lista, aplicamos la conversión a sus elementos (por si hay deques anidados, aunque no debería pasar aquí)
-            return [convert_deques_to_lists(item) for item in obj]
-        else:
-            # Si es otro tipo (string, int, bool, None), lo devolvemos directamente
-            return obj
-
-    if isinstance(data, defaultdict):
-        data_to_serialize = convert_deques_to_lists(dict(data)) 
+# Función auxiliar para convertir deques a listas recursivamente
+def convert_deques_to_lists(obj):
+    if isinstance(obj, deque):
+        # Si encontramos un deque, lo convertimos a lista (y los productos a su dict JSON)
+        return [convert_deques_to_lists(item) for item in obj]
+    elif isinstance(obj, Product):
+        return obj.to_dict()
+    elif isinstance(obj, dict):
+        # Si encontramos un diccionario, aplicamos la conversión a sus valores
+        return {k: convert_deques_to_lists(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        # Si encontramos una lista, aplicamos la conversión a sus elementos (por si hay deques anidados, aunque no debería pasar aquí)
+        return [convert_deques_to_lists(item) for item in obj]
     else:
-        data_to_serialize = convert_deques_to_lists(data)
+        # Si es otro tipo (string, int, bool, None), lo devolvemos directamente
+        return obj
 
+def save_data(data, filepath, lock):
+    """Escribe data como JSON de forma atómica (archivo temporal + os.replace). Devuelve True si se guardó."""
+    tmp_path = f"{filepath}.tmp"
     with lock:
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
+            if isinstance(data, defaultdict):
+                data_to_serialize = convert_deques_to_lists(dict(data)) 
+            else:
+                data_to_serialize = convert_deques_to_lists(data)
+
+            with open(tmp_path, 'w', encoding='utf-8') as f:
                 json.dump(data_to_serialize, f, ensure_ascii=False, indent=4)
+            os.replace(tmp_path, filepath)
+            return True
 
         except Exception as e:
             logger.exception(f"Error guardando datos en {filepath}: {e}. Intentando limpiar archivo temporal.")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+
+class DebouncedWriter:
+    """
+    Agrupa las escrituras de un mismo archivo: cada mutación sólo marca el dato como sucio y,
+    pasada la ventana 'delay', se hace una única escritura atómica con save_data.
+    flush() fuerza la escritura pendiente (por ejemplo al apagar el bot).
+    """
+
+    def __init__(self, get_data, filepath, lock, delay=2.0):
+        # get_data() -> objeto actual a serializar
+        self._get_data = get_data
+        self.filepath = filepath
+        self._lock = lock
+        self.delay = delay
+        self._dirty = False
+        self._timer = None
+        self._state_lock = threading.Lock()
+
+    def mark_dirty(self):
+        with self._state_lock:
+            self._dirty = True
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._state_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            self._dirty = False
+        if not save_data(self._get_data(), self.filepath, self._lock):
+            # Por ejemplo si el dict cambió mientras se serializaba: reintentar en la próxima ventana
+            self.mark_dirty()
 
 def load_user_searches(USER_SEARCHES_FILE, user_searches):
     loaded_user_searches_data = load_data(USER_SEARCHES_FILE)
@@ -110,10 +149,11 @@ def load_product_history(PRODUCT_HISTORY_FILE, product_history, MAX_PRODUCT_HIST
         try:
             user_id = int(user_id_str)
             if isinstance(searches_data, dict):
-                product_history[user_id] = defaultdict(lambda: deque(maxlen=MAX_PRODUCT_HISTORY))
+                product_history[user_id] = defaultdict(lambda: AlertHistory(maxlen=MAX_PRODUCT_HISTORY))
                 for search_term, history_list in searches_data.items():
                         if isinstance(history_list, list):
-                            product_history[user_id][search_term].extend(history_list)
+                            product_history[user_id][search_term].extend(
+                                products_from_dicts(product for product in history_list if isinstance(product, dict)))
                         else:
                             logger.warning(f"Historial no válido para user {user_id}, search '{search_term}': {history_list}")
             else:
@@ -122,3 +162,178 @@ def load_product_history(PRODUCT_HISTORY_FILE, product_history, MAX_PRODUCT_HIST
             logger.warning(f"User ID no válido cargado en historial (no es entero): {user_id_str}")
     
     return product_history
+
+
+class ProductHistoryJournal:
+    """
+    Persistencia incremental del historial de productos: cada ciclo agrega al log (JSON lines)
+    sólo los productos nuevos o las alertas borradas, y cada 'compact_every' registros se
+    compacta todo en el snapshot (PRODUCT_HISTORY_FILE) y se vacía el log; si la compactación
+    falla, se vuelve a intentar recién después de otros 'compact_every' registros.
+    Al arrancar se carga el snapshot y se reproduce el log encima.
+    """
+
+    def __init__(self, snapshot_path, log_path, get_product_history, lock, compact_every=500):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        # get_product_history() -> dict actual del historial (para compactar)
+        self._get_product_history = get_product_history
+        self._lock = lock
+        self.compact_every = compact_every
+        self._records_since_compact = 0
+        # Registros del log a partir de los cuales se compacta (se corre tras un intento fallido)
+        self._compact_at = compact_every
+
+    def record_added(self, user_id, search_term, products):
+        """Registra productos agregados (en el orden en que se hizo appendleft)."""
+        records = [{"op": "add", "user": user_id, "term": search_term, "product": product} for product in products]
+        self._append(records)
+
+    def record_deleted(self, user_id, search_term):
+        """Registra el borrado del historial de una alerta."""
+        self._append([{"op": "del", "user": user_id, "term": search_term}])
+
+    def _append(self, records):
+        if not records:
+            return
+        with self._lock:
+            try:
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    for record in records:
+                        f.write(json.dumps(record, ensure_ascii=False, default=product_to_json) + "\n")
+                self._records_since_compact += len(records)
+            except Exception as e:
+                logger.exception(f"Error escribiendo en el log de historial {self.log_path}: {e}")
+                return
+            needs_compaction = self._records_since_compact >= self._compact_at
+        if needs_compaction:
+            self.compact()
+
+    def _snapshot(self):
+        """
+        Copia del historial como dicts JSON. Los workers de monitoreo hacen appendleft sin este lock:
+        cada dict y cada deque se copian con list(), que en CPython corre en C sin soltar el GIL,
+        y lo que se recorre después son esas copias.
+        """
+        return {user_id: {search_term: [product.to_dict() if isinstance(product, Product) else product
+                                        for product in list(history)]
+                          for search_term, history in list(searches.items())}
+                for user_id, searches in list(self._get_product_history().items())}
+
+    def compact(self):
+        """Escribe el historial completo en el snapshot (archivo temporal + os.replace) y vacía el log."""
+        with self._lock:
+            tmp_path = f"{self.snapshot_path}.tmp"
+            try:
+                data_to_serialize = self._snapshot()
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data_to_serialize, f, ensure_ascii=False)
+                os.replace(tmp_path, self.snapshot_path)
+                # El snapshot ya contiene todo lo registrado: el log puede empezar de cero
+                open(self.log_path, 'w', encoding='utf-8').close()
+                logger.info(f"Historial compactado en {self.snapshot_path} ({self._records_since_compact} registros del log).")
+                self._records_since_compact = 0
+                self._compact_at = self.compact_every
+            except Exception as e:
+                # Se conserva el log: el próximo intento de compactación lo incluye
+                self._compact_at = self._records_since_compact + self.compact_every
+                logger.exception(f"Error compactando historial en {self.snapshot_path}: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def replay(self, product_history, MAX_PRODUCT_HISTORY):
+        """Reproduce el log sobre el historial cargado del snapshot."""
+        if not os.path.exists(self.log_path):
+            return product_history
+        replayed = 0
+        with open(self.log_path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                    user_id = int(record["user"])
+                    search_term = record["term"]
+                    if record["op"] == "add":
+                        if user_id not in product_history:
+                            product_history[user_id] = defaultdict(lambda: AlertHistory(maxlen=MAX_PRODUCT_HISTORY))
+                        history = product_history[user_id][search_term]
+                        product = Product.from_dict(record["product"])
+                        # Puede estar ya en el snapshot (se compactó entre la mutación y su registro) o ser
+                        # la versión actualizada de una publicación conocida (bajó de precio): queda la del log
+                        history.replace(product)
+                    elif record["op"] == "del":
+                        if user_id in product_history:
+                            product_history[user_id].pop(search_term, None)
+                            if not product_history[user_id]:
+                                del product_history[user_id]
+                    replayed += 1
+                except (ValueError, KeyError, TypeError) as e:
+                    # Típicamente la última línea a medio escribir si el bot se cortó
+                    logger.warning(f"Registro inválido en {self.log_path}:{line_number}: {e}. Ignorando.")
+        self._records_since_compact = replayed
+        logger.info(f"Log de historial reproducido: {replayed} registros desde {self.log_path}")
+        return product_history
+
+
+class JsonStorage:
+    """
+    Almacenamiento en archivos JSON (backend original): user_searches.json se reescribe en cada cambio
+    de alertas y el historial usa ProductHistoryJournal. Misma interfaz que db.SQLiteStorage.
+    """
+
+    def __init__(self, user_searches_file, product_history_file, product_history_log_file,
+                 get_user_searches, get_product_history, MAX_PRODUCT_HISTORY, save_delay=2.0):
+        self.user_searches_file = user_searches_file
+        self.product_history_file = product_history_file
+        self.max_product_history = MAX_PRODUCT_HISTORY
+        self.user_searches_lock = threading.Lock()
+        self.product_history_lock = threading.Lock()
+        # Los cambios de alertas dentro de una misma ventana terminan en una sola escritura
+        self.user_searches_writer = DebouncedWriter(get_user_searches, user_searches_file,
+                                                    self.user_searches_lock, delay=save_delay)
+        self.history_journal = ProductHistoryJournal(product_history_file, product_history_log_file,
+                                                     get_product_history, self.product_history_lock)
+
+    def save_alert(self, user_id, search_term, alert_details):
+        self.user_searches_writer.mark_dirty()
+
+    def delete_alert(self, user_id, search_term):
+        self.user_searches_writer.mark_dirty()
+        self.history_journal.record_deleted(user_id, search_term)
+
+    def add_products(self, user_id, search_term, products):
+        self.history_journal.record_added(user_id, search_term, products)
+
+    def load(self, user_searches, product_history):
+        user_searches = load_user_searches(USER_SEARCHES_FILE=self.user_searches_file,
+                                           user_searches=user_searches)
+        product_history = load_product_history(PRODUCT_HISTORY_FILE=self.product_history_file,
+                                               product_history=product_history,
+                                               MAX_PRODUCT_HISTORY=self.max_product_history)
+        # Aplicar los cambios registrados desde el último snapshot y compactar
+        product_history = self.history_journal.replay(product_history, self.max_product_history)
+        self.history_journal.compact()
+        return user_searches, product_history
+
+    def has_data(self):
+        return os.path.exists(self.user_searches_file) or os.path.exists(self.product_history_file)
+
+    # El estado de las publicaciones (precios, última vez vistas) no se guarda en JSON: vive en memoria
+
+    def save_listings(self, rows):
+        pass
+
+    def prune_listings(self, before):
+        pass
+
+    def load_listings(self, since):
+        return []
+
+    def flush(self, timeout=None):
+        self.user_searches_writer.flush()
+        self.history_journal.compact()
+
+    def close(self):
+        self.flush()
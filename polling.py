@@ -0,0 +1,98 @@
+import random
+import threading
+import logging
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# Cuánto se estira el intervalo por cada ciclo seguido sin publicaciones nuevas (hasta max_seconds)
+EMPTY_POLL_BACKOFF = 1.5
+
+
+class AdaptiveInterval:
+    """
+    Intervalo de refresco por búsqueda según la velocidad a la que aparecen publicaciones nuevas.
+
+    Lleva un EWMA de IDs nuevos por segundo para cada grupo del scheduler y apunta a que cada
+    ciclo traiga unos target_new_per_poll productos nuevos: las búsquedas con mucho movimiento
+    se refrescan más seguido y las que casi no cambian se espacian hasta max_seconds.
+    Sin datos todavía (alerta nueva o reinicio) se usa el rango aleatorio cold_start_range; una
+    búsqueda que no trae nada se espacia de a poco desde ese rango (EMPTY_POLL_BACKOFF por ciclo vacío).
+    Con requests_per_hour, si la suma de todas las búsquedas supera el presupuesto, los intervalos
+    se estiran en proporción. Se usa como interval_fn de QueryScheduler.
+    """
+
+    def __init__(self, min_seconds, max_seconds, target_new_per_poll=1.0, alpha=0.3,
+                 requests_per_hour=None, jitter=0.1, cold_start_range=(185, 353)):
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.cold_start_range = cold_start_range
+        self.target_new_per_poll = target_new_per_poll
+        self.alpha = alpha
+        self.requests_per_hour = requests_per_hour
+        self.jitter = jitter
+        # _rates: { QueryGroup: IDs nuevos por segundo (EWMA) }
+        self._rates = weakref.WeakKeyDictionary()
+        # _empty_polls: { QueryGroup: ciclos seguidos sin IDs nuevos }
+        self._empty_polls = weakref.WeakKeyDictionary()
+        # _intervals: { QueryGroup: último intervalo asignado } - para calcular el consumo total
+        self._intervals = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def __call__(self, group=None):
+        if group is None:
+            # Sin grupo no hay historia: el mismo intervalo que una búsqueda recién creada
+            return int(self._cold_start())
+        with self._lock:
+            rate = self._observe(group)
+            interval = self._base_interval(rate, self._empty_polls.get(group, 0))
+            interval = self._apply_budget(group, interval)
+            self._intervals[group] = interval
+        # Jitter para que las búsquedas no queden sincronizadas entre sí
+        interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return int(max(self.min_seconds, min(self.max_seconds, interval)))
+
+    def _observe(self, group):
+        # Requiere self._lock
+        new_count = group.last_new_count
+        elapsed = group.last_poll_elapsed
+        group.last_new_count = None
+        rate = self._rates.get(group)
+        if new_count is not None and elapsed:
+            sample = new_count / elapsed
+            rate = sample if rate is None else self.alpha * sample + (1 - self.alpha) * rate
+            self._rates[group] = rate
+            self._empty_polls[group] = self._empty_polls.get(group, 0) + 1 if new_count == 0 else 0
+        return rate
+
+    def _cold_start(self):
+        low, high = self.cold_start_range
+        return max(self.min_seconds, min(self.max_seconds, random.uniform(low, high)))
+
+    def _base_interval(self, rate, empty_polls):
+        if rate is None:
+            # Todavía sin datos: un valor al azar del rango fijo de siempre, acotado a los límites
+            return self._cold_start()
+        if rate <= 0:
+            # Nada nuevo desde que se sigue la búsqueda: se espacia de a poco en vez de saltar a max_seconds
+            return min(self.max_seconds, self._cold_start() * EMPTY_POLL_BACKOFF ** empty_polls)
+        return max(self.min_seconds, min(self.max_seconds, self.target_new_per_poll / rate))
+
+    def _apply_budget(self, group, interval):
+        # Requiere self._lock
+        if not self.requests_per_hour:
+            return interval
+        requests_per_hour = 3600 / interval + sum(
+            3600 / other_interval for other, other_interval in self._intervals.items() if other is not group)
+        if requests_per_hour <= self.requests_per_hour:
+            return interval
+        return min(self.max_seconds, interval * requests_per_hour / self.requests_per_hour)
+
+    def stats(self):
+        """Búsquedas con datos, consumo estimado (peticiones/hora) y presupuesto."""
+        with self._lock:
+            intervals = list(self._intervals.values())
+            tracked = len(self._rates)
+        return {"tracked_queries": tracked,
+                "requests_per_hour": round(sum(3600 / interval for interval in intervals), 1),
+                "budget_per_hour": self.requests_per_hour}
@@ -0,0 +1,55 @@
+import functools
+import re
+
+# Moneda de "$" a secas: Marketplace muestra los precios en la moneda local (el bot apunta a Argentina)
+DEFAULT_CURRENCY = "ARS"
+# Prefijos de moneda, los más específicos primero ("US$" antes que "$")
+CURRENCY_MARKERS = (('us$', 'USD'), ('u$s', 'USD'), ('usd', 'USD'), ('r$', 'BRL'), ('€', 'EUR'), ('eur', 'EUR'),
+                    ('ars', 'ARS'), ('$', DEFAULT_CURRENCY))
+FREE_WORDS = ('gratis', 'free')
+NUMBER_PATTERN = re.compile(r'\d[\d.,]*')
+CENTS = 100
+
+
+def _amount_to_cents(number):
+    """'150.000' / '1.234,50' / '23,000' / '99.9' -> centavos."""
+    number = number.rstrip('.,')
+    last_separator = max(number.rfind('.'), number.rfind(','))
+    decimals = ''
+    # Separador decimal: el último, si lo siguen 1 o 2 dígitos ("1.234,50", "99.9"); el resto son de miles
+    if last_separator != -1 and len(number) - last_separator - 1 in (1, 2):
+        number, decimals = number[:last_separator], number[last_separator + 1:]
+    units = int(number.replace('.', '').replace(',', '') or 0)
+    return units * CENTS + int(decimals.ljust(2, '0') or 0)
+
+@functools.lru_cache(maxsize=16384)
+def parse_formatted_price(text):
+    """
+    (centavos, moneda) de un precio formateado ("$ 150.000", "US$1,200", "Gratis", "$100 - $200").
+    En los rangos queda el extremo inferior. (None, None) si no tiene número.
+    Los formatos se repiten mucho entre publicaciones: el resultado se cachea por string.
+    """
+    if not isinstance(text, str):
+        return (None, None)
+    lowered = text.lower()
+    if any(word in lowered for word in FREE_WORDS):
+        return (0, None)
+    match = NUMBER_PATTERN.search(lowered)
+    if not match:
+        return (None, None)
+    prefix = lowered[:match.start()]
+    currency = next((code for marker, code in CURRENCY_MARKERS if marker in prefix), None)
+    return (_amount_to_cents(match.group()), currency)
+
+# Cómo se muestra cada moneda al formatear un monto
+CURRENCY_SYMBOLS = {'ARS': '$', 'USD': 'US$', 'BRL': 'R$', 'EUR': '€'}
+
+def format_cents(cents, currency=None):
+    """Monto en centavos con el formato de Marketplace en Argentina: "$ 150.000" / "US$ 1.200,50"."""
+    if cents is None:
+        return "Sin precio"
+    units, decimals = divmod(cents, CENTS)
+    text = f"{units:,}".replace(',', '.')
+    if decimals:
+        text += f",{decimals:02d}"
+    return f"{CURRENCY_SYMBOLS.get(currency, currency or '$')} {text}"
@@ -0,0 +1,128 @@
+import sys
+import threading
+import weakref
+
+from prices import parse_formatted_price
+
+PRODUCT_URL_TEMPLATE = "https://www.facebook.com/marketplace/item/{}/"
+DEFAULT_CITY = "Ubicación desconocida"
+
+
+class Product:
+    """
+    Publicación de Marketplace. Registro compacto (__slots__) que reemplaza al dict de producto:
+    la URL se deriva del id en vez de guardarse, y get()/[] mantienen compatibilidad con el
+    código que usaba product.get('titulo'). to_dict()/from_dict() usan el esquema JSON de siempre.
+    Junto al precio formateado ('precio', para mostrar) van el monto en centavos y la moneda,
+    para comparar y ordenar sin volver a parsear el texto.
+    """
+
+    __slots__ = ('id', 'titulo', 'precio', 'precio_centavos', 'moneda', 'imagen_url', 'ciudad', '__weakref__')
+
+    # Claves del esquema JSON (en el orden en que se guardaban los dicts; las numéricas del precio al final)
+    KEYS = ('id', 'titulo', 'precio', 'url', 'imagen_url', 'ciudad', 'precio_centavos', 'moneda')
+
+    def __init__(self, id, titulo='Sin título', precio='Sin precio', imagen_url=None, ciudad=DEFAULT_CITY,
+                 precio_centavos=None, moneda=None):
+        self.id = id
+        self.titulo = titulo
+        self.precio = precio
+        if precio_centavos is None:
+            # Registros guardados antes de tener el campo numérico
+            precio_centavos, parsed_currency = parse_formatted_price(precio)
+            moneda = moneda or parsed_currency
+        self.precio_centavos = precio_centavos
+        self.moneda = sys.intern(moneda) if isinstance(moneda, str) else moneda
+        self.imagen_url = imagen_url
+        # Hay pocas ciudades distintas: se comparte un único string por ciudad
+        self.ciudad = sys.intern(ciudad) if isinstance(ciudad, str) else ciudad
+
+    @property
+    def url(self):
+        return PRODUCT_URL_TEMPLATE.format(self.id)
+
+    def get(self, key, default=None):
+        if key not in self.KEYS:
+            return default
+        return getattr(self, key)
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.KEYS}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Crea (o reutiliza) un Product a partir de un dict con el esquema JSON. 'url' se ignora."""
+        if isinstance(data, Product):
+            return data
+        return make_product(
+            data.get('id'),
+            data.get('titulo', 'Sin título'),
+            data.get('precio', 'Sin precio'),
+            data.get('imagen_url'),
+            data.get('ciudad', DEFAULT_CITY),
+            data.get('precio_centavos'),
+            data.get('moneda')
+        )
+
+    def _same_listing_data(self, titulo, precio, imagen_url, ciudad):
+        return (self.titulo == titulo and self.precio == precio
+                and self.imagen_url == imagen_url and self.ciudad == ciudad)
+
+    def __repr__(self):
+        return f"Product(id={self.id!r}, titulo={self.titulo!r}, precio={self.precio!r})"
+
+
+# _shared_products: { listing_id: Product } - una sola instancia por publicación mientras alguna alerta la tenga
+_shared_products = weakref.WeakValueDictionary()
+_shared_products_lock = threading.Lock()
+
+def make_product(listing_id, titulo, precio, imagen_url, ciudad, precio_centavos=None, moneda=None):
+    """
+    Devuelve el Product de esta publicación, compartido entre todas las alertas que la tengan.
+    Si los datos cambiaron (ej. bajó el precio) se crea una instancia nueva para los historiales
+    que la agreguen desde ahora; los que tenían la anterior la conservan.
+    """
+    if listing_id is None:
+        return Product(listing_id, titulo, precio, imagen_url, ciudad, precio_centavos, moneda)
+    with _shared_products_lock:
+        return _make_shared_product(listing_id, titulo, precio, imagen_url, ciudad, precio_centavos, moneda)
+
+def _make_shared_product(listing_id, titulo, precio, imagen_url, ciudad, precio_centavos=None, moneda=None):
+    # Requiere _shared_products_lock. El monto numérico sale del mismo precio: basta comparar el texto
+    product = _shared_products.get(listing_id)
+    if product is None or not product._same_listing_data(titulo, precio, imagen_url, ciudad):
+        product = Product(listing_id, titulo, precio, imagen_url, ciudad, precio_centavos, moneda)
+        _shared_products[listing_id] = product
+    return product
+
+def products_from_dicts(dicts):
+    """Versión en lote de Product.from_dict para cargas grandes (toma el lock una sola vez)."""
+    products = []
+    with _shared_products_lock:
+        for data in dicts:
+            if isinstance(data, Product):
+                products.append(data)
+            elif data.get('id') is None:
+                products.append(Product.from_dict(data))
+            else:
+                products.append(_make_shared_product(
+                    data['id'],
+                    data.get('titulo', 'Sin título'),
+                    data.get('precio', 'Sin precio'),
+                    data.get('imagen_url'),
+                    data.get('ciudad', DEFAULT_CITY),
+                    data.get('precio_centavos'),
+                    data.get('moneda')
+                ))
+    return products
+
+def product_to_json(obj):
+    """Para json.dump(..., default=product_to_json)."""
+    if isinstance(obj, Product):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -0,0 +1,170 @@
+import random
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Códigos de Marketplace que indican bloqueo o sesión inválida: frenan a todo el bot, no sólo a una búsqueda
+BREAKER_STATUS_CODES = (401, 403, 429)
+
+
+class TokenBucket:
+    """Token bucket thread-safe: rate tokens por segundo, hasta capacity acumulados."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        # Requiere self._lock
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """Toma un token (aunque quede en deuda) y devuelve cuántos segundos hay que esperar para usarlo."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def available(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+
+class CircuitBreaker:
+    """
+    Corta todas las peticiones a Marketplace tras un 401/403/429.
+    Cada disparo seguido duplica la pausa (con jitter) hasta max_pause; al vencer deja pasar
+    una sola petición de prueba (half_open): si sale bien se cierra, si no vuelve a abrirse.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, base_pause=60, max_pause=1800, jitter=0.2, status_codes=BREAKER_STATUS_CODES):
+        self.status_codes = tuple(status_codes)
+        self.base_pause = base_pause
+        self.max_pause = max_pause
+        self.jitter = jitter
+        self._state = self.CLOSED
+        self._open_until = 0.0
+        self._trips = 0
+        self._last_status = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True si se puede hacer una petición ahora."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.monotonic() >= self._open_until:
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self._state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.warning(f"Circuit breaker de Marketplace cerrado tras {self._trips} disparos: se reanudan las peticiones.")
+            self._state = self.CLOSED
+            self._trips = 0
+            self._probe_in_flight = False
+
+    def record_failure(self, status_code):
+        """Registra una respuesta HTTP con error; sólo los códigos de status_codes abren el circuito."""
+        with self._lock:
+            self._probe_in_flight = False
+            if status_code not in self.status_codes:
+                if self._state == self.HALF_OPEN:
+                    # La prueba no confirmó nada: se reintenta en la próxima petición
+                    self._state = self.OPEN
+                    self._open_until = time.monotonic()
+                return
+            self._trips += 1
+            self._last_status = status_code
+            pause = min(self.max_pause, self.base_pause * 2 ** (self._trips - 1))
+            pause *= random.uniform(1 - self.jitter, 1 + self.jitter)
+            self._state = self.OPEN
+            self._open_until = time.monotonic() + pause
+        logger.warning(f"Circuit breaker de Marketplace abierto por HTTP {status_code}: "
+                       f"todas las peticiones en pausa por {pause:.0f} segundos (disparo {self._trips}).")
+
+    def state(self):
+        with self._lock:
+            return {"state": self._state,
+                    "retry_in": max(0.0, round(self._open_until - time.monotonic(), 1)) if self._state == self.OPEN else 0.0,
+                    "consecutive_trips": self._trips,
+                    "last_status": self._last_status}
+
+
+class RateLimiter:
+    """
+    Límite global de peticiones a Marketplace: un token bucket por cookie (requests_per_minute,
+    con ráfagas de hasta burst) y un circuit breaker compartido por todo el proceso.
+    Con varias cuentas conviene dejar 401/403 fuera de breaker_status_codes: esos errores son de
+    una sola cookie y los maneja la cuarentena del SessionPool.
+    """
+
+    def __init__(self, requests_per_minute=30, burst=5, base_pause=60, max_pause=1800,
+                 breaker_status_codes=BREAKER_STATUS_CODES):
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst
+        self.breaker = CircuitBreaker(base_pause=base_pause, max_pause=max_pause, status_codes=breaker_status_codes)
+        # _buckets: { cookie: TokenBucket }
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, cookie, requests_per_minute=None):
+        with self._lock:
+            bucket = self._buckets.get(cookie)
+            if bucket is None:
+                bucket = TokenBucket((requests_per_minute or self.requests_per_minute) / 60, self.burst)
+                self._buckets[cookie] = bucket
+            return bucket
+
+    def reserve(self, cookie, requests_per_minute=None):
+        """
+        Segundos a esperar antes de pedir con esta cookie, o None si el circuit breaker está abierto.
+        requests_per_minute: límite propio de la cookie (None = el global).
+        """
+        if not self.breaker.allow():
+            return None
+        return self._bucket(cookie, requests_per_minute).reserve()
+
+    def acquire(self, cookie, requests_per_minute=None):
+        """Bloquea hasta poder hacer la petición. False si el circuit breaker está abierto."""
+        wait = self.reserve(cookie, requests_per_minute)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def record_response(self, status_code):
+        if status_code is not None and status_code < 400:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure(status_code)
+
+    def state(self):
+        """Estado para monitoreo: circuit breaker, límite configurado y tokens disponibles por cookie."""
+        state = self.breaker.state()
+        with self._lock:
+            buckets = list(self._buckets.values())
+        state["requests_per_minute"] = self.requests_per_minute
+        state["tokens_available"] = [round(bucket.available(), 2) for bucket in buckets]
+        return state
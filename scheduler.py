@@ -0,0 +1,305 @@
+import heapq
+import itertools
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from unidecode import unidecode
+
+from filters import merge_price_bounds
+from geo import covering_region, regions_overlap
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(search_term):
+    """Normaliza un término de búsqueda igual que save_search (minúsculas, sin tildes, espacios simples)."""
+    return unidecode(' '.join(search_term.lower().split()))
+
+def region_key(region):
+    """Clave hasheable para una región {'latitude', 'longitude', 'radius'}."""
+    return (round(float(region["latitude"]), 4), round(float(region["longitude"]), 4), float(region["radius"]))
+
+
+class QueryGroup:
+    """
+    Todas las alertas activas que comparten la misma búsqueda normalizada y cuyas regiones se pueden
+    cubrir con un único círculo (ver QueryScheduler.max_cover_radius).
+    """
+
+    def __init__(self, query, region):
+        self.query = query
+        # Región que se le pide a GraphQL: cubre la de todas las alertas del grupo
+        self.region = region
+        # subscribers: { (user_id, search_term): on_products }
+        self.subscribers = {}
+        # subscriber_regions: { (user_id, search_term): región } - cada alerta filtra su propio círculo
+        self.subscriber_regions = {}
+        # subscriber_price_bounds: { (user_id, search_term): (mínimo, máximo) } - el filtro de precio de cada alerta
+        self.subscriber_price_bounds = {}
+        # Cotas que se le piden a GraphQL: cubren el rango de todas las alertas del grupo
+        self.price_bounds = (None, None)
+        self.last_products = None
+        # IDs del último resultado: el próximo fetch deja de paginar al encontrar alguno
+        self.seen_ids = None
+        # Observación del último ciclo para el intervalo adaptativo: IDs nuevos y segundos desde el fetch anterior
+        self.last_new_count = None
+        self.last_poll_elapsed = None
+        self.last_poll_at = None
+        # Momento (time.monotonic) en que le toca el próximo ciclo
+        self.next_due = None
+        # running: hay un ciclo en el pool; rerun: se pidió reprogramar mientras corría
+        self.running = False
+        self.rerun = False
+
+
+class QueryScheduler:
+    """
+    Deduplica las alertas activas por (búsqueda normalizada, región) y hace un único
+    fetch por grupo y por ciclo, repartiendo los productos a cada suscriptor.
+    Con max_cover_radius, las alertas de la misma búsqueda con círculos que se superponen comparten
+    un fetch sobre un círculo que las cubre a todas (de hasta ese radio en km).
+
+    Un solo hilo despachador mantiene un heap ordenado por próximo vencimiento y
+    manda los grupos vencidos a un pool de tamaño fijo, en vez de un hilo dormido por alerta.
+    """
+
+    def __init__(self, fetch_products, interval_fn, max_workers=8, max_cover_radius=0):
+        # fetch_products(search_term, region, seen_ids, price_bounds) -> list | None (seen_ids es None en el primer ciclo)
+        # interval_fn(group) -> segundos hasta el próximo ciclo del grupo (ver polling.AdaptiveInterval)
+        self._fetch_products = fetch_products
+        self._interval_fn = interval_fn
+        self._max_workers = max_workers
+        # 0: sólo comparten fetch las alertas con exactamente la misma región
+        self.max_cover_radius = max_cover_radius
+        # _groups: { (query, n): QueryGroup } - la región de un grupo cambia con sus suscriptores
+        self._groups = {}
+        self._group_ids = itertools.count()
+        # _subscriptions: { (user_id, search_term): group_key }
+        self._subscriptions = {}
+        # _heap: [(next_due, seq, group_key)] - puede tener entradas viejas, se validan contra group.next_due
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._executor = None
+        self._dispatcher = None
+        self._stopped = False
+
+    def start(self):
+        """Arranca el hilo despachador y el pool de workers (idempotente)."""
+        with self._lock:
+            if self._dispatcher is not None:
+                return
+            self._stopped = False
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="monitor")
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, name="monitor-scheduler", daemon=True)
+            self._dispatcher.start()
+        logger.info(f"Scheduler de monitoreo iniciado con {self._max_workers} workers.")
+
+    def stop(self, wait=True):
+        """Detiene el despachador y el pool. Las suscripciones se conservan."""
+        with self._lock:
+            if self._dispatcher is None:
+                return
+            self._stopped = True
+            self._wakeup.notify_all()
+            dispatcher, executor = self._dispatcher, self._executor
+            self._dispatcher = None
+            self._executor = None
+        dispatcher.join()
+        executor.shutdown(wait=wait)
+        logger.info("Scheduler de monitoreo detenido.")
+
+    def subscribe(self, user_id, search_term, region, on_products, price_bounds=(None, None)):
+        """
+        Suscribe una alerta a su grupo de búsqueda. on_products(products) se llama en cada ciclo
+        con la lista de productos (o None si el fetch falló). Devuelve False si ya estaba suscripta.
+        price_bounds: (mínimo, máximo) del filtro de precio de la alerta, para pedirle a GraphQL sólo ese rango.
+        """
+        self.start()
+        alert_key = (user_id, search_term)
+        query = normalize_query(search_term)
+        with self._lock:
+            if alert_key in self._subscriptions:
+                return False
+            group_key = self._find_group(query, region)
+            is_new_group = group_key is None
+            if is_new_group:
+                group_key = (query, next(self._group_ids))
+                group = QueryGroup(query, region)
+                self._groups[group_key] = group
+                # Un grupo nuevo hace su primer fetch de inmediato
+                self._schedule(group_key, group, 0)
+            group = self._groups[group_key]
+            group.subscribers[alert_key] = on_products
+            group.subscriber_price_bounds[alert_key] = tuple(price_bounds)
+            group.subscriber_regions[alert_key] = region
+            self._subscriptions[alert_key] = group_key
+            last_products = group.last_products
+            widened = self._update_price_bounds(group)
+            widened = self._update_region(group) or widened
+            if widened and not is_new_group:
+                # El grupo ahora pide un rango o una zona más amplia: el último resultado no sirve de
+                # línea base para esta alerta (quedarían afuera publicaciones viejas de su rango)
+                last_products = None
+                if group.running:
+                    group.rerun = True
+                else:
+                    self._schedule(group_key, group, 0)
+
+        if is_new_group:
+            logger.info(f"Nuevo grupo de búsqueda '{group.query}' en {region_key(group.region)} (Usuario: {user_id})")
+        else:
+            logger.info(f"Alerta '{search_term}' (Usuario: {user_id}) unida al grupo existente '{group.query}' ({len(group.subscribers)} suscriptores)")
+            # Usar el último resultado del grupo como primer scrapeo del nuevo suscriptor
+            if last_products:
+                self._deliver(group, alert_key, on_products, last_products)
+        return True
+
+    def unsubscribe(self, user_id, search_term):
+        """Quita una alerta de su grupo. Si el grupo queda vacío, deja de programarse."""
+        alert_key = (user_id, search_term)
+        with self._lock:
+            group_key = self._subscriptions.pop(alert_key, None)
+            if group_key is None:
+                return False
+            group = self._groups[group_key]
+            group.subscribers.pop(alert_key, None)
+            group.subscriber_price_bounds.pop(alert_key, None)
+            group.subscriber_regions.pop(alert_key, None)
+            self._update_price_bounds(group)
+            if group.subscriber_regions:
+                # Sin esta alerta el círculo que cubre al resto puede achicarse
+                self._update_region(group)
+            if not group.subscribers:
+                del self._groups[group_key]
+                group.next_due = None
+                logger.info(f"Grupo de búsqueda '{group.query}' sin suscriptores. Deteniendo.")
+        return True
+
+    def reschedule(self, user_id, search_term, delay=0):
+        """Adelanta o atrasa el próximo ciclo del grupo de una alerta a 'delay' segundos desde ahora."""
+        with self._lock:
+            group_key = self._subscriptions.get((user_id, search_term))
+            if group_key is None:
+                return False
+            group = self._groups[group_key]
+            if group.running:
+                group.rerun = True
+            else:
+                self._schedule(group_key, group, delay)
+        return True
+
+    def is_subscribed(self, user_id, search_term):
+        with self._lock:
+            return (user_id, search_term) in self._subscriptions
+
+    def stats(self):
+        """Cantidad de alertas suscriptas, de búsquedas reales (grupos) por ciclo y de ciclos en curso."""
+        with self._lock:
+            return {"alerts": len(self._subscriptions),
+                    "queries": len(self._groups),
+                    "running": sum(1 for group in self._groups.values() if group.running)}
+
+    def fetch_region(self, user_id, search_term):
+        """Región que se está pidiendo para el grupo de una alerta (None si no está suscripta)."""
+        with self._lock:
+            group_key = self._subscriptions.get((user_id, search_term))
+            return self._groups[group_key].region if group_key is not None else None
+
+    def _find_group(self, query, region):
+        # Requiere self._lock. Primero un grupo con la misma región; si no, uno cuyo círculo se superponga
+        # con el de la alerta y que, sumándola, no pase de max_cover_radius
+        key = region_key(region)
+        candidates = [(group_key, group) for group_key, group in self._groups.items() if group.query == query]
+        for group_key, group in candidates:
+            if region_key(group.region) == key:
+                return group_key
+        if not self.max_cover_radius:
+            return None
+        best = None
+        for group_key, group in candidates:
+            if not regions_overlap(group.region, region):
+                continue
+            covering = covering_region([*group.subscriber_regions.values(), region])
+            if covering["radius"] <= self.max_cover_radius and (best is None or covering["radius"] < best[0]):
+                best = (covering["radius"], group_key)
+        return best[1] if best else None
+
+    def _update_region(self, group):
+        # Requiere self._lock. True si cambió la región que se le pide a GraphQL
+        region = covering_region(group.subscriber_regions.values())
+        changed = region_key(region) != region_key(group.region)
+        group.region = region
+        return changed
+
+    def _update_price_bounds(self, group):
+        # Requiere self._lock. True si cambiaron las cotas que se le piden a GraphQL
+        price_bounds = merge_price_bounds(group.subscriber_price_bounds.values())
+        changed = price_bounds != group.price_bounds
+        group.price_bounds = price_bounds
+        return changed
+
+    def _schedule(self, group_key, group, delay):
+        # Requiere self._lock
+        group.next_due = time.monotonic() + delay
+        heapq.heappush(self._heap, (group.next_due, next(self._seq), group_key))
+        self._wakeup.notify()
+
+    def _dispatch_loop(self):
+        with self._lock:
+            while not self._stopped:
+                if not self._heap:
+                    self._wakeup.wait()
+                    continue
+                due, _, group_key = self._heap[0]
+                now = time.monotonic()
+                if due > now:
+                    self._wakeup.wait(due - now)
+                    continue
+                heapq.heappop(self._heap)
+                group = self._groups.get(group_key)
+                # Entrada vieja: el grupo fue eliminado, reprogramado o ya está corriendo
+                if group is None or group.next_due != due or group.running:
+                    continue
+                group.running = True
+                group.next_due = None
+                self._executor.submit(self._run_cycle, group_key, group)
+
+    def _deliver(self, group, alert_key, on_products, products):
+        try:
+            on_products(products)
+        except Exception as e:
+            logger.exception(f"Error entregando productos de '{group.query}' a {alert_key}: {e}")
+
+    def _fan_out(self, group, products):
+        """Guarda el resultado del ciclo en el grupo y lo entrega a cada suscriptor."""
+        with self._lock:
+            if products is not None:
+                now = time.monotonic()
+                if group.seen_ids is not None:
+                    group.last_new_count = sum(1 for product in products if product.id not in group.seen_ids)
+                    group.last_poll_elapsed = now - group.last_poll_at
+                group.last_poll_at = now
+                group.last_products = products
+                group.seen_ids = frozenset(product.id for product in products)
+            subscribers = list(group.subscribers.items())
+
+        logger.info(f"Grupo '{group.query}': repartiendo resultados a {len(subscribers)} suscriptores.")
+        for alert_key, on_products in subscribers:
+            self._deliver(group, alert_key, on_products, products)
+
+    def _run_cycle(self, group_key, group):
+        try:
+            self._fan_out(group, self._fetch_products(group.query, group.region, group.seen_ids, group.price_bounds))
+        except Exception as e:
+            logger.exception(f"Error inesperado en el ciclo del grupo '{group.query}': {e}")
+        finally:
+            with self._lock:
+                group.running = False
+                if self._groups.get(group_key) is group:
+                    refresh_interval = 0 if group.rerun else self._interval_fn(group)
+                    group.rerun = False
+                    self._schedule(group_key, group, refresh_interval)
+                    logger.info(f"Grupo '{group.query}' esperando {refresh_interval} segundos.")
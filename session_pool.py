@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Campos del payload atados a la sesión de Facebook (el resto de STATIC_PAYLOAD es igual para todas)
+SESSION_PAYLOAD_FIELDS = ('av', '__user', 'fb_dtsg', 'jazoest', 'lsd', '__hs', '__rev',
+                          '__spin_r', '__spin_b', '__spin_t', '__hsi', '__dyn', '__csr')
+
+AUTH_STATUS_CODES = (401, 403)
+THROTTLE_STATUS_CODES = (429,)
+
+
+class MarketplaceSession:
+    """Una cuenta de Facebook: cookie, campos propios del payload y su estado de salud."""
+
+    def __init__(self, name, cookie, payload=None, requests_per_minute=None):
+        self.name = name
+        self.cookie = cookie
+        # payload: campos que reemplazan a los de STATIC_PAYLOAD para esta cuenta (lsd, __hs, __spin_*, ...)
+        self.payload = {k: v for k, v in (payload or {}).items() if k in SESSION_PAYLOAD_FIELDS}
+        # Límite propio de peticiones por minuto (None = el límite global)
+        self.requests_per_minute = requests_per_minute
+        # health: 1.0 = todas las peticiones recientes bien, baja con cada error (EWMA)
+        self.health = 1.0
+        self.in_flight = 0
+        self.requests = 0
+        self.quarantined_until = 0.0
+        self.quarantine_count = 0
+        self.last_status = None
+
+    def is_quarantined(self, now=None):
+        return (now if now is not None else time.monotonic()) < self.quarantined_until
+
+
+class SessionPool:
+    """
+    Reparte las peticiones entre varias cuentas de Facebook.
+    Elige la sesión menos cargada (o en round robin), lleva un puntaje de salud por sesión y pone
+    en cuarentena las que reciben 401/403 (cookie vencida o bloqueada) o 429, duplicando la
+    cuarentena cada vez que vuelve a pasar, para que el resto siga buscando.
+    """
+
+    def __init__(self, sessions, strategy="least_loaded", auth_quarantine=3600, throttle_quarantine=120,
+                 max_quarantine=86400, health_alpha=0.2):
+        self.sessions = list(sessions)
+        self.strategy = strategy
+        self.auth_quarantine = auth_quarantine
+        self.throttle_quarantine = throttle_quarantine
+        self.max_quarantine = max_quarantine
+        self.health_alpha = health_alpha
+        self._next_index = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def acquire(self):
+        """Reserva una sesión para una petición, o None si todas están en cuarentena. Devolverla con release()."""
+        with self._lock:
+            now = time.monotonic()
+            available = [session for session in self.sessions if not session.is_quarantined(now)]
+            if not available:
+                return None
+            if self.strategy == "round_robin":
+                session = available[self._next_index % len(available)]
+                self._next_index += 1
+            else:
+                session = min(available, key=lambda s: (s.in_flight, -s.health, s.requests))
+            session.in_flight += 1
+            session.requests += 1
+            return session
+
+    def cancel(self, session):
+        """Devuelve una sesión reservada con la que al final no se hizo la petición."""
+        with self._lock:
+            session.in_flight -= 1
+            session.requests -= 1
+
+    def release(self, session, status_code):
+        """Registra el resultado de la petición (status_code None = error de red/timeout)."""
+        with self._lock:
+            session.in_flight -= 1
+            session.last_status = status_code
+            ok = status_code is not None and status_code < 400
+            session.health = (1 - self.health_alpha) * session.health + self.health_alpha * (1.0 if ok else 0.0)
+            if ok:
+                session.quarantine_count = 0
+                return
+            if status_code in AUTH_STATUS_CODES:
+                base = self.auth_quarantine
+            elif status_code in THROTTLE_STATUS_CODES:
+                base = self.throttle_quarantine
+            else:
+                return
+            session.quarantine_count += 1
+            pause = min(self.max_quarantine, base * 2 ** (session.quarantine_count - 1))
+            session.quarantined_until = time.monotonic() + pause
+            available = sum(1 for s in self.sessions if not s.is_quarantined())
+        logger.warning(f"Sesión de Facebook '{session.name}' en cuarentena por {pause} segundos (HTTP {status_code}). "
+                       f"Quedan {available} de {len(self.sessions)} sesiones disponibles.")
+
+    def next_available_in(self):
+        """Segundos hasta que alguna sesión salga de cuarentena (0 si hay alguna disponible)."""
+        with self._lock:
+            if not self.sessions:
+                return 0.0
+            now = time.monotonic()
+            return max(0.0, min(session.quarantined_until for session in self.sessions) - now)
+
+    def state(self):
+        """Estado de cada sesión para monitoreo."""
+        with self._lock:
+            now = time.monotonic()
+            return [{"name": session.name,
+                     "health": round(session.health, 2),
+                     "in_flight": session.in_flight,
+                     "requests": session.requests,
+                     "quarantined_for": max(0.0, round(session.quarantined_until - now, 1)),
+                     "last_status": session.last_status}
+                    for session in self.sessions]
+
+
+def load_session_pool(filepath, fallback_cookie=None, **pool_options):
+    """
+    Carga las sesiones de un archivo JSON:
+        [{"name": "cuenta1", "cookie": "...", "payload": {"lsd": "...", "__hs": "..."}, "requests_per_minute": 20}, ...]
+    Si el archivo no existe usa fallback_cookie (FACEBOOK_COOKIE) como única sesión.
+    """
+    sessions = []
+    if filepath and os.path.exists(filepath):
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            for i, entry in enumerate(entries):
+                if not entry.get('cookie'):
+                    logger.warning(f"Sesión {i} de {filepath} sin 'cookie'. Saltando.")
+                    continue
+                sessions.append(MarketplaceSession(entry.get('name') or f"sesion{i + 1}", entry['cookie'],
+                                                   entry.get('payload'), entry.get('requests_per_minute')))
+            logger.info(f"Cargadas {len(sessions)} sesiones de Facebook desde {filepath}")
+        except (json.JSONDecodeError, OSError, TypeError, AttributeError) as e:
+            logger.error(f"Error cargando sesiones de Facebook desde {filepath}: {e}")
+    if not sessions and fallback_cookie:
+        sessions.append(MarketplaceSession("FACEBOOK_COOKIE", fallback_cookie))
+    return SessionPool(sessions, **pool_options)
@@ -0,0 +1,120 @@
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from aiohttp import web
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+# Campos de un Update que traen al usuario que lo originó (en el orden en que se buscan)
+UPDATE_FIELDS = ('message', 'callback_query', 'edited_message', 'inline_query', 'chosen_inline_result',
+                 'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+                 'chat_join_request', 'channel_post', 'edited_channel_post')
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def update_user_key(update):
+    """Usuario (o chat) al que pertenece un update; los que no tienen ninguno se procesan sueltos."""
+    for field in UPDATE_FIELDS:
+        content = getattr(update, field, None)
+        if content is None:
+            continue
+        user = getattr(content, 'from_user', None) or getattr(content, 'user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(content, 'chat', None)
+        if chat is not None:
+            return chat.id
+    return ('update', update.update_id)
+
+
+class UpdateDispatcher:
+    """
+    Reparte los updates de Telegram en un pool de hilos.
+    Los de un mismo usuario se procesan de a uno y en el orden en que llegaron (cola por usuario);
+    los de usuarios distintos van en paralelo, así un handler lento (ej. "Buscar Ahora") sólo demora
+    a quien lo tocó. Cada hilo atiende un update y devuelve el lugar, para no acaparar el pool.
+    """
+
+    def __init__(self, process_updates, max_workers=16):
+        # process_updates: bot.process_new_updates (con el bot en threaded=False)
+        self._process_updates = process_updates
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="updates")
+        # _queues: { user_key: deque([update, ...]) } - sólo usuarios con updates pendientes o en proceso
+        self._queues = {}
+        self._processed = 0
+        self._lock = threading.Lock()
+
+    def submit(self, update):
+        """Encola un update sin esperar a que se procese."""
+        key = update_user_key(update)
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                # Ya hay un hilo con este usuario: lo toma cuando termine el update actual
+                queue.append(update)
+                return
+            self._queues[key] = deque([update])
+        self._executor.submit(self._run_next, key)
+
+    def _run_next(self, key):
+        with self._lock:
+            update = self._queues[key].popleft()
+        try:
+            self._process_updates([update])
+        except Exception as e:
+            logger.exception(f"Error procesando el update {update.update_id}: {e}")
+        with self._lock:
+            self._processed += 1
+            if not self._queues[key]:
+                del self._queues[key]
+                return
+        self._executor.submit(self._run_next, key)
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.max_workers,
+                    "active_users": len(self._queues),
+                    "pending": sum(len(queue) for queue in self._queues.values()),
+                    "processed": self._processed}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def create_webhook_app(dispatcher, path, secret_token=None):
+    """App aiohttp que recibe los updates de Telegram y responde 200 apenas los encola."""
+
+    async def handle_update(request):
+        if secret_token and request.headers.get(SECRET_TOKEN_HEADER) != secret_token:
+            logger.warning(f"Webhook: petición rechazada desde {request.remote} (secret token inválido).")
+            return web.Response(status=403)
+        try:
+            update = types.Update.de_json(await request.text())
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Webhook: update inválido descartado: {e}")
+            return web.Response(status=400)
+        dispatcher.submit(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+
+def run_webhook(bot, dispatcher, url, listen="0.0.0.0", port=8443, secret_token=None, max_connections=40):
+    """
+    Registra el webhook en Telegram y atiende las peticiones hasta que se corte el proceso (bloqueante).
+    El HTTPS lo pone un proxy delante (nginx, Caddy, un túnel...): este servidor escucha en HTTP plano.
+    """
+    path = urlsplit(url).path or "/"
+    app = create_webhook_app(dispatcher, path, secret_token)
+    bot.remove_webhook()
+    bot.set_webhook(url=url, secret_token=secret_token, max_connections=max_connections)
+    logger.info(f"Webhook registrado en {url}; escuchando en {listen}:{port}{path} con {dispatcher.max_workers} workers.")
+    web.run_app(app, host=listen, port=port, print=None)